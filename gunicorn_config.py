@@ -0,0 +1,28 @@
+"""
+gunicorn configuration for the instrument agent
+
+    gunicorn -c gunicorn_config.py ooi_instrument_agent:app
+"""
+import time
+
+bind = '0.0.0.0:12572'
+workers = 2
+worker_class = 'gevent'
+logconfig = 'logging.conf'
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.time()
+
+
+def post_worker_init(worker):
+    # Runs in the forked worker once gevent is set up and the app is loaded, but before the
+    # worker accepts connections. Doing this in post_fork itself would run ahead of the
+    # gevent worker's hub reinitialization, so it only records the fork time.
+    from ooi_instrument_agent import metrics, views
+    metrics.WORKER_STARTUP.observe(time.time() - worker.forked_at, phase='import')
+    timings = views.initialize_worker()
+    # from here on log records are written by a background greenlet, off the request path
+    views.page.log_queue.install()
+    worker.log.info('Worker ready %.3fs after fork (%s)', time.time() - worker.forked_at,
+                    ', '.join('%s %.3fs' % item for item in sorted(timings.items())))
@@ -0,0 +1,184 @@
+import atexit
+import json
+import logging
+import random
+import time
+from collections import deque
+
+import gevent
+
+from ooi_instrument_agent.common import (get_env_number, LOG_QUEUE_SIZE_ENV_KEY, DEFAULT_LOG_QUEUE_SIZE,
+                                         ACCESS_LOG_SAMPLE_ENV_KEY, DEFAULT_ACCESS_LOG_SAMPLE)
+from ooi_instrument_agent.metrics import LOG_RECORDS_DROPPED
+
+log = logging.getLogger(__name__)
+access_log = logging.getLogger('ooi_instrument_agent.access')
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler which only queues records, leaving formatting and I/O to a flusher greenlet.
+
+    As with the standard library's QueueHandler, the message and any exception are rendered when
+    the record is queued, since the arguments may change before it is written. The flusher hands
+    each batch to the target handlers, writing all the lines for a stream handler at once and
+    flushing it once per batch. Records arriving while the queue is full are dropped and counted
+    rather than blocking the request which logged them.
+    """
+    def __init__(self, targets, size=DEFAULT_LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.targets = targets
+        self.size = size
+        self.queue = deque()
+
+    def emit(self, record):
+        if len(self.queue) >= self.size:
+            LOG_RECORDS_DROPPED.inc()
+            return
+        self.queue.append(self.prepare(record))
+
+    @staticmethod
+    def prepare(record):
+        # an AccessRecord is built for its log record alone, so its serialization can still be deferred
+        if record.args and not isinstance(record.args, AccessRecord):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def drain(self):
+        records = []
+        while self.queue:
+            records.append(self.queue.popleft())
+        for handler in self.targets:
+            write_batch(handler, [record for record in records if record.levelno >= handler.level])
+
+    def close(self):
+        self.drain()
+        logging.Handler.close(self)
+
+
+def write_batch(handler, records):
+    records = [record for record in records if handler.filter(record)]
+    if not records:
+        return
+    if not isinstance(handler, logging.StreamHandler) or getattr(handler, 'stream', None) is None:
+        for record in records:
+            handler.handle(record)
+        return
+    lines = []
+    for record in records:
+        try:
+            lines.append(handler.format(record) + '\n')
+        except Exception:
+            handler.handleError(record)
+    handler.acquire()
+    try:
+        handler.stream.write(''.join(lines))
+        handler.flush()
+    except Exception:
+        handler.handleError(records[-1])
+    finally:
+        handler.release()
+
+
+class LogQueue(object):
+    """
+    Moves logging I/O off the request path: install() swaps the handlers of the given loggers
+    for QueueHandlers drained by a single greenlet every interval seconds.
+
+    :param size: Records held per handler before new ones are dropped, 0 to log synchronously
+    """
+    def __init__(self, size=DEFAULT_LOG_QUEUE_SIZE, interval=0.5):
+        self.size = size
+        self.interval = interval
+        self.handlers = []
+        self.flusher = None
+
+    @classmethod
+    def from_environ(cls):
+        return cls(size=get_env_number(LOG_QUEUE_SIZE_ENV_KEY, DEFAULT_LOG_QUEUE_SIZE))
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def install(self, loggers=None):
+        """
+        :param loggers: Loggers whose handlers to queue, the root and access loggers by default
+        """
+        if not self.enabled or self.flusher is not None:
+            return
+        for logger in loggers or (logging.getLogger(), access_log):
+            if not logger.handlers:
+                continue
+            handler = QueueHandler(list(logger.handlers), self.size)
+            logger.handlers = [handler]
+            self.handlers.append(handler)
+
+        def flush():
+            while True:
+                gevent.sleep(self.interval)
+                self.flush()
+        self.flusher = gevent.spawn(flush)
+        atexit.register(self.flush)
+
+    def flush(self):
+        for handler in self.handlers:
+            try:
+                handler.drain()
+            except Exception as e:
+                # the handlers failed, do not go through them to say so
+                LOG_RECORDS_DROPPED.inc()
+                log.debug('Log flush failed: %s', e)
+
+
+class AccessRecord(dict):
+    """
+    A structured access log entry, serialized only when the record is formatted
+    """
+    def __str__(self):
+        return json.dumps(self, separators=(',', ':'), sort_keys=True)
+
+
+class AccessLog(object):
+    """
+    One structured record per request, logged at INFO to the 'ooi_instrument_agent.access' logger.
+
+    Successful GETs, by far the bulk of the traffic, are logged with probability get_sample;
+    the records carry the sample rate so counts can be scaled back up. Everything else is
+    always logged.
+    """
+    def __init__(self, get_sample=DEFAULT_ACCESS_LOG_SAMPLE):
+        self.get_sample = get_sample
+
+    @classmethod
+    def from_environ(cls):
+        return cls(get_sample=get_env_number(ACCESS_LOG_SAMPLE_ENV_KEY, DEFAULT_ACCESS_LOG_SAMPLE, float))
+
+    def sampled(self, method, status):
+        if method != 'GET' or status >= 400 or self.get_sample >= 1:
+            return 1
+        if random.random() < self.get_sample:
+            return self.get_sample
+        return 0
+
+    def record(self, method, path, endpoint, refdes, status, elapsed, size=None, client=None, priority=None,
+               phases=None):
+        """
+        :param phases: Dictionary of phase (consul, lock, zmq, queue) -> seconds
+        """
+        sample = self.sampled(method, status)
+        if not sample or not access_log.isEnabledFor(logging.INFO):
+            return
+        entry = AccessRecord(time=round(time.time() - elapsed, 6), method=method, path=path, endpoint=endpoint,
+                             refdes=refdes, status=status, elapsed=round(elapsed, 6), size=size, client=client,
+                             priority=priority)
+        for phase, seconds in (phases or {}).items():
+            entry[phase] = round(seconds, 6)
+        if sample < 1:
+            entry['sample'] = sample
+        access_log.info('%s', entry)
@@ -0,0 +1,124 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from collections import namedtuple
+from logging import getLogger
+
+from flask import request, Response
+from six import BytesIO
+from werkzeug.exceptions import abort
+
+from ooi_instrument_agent.common import get_env_number, ASSET_MAX_AGE_ENV_KEY, DEFAULT_ASSET_MAX_AGE
+
+log = getLogger(__name__)
+
+DEFAULT_ASSET_DIR = os.path.join(os.path.dirname(__file__), 'agent-web', 'app')
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+MIN_COMPRESS_SIZE = 512
+# appended to the ETag of the precompressed representation
+GZIP_ETAG_SUFFIX = '-gz'
+
+Asset = namedtuple('Asset', 'data gzipped etag mimetype mtime')
+
+
+def compress(data):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as fh:
+        fh.write(data)
+    return buf.getvalue()
+
+
+class AssetStore(object):
+    """
+    In-memory copy of the agent-web UI.
+
+    Every file below root is read once, hashed for its ETag and, where worthwhile, gzip compressed
+    ahead of time. Responses honour If-None-Match and Accept-Encoding. index.html must always be
+    revalidated, as it names the other assets; everything else may be cached for max_age seconds.
+
+    :param reload: Check modification times on each request and reload changed files (development)
+    """
+    def __init__(self, root=DEFAULT_ASSET_DIR, max_age=DEFAULT_ASSET_MAX_AGE, reload=False):
+        self.root = root
+        self.max_age = max_age
+        self.reload = reload
+        self.assets = {}
+
+    @classmethod
+    def from_environ(cls):
+        return cls(max_age=get_env_number(ASSET_MAX_AGE_ENV_KEY, DEFAULT_ASSET_MAX_AGE))
+
+    def scan(self):
+        """
+        Load every file below root
+        :return: Number of assets loaded
+        """
+        assets = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                try:
+                    assets[path] = self.load(path)
+                except (IOError, OSError) as e:
+                    log.warn('Unable to load asset %s: %s', path, e)
+        self.assets = assets
+        if not assets:
+            log.warn('No UI assets found in %s', self.root)
+        return len(assets)
+
+    def load(self, path):
+        filename = os.path.join(self.root, path)
+        mtime = os.path.getmtime(filename)
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        gzipped = None
+        if len(data) >= MIN_COMPRESS_SIZE and mimetype.startswith(COMPRESSIBLE_TYPES):
+            gzipped = compress(data)
+            if len(gzipped) >= len(data):
+                gzipped = None
+        etag = hashlib.md5(data).hexdigest()
+        return Asset(data, gzipped, etag, mimetype, mtime)
+
+    def get(self, path):
+        """
+        :return: The Asset at path relative to root, or None
+        """
+        asset = self.assets.get(path)
+        if self.reload:
+            filename = os.path.join(self.root, path)
+            if not os.path.isfile(filename):
+                self.assets.pop(path, None)
+                return None
+            if asset is None or os.path.getmtime(filename) != asset.mtime:
+                asset = self.assets[path] = self.load(path)
+        return asset
+
+    def response(self, path):
+        """
+        Build the response for the asset at path, 404 if there is none
+        """
+        asset = self.get(path)
+        if asset is None:
+            abort(404)
+
+        gzipped = asset.gzipped is not None and request.accept_encodings['gzip']
+        # the two encodings differ byte for byte, so they must not share a strong validator
+        etag = asset.etag + GZIP_ETAG_SUFFIX if gzipped else asset.etag
+        headers = {'ETag': '"%s"' % etag, 'Vary': 'Accept-Encoding'}
+        if path == 'index.html':
+            headers['Cache-Control'] = 'no-cache'
+        else:
+            headers['Cache-Control'] = 'public, max-age=%d' % self.max_age
+
+        # either encoding is current; the Compressor weakens the tag of responses it compresses,
+        # so compare weakly
+        if (request.if_none_match.contains_weak(asset.etag) or
+                request.if_none_match.contains_weak(asset.etag + GZIP_ETAG_SUFFIX)):
+            return Response(status=304, headers=headers)
+
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+            return Response(asset.gzipped, mimetype=asset.mimetype, headers=headers)
+        return Response(asset.data, mimetype=asset.mimetype, headers=headers)
@@ -0,0 +1,25 @@
+"""
+Benchmark harness for the instrument agent.
+
+fleet       - simulated ZMQ driver fleet and Consul stand-in
+serve       - run the agent under a gevent WSGI server
+load        - load generator reporting throughput and p50/p99 latency per endpoint
+replay      - replay a recorded agent trace against the simulated fleet
+encode      - JSON encoder and compression comparison on fleet sized payloads
+"""
+import socket
+
+from gevent import socket as gsocket
+
+
+def listener(host, port, backlog=256):
+    """
+    Listening socket with TCP_NODELAY set, which accepted connections inherit.
+    Without it small keep-alive responses stall on delayed ACKs, as gunicorn and Consul avoid.
+    """
+    sock = gsocket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
@@ -0,0 +1,142 @@
+import base64
+import json
+import re
+from logging import getLogger
+
+from gevent.event import Event
+from six.moves.urllib.parse import parse_qs
+
+log = getLogger(__name__)
+
+WAIT_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_wait(wait, default=300):
+    """
+    Parse a Consul wait parameter (e.g. 10s, 5m) into seconds
+    """
+    if not wait:
+        return default
+    match = re.match(r'^(\d+)(ms|s|m|h)?$', wait)
+    if match is None:
+        return default
+    return int(match.group(1)) * WAIT_UNITS[match.group(2) or 's']
+
+
+class ConsulStub(object):
+    """
+    In-process stand-in for the subset of the Consul HTTP API used by the agent and the sniffer:
+
+    GET /v1/health/service/<service>   (tag, passing, index and wait)
+    GET/PUT/DELETE /v1/kv/<key>        (recurse and cas)
+
+    Every change increments a global index, which is returned in X-Consul-Index and used to
+    answer blocking queries. Served as a WSGI application, e.g. with gevent.pywsgi.
+    """
+    def __init__(self):
+        self.services = {}
+        self.kv = {}
+        self.index = 1
+        self.changed = Event()
+
+    def _bump(self):
+        self.index += 1
+        # wake any blocking queries, later queries wait on a fresh event
+        changed, self.changed = self.changed, Event()
+        changed.set()
+
+    def register(self, service, tag, host, port, node='bench'):
+        entry = {
+            'Node': {'Node': node, 'Address': host},
+            'Service': {'ID': '%s_%s' % (service, tag), 'Service': service, 'Tags': [tag],
+                        'Address': '', 'Port': port},
+            'Checks': [{'Node': node, 'CheckID': 'service:%s_%s' % (service, tag), 'Status': 'passing'}],
+        }
+        self.services.setdefault(service, []).append(entry)
+        self._bump()
+        return entry
+
+    def deregister(self, service, tag):
+        self.services[service] = [e for e in self.services.get(service, []) if tag not in e['Service']['Tags']]
+        self._bump()
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '')
+        params = dict((k, v[-1]) for k, v in parse_qs(environ.get('QUERY_STRING', '')).items())
+
+        if path.startswith('/v1/health/service/') and method == 'GET':
+            status, body = self.health(path[len('/v1/health/service/'):], params)
+        elif path.startswith('/v1/kv/'):
+            key = path[len('/v1/kv/'):]
+            if method == 'GET':
+                status, body = self.kv_get(key, params)
+            elif method == 'PUT':
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+                status, body = self.kv_put(key, params, environ['wsgi.input'].read(length))
+            elif method == 'DELETE':
+                status, body = self.kv_delete(key, params)
+            else:
+                status, body = '405 Method Not Allowed', None
+        else:
+            status, body = '404 Not Found', None
+
+        data = json.dumps(body) if body is not None else ''
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(data))),
+                                ('X-Consul-Index', str(self.index))])
+        return [data]
+
+    def _block(self, params):
+        index = params.get('index')
+        if index is not None and int(index) >= self.index:
+            self.changed.wait(timeout=parse_wait(params.get('wait')))
+
+    def health(self, service, params):
+        self._block(params)
+        tag = params.get('tag')
+        entries = self.services.get(service, [])
+        if tag:
+            entries = [e for e in entries if tag in e['Service']['Tags']]
+        return '200 OK', entries
+
+    def _kv_entry(self, key, entry):
+        value = entry['Value']
+        return {'Key': key, 'Value': base64.b64encode(value) if value is not None else None, 'Flags': 0,
+                'CreateIndex': entry['CreateIndex'], 'ModifyIndex': entry['ModifyIndex'], 'LockIndex': 0}
+
+    def kv_get(self, key, params):
+        self._block(params)
+        if 'recurse' in params:
+            matches = [self._kv_entry(k, v) for k, v in sorted(self.kv.items()) if k.startswith(key)]
+        else:
+            matches = [self._kv_entry(key, self.kv[key])] if key in self.kv else []
+        if not matches:
+            return '404 Not Found', None
+        return '200 OK', matches
+
+    def kv_put(self, key, params, value):
+        current = self.kv.get(key)
+        cas = params.get('cas')
+        if cas is not None:
+            cas = int(cas)
+            if (cas == 0 and current is not None) or (cas != 0 and (current is None or
+                                                                     current['ModifyIndex'] != cas)):
+                return '200 OK', False
+        self._bump()
+        create_index = current['CreateIndex'] if current is not None else self.index
+        self.kv[key] = {'Value': value, 'CreateIndex': create_index, 'ModifyIndex': self.index}
+        return '200 OK', True
+
+    def kv_delete(self, key, params):
+        if 'recurse' in params:
+            for k in [k for k in self.kv if k.startswith(key)]:
+                del self.kv[k]
+        else:
+            current = self.kv.get(key)
+            cas = params.get('cas')
+            if current is not None and cas is not None and current['ModifyIndex'] != int(cas):
+                return '200 OK', False
+            self.kv.pop(key, None)
+        self._bump()
+        return '200 OK', True
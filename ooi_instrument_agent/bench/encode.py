@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Compare JSON encoders and response compression on fleet sized payloads.
+
+    python -m ooi_instrument_agent.bench.encode --drivers 500
+
+For each payload reports the encoded size and encode time of the old pretty printed jsonify output
+and of every available compact encoder, then the gzip and deflate size and compression time of the
+compact encoding at the agent's default level.
+
+Then for each driver RPC compares the ZMQ envelope codecs: request and reply bytes, and the agent's
+CPU time per command (encoding the request plus decoding the reply). msgpack-py marks msgpack running
+without its C extension, which the agent does not negotiate.
+"""
+import argparse
+import json
+import random
+import sys
+import timeit
+import zlib
+
+from ooi_instrument_agent.bench.fleet import build_metadata, DEFAULT_PREFIX
+from ooi_instrument_agent.client import msgpack, msgpack_dumps, msgpack_loads, msgpack_is_compiled
+from ooi_instrument_agent.common import DEFAULT_COMPRESS_LEVEL
+from ooi_instrument_agent.encoding import ENCODERS, WBITS
+
+STATES = ['DRIVER_STATE_COMMAND', 'DRIVER_STATE_AUTOSAMPLE', 'DRIVER_STATE_UNKNOWN', 'DRIVER_STATE_DIRECT_ACCESS']
+
+
+def parameter_values(parameters):
+    values = {}
+    for i in range(parameters):
+        kind = i % 3
+        if kind == 0:
+            values['PARAM_%02d' % i] = random.randint(0, 100000)
+        elif kind == 1:
+            values['PARAM_%02d' % i] = random.random() * 1000
+        else:
+            values['PARAM_%02d' % i] = 'setting-%d' % random.randint(0, 100)
+    return values
+
+
+def driver_response(value):
+    return {'cmd': {'cmd': 'get_resource', 'args': ['DRIVER_PARAMETER_ALL'], 'kwargs': {}},
+            'type': 'DRIVER_ASYNC_RESULT', 'time': 3700000000 + random.random() * 1e6, 'value': value}
+
+
+def build_payloads(drivers, parameters):
+    """
+    :return: name -> payload as returned by the agent's endpoints
+    """
+    random.seed(0)
+    refdes = ['%s%03d' % (DEFAULT_PREFIX, i) for i in range(drivers)]
+    state = driver_response({'state': {'resource': 'DRIVER_STATE_COMMAND'},
+                             'metadata': build_metadata(parameters),
+                             'parameters': parameter_values(parameters)})
+    state['locked-by'] = None
+    return {
+        'status': dict((name, random.choice(STATES)) for name in refdes),
+        'locks': {'locks': dict((name, 'operator%d' % random.randint(0, 20)) for name in refdes[::3])},
+        'overall_state': state,
+        'resource': driver_response(parameter_values(parameters)),
+        'fleet_resource': dict((name, driver_response(parameter_values(parameters))) for name in refdes),
+    }
+
+
+def pretty(obj):
+    # what flask.jsonify produced
+    return json.dumps(obj, indent=2, separators=(', ', ': '), sort_keys=True)
+
+
+def best_time(func, repeat=5, number=None):
+    timer = timeit.Timer(func)
+    if number is None:
+        number = max(1, int(0.2 / max(timer.timeit(1), 1e-6)))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def available_encoders():
+    encoders = [('jsonify', pretty)]
+    for name in sorted(ENCODERS):
+        try:
+            ENCODERS[name]({})
+        except ImportError:
+            continue
+        encoders.append((name, ENCODERS[name]))
+    return encoders
+
+
+def run(payloads, level=DEFAULT_COMPRESS_LEVEL):
+    rows = []
+    for name in sorted(payloads):
+        payload = payloads[name]
+        for encoder_name, encoder in available_encoders():
+            data = encoder(payload)
+            rows.append((name, encoder_name, len(data), best_time(lambda: encoder(payload))))
+        compact = ENCODERS['json'](payload)
+        for encoding in ('gzip', 'deflate'):
+            def compress():
+                compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+                return compressor.compress(compact) + compressor.flush()
+            rows.append((name, 'json+%s' % encoding, len(compress()), best_time(compress)))
+    return rows
+
+
+def format_rows(rows):
+    lines = ['%-15s %-16s %10s %10s' % ('payload', 'encoding', 'bytes', 'ms')]
+    for name, encoding, size, seconds in rows:
+        lines.append('%-15s %-16s %10d %10.3f' % (name, encoding, size, seconds * 1000))
+    return '\n'.join(lines)
+
+
+def build_rpc_messages(parameters):
+    """
+    :return: command -> (request, reply) as exchanged with a driver
+    """
+    random.seed(0)
+    metadata = build_metadata(parameters)
+    values = parameter_values(parameters)
+    names = sorted(values)
+    commands = {
+        'process_echo': ((), 'ping from %s000' % DEFAULT_PREFIX),
+        'overall_state': ((), {'state': {'resource': 'DRIVER_STATE_COMMAND'}, 'metadata': metadata,
+                               'parameters': values}),
+        'get_resource_state': ((), 'DRIVER_STATE_COMMAND'),
+        'get_resource': (('DRIVER_PARAMETER_ALL',), values),
+        'set_resource': ((dict((name, values[name]) for name in names[:3]),), values),
+        'execute_resource': (('DRIVER_EVENT_ACQUIRE_SAMPLE',), [None, 'OK']),
+    }
+    messages = {}
+    for command, (args, value) in commands.items():
+        request = {'cmd': command, 'args': list(args), 'kwargs': {'timeout': 90000}}
+        reply = {'cmd': request, 'type': 'DRIVER_ASYNC_RESULT', 'time': 3700000000 + random.random() * 1e6,
+                 'value': value}
+        messages[command] = request, reply
+    return messages
+
+
+def driver_codecs():
+    codecs = [('json', lambda obj: json.dumps(obj), json.loads)]
+    if msgpack is not None:
+        # the agent will not negotiate the pure Python fallback
+        codecs.append(('msgpack' if msgpack_is_compiled() else 'msgpack-py', msgpack_dumps, msgpack_loads))
+    return codecs
+
+
+def run_rpc(messages):
+    rows = []
+    for command in sorted(messages):
+        request, reply = messages[command]
+        for name, dumps, loads in driver_codecs():
+            reply_data = dumps(reply)
+
+            def exchange():
+                dumps(request)
+                loads(reply_data)
+            rows.append((command, name, len(dumps(request)), len(reply_data), best_time(exchange)))
+    return rows
+
+
+def format_rpc_rows(rows):
+    lines = ['%-19s %-8s %10s %10s %10s %8s' % ('command', 'codec', 'req bytes', 'rep bytes', 'us', 'saved')]
+    json_rows = dict((row[0], row) for row in rows if row[1] == 'json')
+    for command, codec, request_size, reply_size, seconds in rows:
+        baseline = json_rows[command]
+        saved = '%d%%' % round(100 - 100.0 * (request_size + reply_size) / (baseline[2] + baseline[3]))
+        lines.append('%-19s %-8s %10d %10d %10.1f %8s' % (command, codec, request_size, reply_size,
+                                                           seconds * 1e6, saved))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark JSON encoding and compression')
+    parser.add_argument('--drivers', type=int, default=500)
+    parser.add_argument('--parameters', type=int, default=50)
+    parser.add_argument('--level', type=int, default=DEFAULT_COMPRESS_LEVEL)
+    args = parser.parse_args(argv)
+    print(format_rows(run(build_payloads(args.drivers, args.parameters), args.level)))
+    print('')
+    print(format_rpc_rows(run_rpc(build_rpc_messages(args.parameters))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
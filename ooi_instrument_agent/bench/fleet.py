@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Simulated fleet of ZMQ instrument drivers plus a Consul stand-in, for benchmarking the agent.
+
+    python -m ooi_instrument_agent.bench.fleet --drivers 500 --latency 0.01 --timeout-rate 0.01
+
+Prints "CONSUL <host>:<port>" once all drivers are registered, then serves until killed.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from logging import getLogger
+
+import gevent
+import zmq.green as zmq
+from gevent.lock import Semaphore
+from gevent.pywsgi import WSGIServer
+
+from ooi_instrument_agent.bench import listener
+from ooi_instrument_agent.bench.consul_stub import ConsulStub
+from ooi_instrument_agent.client import msgpack, msgpack_dumps, msgpack_loads, is_msgpack
+from ooi_instrument_agent.discovery import write_registry
+
+log = getLogger(__name__)
+
+DEFAULT_PREFIX = 'RS10ENGC-XX00X-00-SIMDRV'
+
+COMMAND_TIMEOUTS = {
+    'DRIVER_EVENT_ACQUIRE_SAMPLE': 30,
+    'DRIVER_EVENT_START_AUTOSAMPLE': 60,
+    'DRIVER_EVENT_STOP_AUTOSAMPLE': 60,
+    'DRIVER_EVENT_DISCOVER': 60,
+    'DRIVER_EVENT_SET': 30,
+}
+
+
+def build_metadata(parameters):
+    """
+    Build overall_state metadata describing the simulated commands and parameters
+    """
+    return {
+        'commands': dict((name, {'display_name': name, 'timeout': timeout})
+                         for name, timeout in COMMAND_TIMEOUTS.items()),
+        'parameters': dict(('PARAM_%02d' % i, {'display_name': 'Parameter %d' % i,
+                                               'description': 'Simulated parameter %d' % i,
+                                               'visibility': 'READ_WRITE',
+                                               'range': [0, 1000],
+                                               'value': {'type': 'int'}})
+                           for i in range(parameters)),
+    }
+
+
+class SimulatedDriver(object):
+    """
+    A driver answering the agent's RPC commands on a ZMQ ROUTER socket.
+
+    :param latency: Fixed delay in seconds before each response
+    :param jitter: Additional uniformly distributed delay in seconds
+    :param timeout_rate: Fraction of requests which are never answered
+    :param parameters: Number of simulated parameters
+    :param accept_msgpack: Answer in msgpack when offered or sent msgpack, otherwise behave as a
+                           JSON-only driver which cannot parse msgpack requests
+    """
+    def __init__(self, refdes, context, host='127.0.0.1', latency=0.0, jitter=0.0, timeout_rate=0.0,
+                 parameters=20, accept_msgpack=True):
+        self.refdes = refdes
+        self.host = host
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.accept_msgpack = accept_msgpack and msgpack is not None
+        self.socket = context.socket(zmq.ROUTER)
+        self.port = self.socket.bind_to_random_port('tcp://%s' % host)
+        self.send_lock = Semaphore()
+        self.metadata = build_metadata(parameters)
+        self.values = dict((name, 0) for name in self.metadata['parameters'])
+        self.resource_state = 'DRIVER_STATE_COMMAND'
+        self.calls = {}
+        self.greenlet = None
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.serve)
+        return self
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+        self.socket.close(linger=0)
+
+    def serve(self):
+        while True:
+            frames = self.socket.recv_multipart()
+            gevent.spawn(self.handle, frames)
+
+    def handle(self, frames):
+        body = frames[-1]
+        if is_msgpack(body):
+            if not self.accept_msgpack:
+                log.warn('%s cannot decode msgpack request', self.refdes)
+                return
+            msg = msgpack_loads(body)
+            codec = 'msgpack'
+        else:
+            msg = json.loads(body)
+            codec = 'msgpack' if self.accept_msgpack and 'msgpack' in msg.get('accept', ()) else 'json'
+        command = msg.get('cmd')
+        self.calls[command] = self.calls.get(command, 0) + 1
+
+        if self.timeout_rate and random.random() < self.timeout_rate:
+            return
+
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            gevent.sleep(delay)
+
+        reply = {'cmd': msg, 'type': 'DRIVER_ASYNC_RESULT', 'time': time.time(),
+                 'value': self.respond(command, msg.get('args', []), msg.get('kwargs', {}))}
+        data = msgpack_dumps(reply) if codec == 'msgpack' else json.dumps(reply)
+        with self.send_lock:
+            self.socket.send_multipart(frames[:-1] + [data])
+
+    def respond(self, command, args, kwargs):
+        if command == 'process_echo':
+            return 'ping from %s' % self.refdes
+        if command == 'overall_state':
+            return {'state': {'resource': self.resource_state}, 'metadata': self.metadata,
+                    'parameters': self.values}
+        if command in ('get_resource_state', 'discover_state'):
+            return self.resource_state
+        if command == 'get_resource':
+            names = args[0] if args else 'DRIVER_PARAMETER_ALL'
+            if names == 'DRIVER_PARAMETER_ALL':
+                return dict(self.values)
+            return dict((name, self.values.get(name)) for name in names)
+        if command == 'set_resource':
+            self.values.update(args[0] if args else {})
+            return dict(self.values)
+        if command == 'execute_resource':
+            return [None, 'OK']
+        if command in ('set_init_params', 'stop_driver_process', 'set_log_level'):
+            return 'OK'
+        return 'Unknown command %r' % command
+
+
+class Fleet(object):
+    """
+    A collection of simulated drivers, optionally registered with a ConsulStub
+
+    :param refdes: Explicit reference designators to simulate, overriding size and prefix
+    """
+    def __init__(self, size, prefix=DEFAULT_PREFIX, context=None, refdes=None, **driver_kwargs):
+        self.context = context or zmq.Context()
+        if refdes is None:
+            refdes = ['%s%03d' % (prefix, i) for i in range(size)]
+        self.drivers = [SimulatedDriver(name, self.context, **driver_kwargs) for name in refdes]
+
+    @property
+    def refdes(self):
+        return [driver.refdes for driver in self.drivers]
+
+    def start(self):
+        for driver in self.drivers:
+            driver.start()
+        return self
+
+    def stop(self):
+        for driver in self.drivers:
+            driver.stop()
+
+    def register(self, consul_stub):
+        for driver in self.drivers:
+            consul_stub.register('instrument_driver', driver.refdes, driver.host, driver.port)
+
+    def registry(self):
+        """
+        :return: The fleet as the contents of a discovery registry file
+        """
+        return {'instrument_driver': dict((driver.refdes, [driver.host, driver.port]) for driver in self.drivers)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a simulated driver fleet and Consul stand-in')
+    parser.add_argument('--drivers', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='response delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='additional random delay in seconds')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='fraction of requests never answered')
+    parser.add_argument('--parameters', type=int, default=20)
+    parser.add_argument('--consul-port', type=int, default=0)
+    parser.add_argument('--refdes-file', help='simulate the reference designators listed in this file')
+    parser.add_argument('--registry-file', help='also write the fleet to this discovery registry file')
+    parser.add_argument('--json-only', action='store_true', help='simulate drivers without msgpack support')
+    args = parser.parse_args(argv)
+
+    refdes = None
+    if args.refdes_file:
+        with open(args.refdes_file) as fh:
+            refdes = [line.strip() for line in fh if line.strip()]
+
+    fleet = Fleet(args.drivers, refdes=refdes, latency=args.latency, jitter=args.jitter,
+                  timeout_rate=args.timeout_rate, parameters=args.parameters,
+                  accept_msgpack=not args.json_only).start()
+    consul = ConsulStub()
+    fleet.register(consul)
+    if args.registry_file:
+        write_registry(args.registry_file, fleet.registry())
+    server = WSGIServer(listener('127.0.0.1', args.consul_port), consul, log=None)
+    server.start()
+    sys.stdout.write('CONSUL 127.0.0.1:%d\n' % server.server_port)
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Load generator for the instrument agent.
+
+Starts a simulated fleet and Consul stand-in, serves the agent against them and drives a weighted
+mix of read endpoints from concurrent greenlets, reporting throughput and p50/p99 latency:
+
+    python -m ooi_instrument_agent.bench.load --drivers 500 --latency 0.01 --concurrency 50 --duration 30
+
+Use --agent-url to drive an already running agent instead, or --registry-file to have the agent
+discover the fleet from a registry file rather than Consul. --driver-codec msgpack has the agent
+negotiate msgpack with the drivers, add --json-only-drivers to measure the JSON fallback. With
+--baseline, exits non-zero if any endpoint regressed by more than --tolerance against a previous --output.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import gevent
+import requests
+
+from ooi_instrument_agent.common import REGISTRY_FILE_ENV_KEY, DRIVER_CODEC_ENV_KEY
+
+# name -> (path, weight)
+DEFAULT_MIX = OrderedDict([
+    ('list', ('/instrument/api', 5)),
+    ('status', ('/instrument/api/status', 1)),
+    ('driver', ('/instrument/api/{refdes}', 4)),
+    ('state', ('/instrument/api/{refdes}/state', 10)),
+    ('resource', ('/instrument/api/{refdes}/resource', 4)),
+    ('ping', ('/instrument/api/{refdes}/ping', 2)),
+])
+
+
+def parse_mix(text):
+    """
+    Parse "state=10,status=1" into a mix using the paths of DEFAULT_MIX
+    """
+    mix = OrderedDict()
+    for item in text.split(','):
+        name, weight = item.split('=')
+        mix[name] = (DEFAULT_MIX[name][0], int(weight))
+    return mix
+
+
+def percentile(values, q):
+    """
+    :param values: Sorted list of values
+    :param q: Percentile in [0, 1]
+    """
+    if not values:
+        return None
+    return values[int(round(q * (len(values) - 1)))]
+
+
+def run_load(base_url, refdes, concurrency=10, duration=10, mix=None, timeout=120):
+    """
+    Drive the agent for duration seconds from concurrency greenlets
+    :return: name -> {'latencies': [...], 'errors': n, 'bytes': n}
+    """
+    mix = mix or DEFAULT_MIX
+    choices = [name for name, (_, weight) in mix.items() for _ in range(weight)]
+    results = OrderedDict((name, {'latencies': [], 'errors': 0, 'bytes': 0}) for name in mix)
+    deadline = time.time() + duration
+
+    def worker():
+        session = requests.Session()
+        while time.time() < deadline:
+            name = random.choice(choices)
+            url = base_url + mix[name][0].format(refdes=random.choice(refdes))
+            result = results[name]
+            start = time.time()
+            try:
+                response = session.get(url, timeout=timeout)
+            except requests.RequestException:
+                result['errors'] += 1
+                continue
+            if response.status_code >= 400:
+                result['errors'] += 1
+                continue
+            result['latencies'].append(time.time() - start)
+            result['bytes'] += len(response.content)
+
+    gevent.joinall([gevent.spawn(worker) for _ in range(concurrency)])
+    return results
+
+
+def summarize(results, duration):
+    summary = OrderedDict()
+    for name, result in results.items():
+        latencies = sorted(result['latencies'])
+        count = len(latencies)
+        summary[name] = {
+            'count': count,
+            'errors': result['errors'],
+            'throughput': count / float(duration),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'mean_bytes': result['bytes'] / count if count else 0,
+        }
+    return summary
+
+
+def format_summary(summary):
+    width = max([10] + [len(name) for name in summary])
+    lines = ['%-*s %8s %7s %10s %10s %10s %11s' % (width, 'endpoint', 'count', 'errors', 'req/s', 'p50 ms', 'p99 ms',
+                                                   'mean bytes')]
+    for name, row in summary.items():
+        p50 = '%.1f' % (row['p50'] * 1000) if row['p50'] is not None else '-'
+        p99 = '%.1f' % (row['p99'] * 1000) if row['p99'] is not None else '-'
+        lines.append('%-*s %8d %7d %10.1f %10s %10s %11d' % (width, name, row['count'], row['errors'],
+                                                            row['throughput'], p50, p99, row['mean_bytes']))
+    return '\n'.join(lines)
+
+
+def compare(summary, baseline, tolerance=0.2):
+    """
+    :return: List of human readable regressions of summary against baseline
+    """
+    regressions = []
+    for name, row in summary.items():
+        base = baseline.get(name)
+        if not base or not base.get('count'):
+            continue
+        if row['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('%s throughput %.1f < %.1f req/s' % (name, row['throughput'], base['throughput']))
+        if row['p99'] is not None and base['p99'] is not None and row['p99'] > base['p99'] * (1 + tolerance):
+            regressions.append('%s p99 %.1f > %.1f ms' % (name, row['p99'] * 1000, base['p99'] * 1000))
+    return regressions
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        gevent.sleep(0.1)
+    raise RuntimeError('Agent at %s did not become ready' % url)
+
+
+def start_environment(args, refdes_file=None, env=None):
+    """
+    Start the simulated fleet and an agent pointed at it
+    :param refdes_file: File listing the reference designators the fleet should simulate
+    :param env: Additional environment for the agent
+    :return: (agent base url, [processes])
+    """
+    command = [sys.executable, '-m', 'ooi_instrument_agent.bench.fleet',
+               '--drivers', str(args.drivers), '--latency', str(args.latency),
+               '--jitter', str(args.jitter), '--timeout-rate', str(args.timeout_rate)]
+    if refdes_file:
+        command.extend(['--refdes-file', refdes_file])
+    env = dict(env or {})
+    if getattr(args, 'registry_file', None):
+        # the agent finds drivers in the file, the Consul stand-in only holds locks
+        command.extend(['--registry-file', args.registry_file])
+        env[REGISTRY_FILE_ENV_KEY] = args.registry_file
+    if getattr(args, 'driver_codec', None):
+        env[DRIVER_CODEC_ENV_KEY] = args.driver_codec
+    if getattr(args, 'json_only_drivers', False):
+        command.append('--json-only')
+    fleet = subprocess.Popen(command, stdout=subprocess.PIPE)
+    line = fleet.stdout.readline()
+    if not line.startswith('CONSUL '):
+        fleet.terminate()
+        raise RuntimeError('Fleet failed to start')
+
+    port = free_port()
+    env = dict(os.environ, CONSUL_HTTP_ADDR=line.split()[1], **env)
+    agent = subprocess.Popen([sys.executable, '-m', 'ooi_instrument_agent.bench.serve', '--port', str(port)],
+                             env=env)
+    base_url = 'http://127.0.0.1:%d' % port
+    try:
+        wait_ready(base_url + '/instrument/api')
+    except RuntimeError:
+        fleet.terminate()
+        agent.terminate()
+        raise
+    return base_url, [fleet, agent]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the instrument agent')
+    parser.add_argument('--agent-url', help='benchmark an already running agent')
+    parser.add_argument('--drivers', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='e.g. state=10,status=1')
+    parser.add_argument('--output', help='write the summary as JSON')
+    parser.add_argument('--baseline', help='compare against a previous JSON summary')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--registry-file', help='discover drivers from this registry file rather than Consul')
+    parser.add_argument('--driver-codec', choices=['json', 'msgpack'], help='wire encoding the agent offers drivers')
+    parser.add_argument('--json-only-drivers', action='store_true', help='simulate drivers without msgpack support')
+    args = parser.parse_args(argv)
+
+    processes = []
+    try:
+        if args.agent_url:
+            base_url = args.agent_url.rstrip('/')
+        else:
+            base_url, processes = start_environment(args)
+
+        refdes = requests.get(base_url + '/instrument/api').json()
+        results = run_load(base_url, refdes, args.concurrency, args.duration, args.mix)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    summary = summarize(results, args.duration)
+    print(format_summary(summary))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(summary, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(summary, json.load(fh), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Replay a recorded agent trace (see ooi_instrument_agent.trace) for load testing.
+
+Starts a simulated fleet with the reference designators found in the trace, serves the agent
+against it and reissues every recorded HTTP request, preserving the recorded inter-arrival times
+scaled by --speed (0 replays as fast as --concurrency allows):
+
+    python -m ooi_instrument_agent.bench.replay /var/log/agent/trace.jsonl --speed 10
+
+Unless --latency is given, the fleet answers with the median latency of the recorded driver RPCs.
+Reports throughput and p50/p99 latency per endpoint, next to the same figures from the trace.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import gevent
+import requests
+from gevent.pool import Pool
+
+from ooi_instrument_agent.bench.load import summarize, format_summary, percentile, start_environment
+from ooi_instrument_agent.common import TRACE_FILE_ENV_KEY
+from ooi_instrument_agent.trace import read_trace, HTTP, RPC
+
+
+def trace_refdes(records):
+    """
+    :return: Sorted reference designators appearing in the trace
+    """
+    return sorted(set(record[2] for record in records if record[2]))
+
+
+def rpc_latency(records):
+    """
+    :return: Median latency of the answered driver RPCs in the trace, or None
+    """
+    latencies = sorted(record[6] for record in records if record[0] == RPC and record[7] is not None)
+    return percentile(latencies, 0.5)
+
+
+def recorded_results(records):
+    """
+    Collect the recorded HTTP latencies in the form returned by replay
+    """
+    results = OrderedDict()
+    for record in records:
+        if record[0] != HTTP:
+            continue
+        result = results.setdefault(record[3], {'latencies': [], 'errors': 0, 'bytes': 0})
+        if record[9] >= 400:
+            result['errors'] += 1
+            continue
+        result['latencies'].append(record[7])
+        result['bytes'] += record[8] or 0
+    return results
+
+
+def replay(base_url, records, speed=1.0, concurrency=100, timeout=120):
+    """
+    Reissue the HTTP records against the agent at base_url
+    :param speed: Multiple of the recorded rate, 0 for as fast as possible
+    :param concurrency: Maximum number of outstanding requests
+    :return: (endpoint -> {'latencies': [...], 'errors': n, 'bytes': n}, elapsed seconds, max lag seconds)
+    """
+    records = [record for record in records if record[0] == HTTP]
+    results = OrderedDict()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    pool = Pool(concurrency)
+    lag = [0]
+
+    def issue(record):
+        _, _, _, endpoint, method, path, body, _, _, recorded_status = record
+        result = results.setdefault(endpoint, {'latencies': [], 'errors': 0, 'bytes': 0})
+        kwargs = {}
+        if body:
+            kwargs['json' if body[0] == 'json' else 'data'] = body[1]
+        start = time.time()
+        try:
+            response = session.request(method, base_url + path.rstrip('?'), timeout=timeout, **kwargs)
+        except requests.RequestException:
+            result['errors'] += 1
+            return
+        # only count errors the recorded request did not also see
+        if response.status_code >= 400 and recorded_status < 400:
+            result['errors'] += 1
+            return
+        result['latencies'].append(time.time() - start)
+        result['bytes'] += len(response.content)
+
+    started = time.time()
+    if records:
+        origin = records[0][1]
+        for record in records:
+            if speed:
+                due = started + (record[1] - origin) / speed
+                delay = due - time.time()
+                if delay > 0:
+                    gevent.sleep(delay)
+                else:
+                    lag[0] = max(lag[0], -delay)
+            pool.spawn(issue, record)
+        pool.join()
+    return results, time.time() - started, lag[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a recorded agent trace')
+    parser.add_argument('trace', help='AGENT_TRACE_FILE the trace was written with, covering every process')
+    parser.add_argument('--agent-url', help='replay against an already running agent')
+    parser.add_argument('--speed', type=float, default=1.0, help='multiple of recorded rate, 0 for maximum')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--latency', type=float, help='driver response delay, default from the trace')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    records = read_trace(args.trace)
+    if not any(record[0] == HTTP for record in records):
+        print('No HTTP requests in %s' % args.trace)
+        return 1
+
+    processes = []
+    refdes_file = None
+    try:
+        if args.agent_url:
+            base_url = args.agent_url.rstrip('/')
+        else:
+            if args.latency is None:
+                args.latency = rpc_latency(records) or 0.0
+            args.drivers = 0
+            fd, refdes_file = tempfile.mkstemp(suffix='.refdes')
+            with os.fdopen(fd, 'w') as fh:
+                fh.write('\n'.join(trace_refdes(records)) + '\n')
+            base_url, processes = start_environment(args, refdes_file=refdes_file,
+                                                    env={TRACE_FILE_ENV_KEY: ''})
+        results, elapsed, lag = replay(base_url, records, args.speed, args.concurrency)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if refdes_file:
+            os.remove(refdes_file)
+
+    http_records = [record for record in records if record[0] == HTTP]
+    span = max(http_records[-1][1] - http_records[0][1], 1e-6)
+    print('Replayed %d requests in %.1fs (recorded over %.1fs, max schedule lag %.3fs)'
+          % (len(http_records), elapsed, span, lag))
+    print(format_summary(summarize(results, elapsed)))
+    print('\nRecorded:')
+    print(format_summary(summarize(recorded_results(records), span)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Serve the agent with gevent.pywsgi for benchmarking.
+
+    CONSUL_HTTP_ADDR=127.0.0.1:8500 python -m ooi_instrument_agent.bench.serve --port 12572
+"""
+import argparse
+
+from gevent.pywsgi import WSGIServer, WSGIHandler
+
+from ooi_instrument_agent import app
+from ooi_instrument_agent.bench import listener
+from ooi_instrument_agent.views import initialize_worker
+
+
+class SocketHandler(WSGIHandler):
+    """
+    Exposes the client connection as gunicorn's gevent worker does, so disconnects can be detected
+    """
+    def get_environ(self):
+        environ = WSGIHandler.get_environ(self)
+        environ['gunicorn.sock'] = self.socket
+        return environ
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the instrument agent for benchmarking')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12572)
+    parser.add_argument('--cold', action='store_true', help='skip warming connections before serving')
+    args = parser.parse_args(argv)
+    initialize_worker(warm=not args.cold)
+    WSGIServer(listener(args.host, args.port), app, log=None, handler_class=SocketHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
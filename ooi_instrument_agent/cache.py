@@ -0,0 +1,142 @@
+import json
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+from gevent.event import AsyncResult
+
+from ooi_instrument_agent.client import RequestCancelled
+from ooi_instrument_agent.common import (get_env_number, CACHE_ENTRIES_ENV_KEY, DEFAULT_CACHE_ENTRIES,
+                                         CACHE_MAX_AGE_ENV_KEY, DEFAULT_CACHE_MAX_AGE)
+from ooi_instrument_agent.metrics import CACHE_REQUESTS
+
+log = getLogger(__name__)
+
+
+class FetchAbandoned(Exception):
+    """
+    The fetch a reader was waiting on was cancelled with its request, the reader fetches for itself
+    """
+
+
+class DriverCache(object):
+    """
+    Staleness bounded read-through cache of driver replies.
+
+    Entries are keyed by reference designator, command and arguments and evicted least recently
+    used beyond max_entries. A reader states how old a reply it will accept; concurrent readers
+    of the same missing entry share a single fetch. Invalidating a driver drops its entries, and
+    a fetch which was already running when the driver was invalidated is not stored.
+
+    Each worker process has its own entries. Given an enabled SharedCache, invalidating a driver
+    also records the time in the shared directory, and every worker drops replies fetched before
+    the latest invalidation of their driver, whichever worker proxied the write.
+
+    :param shared: SharedCache recording invalidations for all workers, None for this process only
+    """
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, default_max_age=DEFAULT_CACHE_MAX_AGE, shared=None):
+        self.max_entries = max_entries
+        self.default_max_age = default_max_age
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.generations = {}
+
+    @classmethod
+    def from_environ(cls, shared=None):
+        return cls(max_entries=get_env_number(CACHE_ENTRIES_ENV_KEY, DEFAULT_CACHE_ENTRIES),
+                   default_max_age=get_env_number(CACHE_MAX_AGE_ENV_KEY, DEFAULT_CACHE_MAX_AGE, float),
+                   shared=shared)
+
+    @staticmethod
+    def make_key(refdes, command, args):
+        return refdes, command, json.dumps(args, sort_keys=True)
+
+    def get(self, refdes, command, args, fetch, max_age=None):
+        """
+        :param fetch: Function returning a fresh reply
+        :param max_age: Oldest acceptable reply in seconds, 0 to always fetch
+        :return: A reply no older than max_age
+        """
+        if max_age is None:
+            max_age = self.default_max_age
+        key = self.make_key(refdes, command, args)
+
+        if max_age > 0:
+            entry = self.entries.get(key)
+            if (entry is not None and time.time() - entry[0] <= max_age and
+                    entry[0] > self.invalidated(refdes)):
+                # mark as most recently used
+                del self.entries[key]
+                self.entries[key] = entry
+                CACHE_REQUESTS.inc(command=command, result='hit')
+                return entry[1]
+
+            pending = self.pending.get(key)
+            if pending is not None:
+                CACHE_REQUESTS.inc(command=command, result='coalesced')
+                try:
+                    return pending.get()
+                except FetchAbandoned:
+                    pass
+
+        CACHE_REQUESTS.inc(command=command, result='miss')
+        return self._fetch(key, refdes, fetch)
+
+    def _fetch(self, key, refdes, fetch):
+        generation = self.generations.get(refdes, 0)
+        started = time.time()
+        result = self.pending[key] = AsyncResult()
+        try:
+            value = fetch()
+        except RequestCancelled:
+            result.set_exception(FetchAbandoned())
+            raise
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        except BaseException:
+            # the fetching greenlet was killed
+            result.set_exception(FetchAbandoned())
+            raise
+        else:
+            result.set(value)
+            if self.generations.get(refdes, 0) == generation and started > self.invalidated(refdes):
+                self._store(key, (started, value))
+            return value
+        finally:
+            if self.pending.get(key) is result:
+                del self.pending[key]
+
+    def _store(self, key, entry):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, refdes):
+        """
+        Drop every reply cached for refdes, and any being fetched, in every worker
+        """
+        if self.shared is not None:
+            self.shared.invalidate(self.shared_name(refdes))
+        self.generations[refdes] = self.generations.get(refdes, 0) + 1
+        for key in [key for key in self.entries if key[0] == refdes]:
+            del self.entries[key]
+        for key in [key for key in self.pending if key[0] == refdes]:
+            del self.pending[key]
+
+    def invalidated(self, refdes):
+        """
+        :return: Time any worker last invalidated refdes, 0 if never or not shared
+        """
+        if self.shared is None or not self.shared.enabled:
+            return 0
+        return self.shared.invalidated(self.shared_name(refdes))
+
+    @staticmethod
+    def shared_name(refdes):
+        return 'driver-%s' % refdes
+
+    def __len__(self):
+        return len(self.entries)
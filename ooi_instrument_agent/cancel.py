@@ -0,0 +1,111 @@
+import select
+import socket
+import time
+from logging import getLogger
+
+import gevent
+from gevent import monkey
+
+from ooi_instrument_agent.client import RequestCancelled
+from ooi_instrument_agent.metrics import REQUESTS_CANCELLED
+
+log = getLogger(__name__)
+
+# WSGI environ keys under which gunicorn's gevent workers expose the client connection
+SOCKET_ENVIRON_KEYS = ('gunicorn.socket', 'gunicorn.sock')
+
+# gevent's cooperative poll reports readiness only, not hangups
+_poll = monkey.get_original('select', 'poll')
+
+
+def client_socket(environ):
+    for key in SOCKET_ENVIRON_KEYS:
+        sock = environ.get(key)
+        if sock is not None:
+            return sock
+
+
+def disconnected(sock):
+    """
+    :return: True if the connection has been reset or hung up. End of stream alone is not a
+             disconnect, a client may shut down its side for writing and still await the reply.
+    """
+    try:
+        poll = _poll()
+        poll.register(sock, select.POLLIN | select.POLLHUP | select.POLLERR)
+        events = dict(poll.poll(0)).get(sock.fileno(), 0)
+        if events & (select.POLLHUP | select.POLLERR):
+            return True
+        if events & select.POLLIN:
+            # raises if the connection was reset
+            sock.recv(1, socket.MSG_PEEK)
+        return False
+    except (socket.error, select.error, ValueError):
+        return True
+
+
+class RequestWatch(object):
+    """
+    Cancels the greenlet serving a request once its client disconnects or its deadline passes, by
+    raising RequestCancelled wherever it is waiting. A driver RPC it was waiting on is abandoned
+    and its socket discarded; fan-outs are expected to kill their own greenlets on the way out.
+
+    :param sock: Client connection, None if unavailable
+    :param deadline: Timestamp by which the request must complete, None for no deadline
+    :param interval: Seconds between checks of the connection
+    """
+    def __init__(self, greenlet, endpoint=None, sock=None, deadline=None, interval=0.5):
+        self.greenlet = greenlet
+        self.endpoint = endpoint
+        self.sock = sock
+        self.deadline = deadline
+        self.interval = interval
+        self.watcher = None
+        self.cancelled = None
+        self.stopped = False
+        self.throw = None
+
+    def start(self):
+        if self.sock is None and self.deadline is None:
+            return self
+        self.watcher = gevent.spawn(self.run)
+        return self
+
+    def stop(self):
+        """
+        Stop watching. Called from the request greenlet, so a cancellation which fired but has
+        not yet been raised there is still scheduled on the hub, and is withdrawn.
+        """
+        self.stopped = True
+        if self.watcher is not None:
+            self.watcher.kill(block=False)
+            self.watcher = None
+        if self.throw is not None:
+            self.throw.stop()
+            self.throw = None
+
+    def run(self):
+        while True:
+            now = time.time()
+            if self.deadline is not None and now >= self.deadline:
+                return self.cancel('deadline')
+            if self.sock is not None and disconnected(self.sock):
+                return self.cancel('disconnected')
+            wait = self.interval
+            if self.deadline is not None:
+                wait = min(wait, self.deadline - now)
+            gevent.sleep(wait)
+
+    def cancel(self, reason):
+        self.cancelled = reason
+        self.watcher = None
+        # as gevent.kill does, but keeping the callback so that stop can withdraw it
+        self.throw = gevent.get_hub().loop.run_callback(self._throw, reason)
+
+    def _throw(self, reason):
+        self.throw = None
+        if self.stopped or self.greenlet.dead:
+            return
+        REQUESTS_CANCELLED.inc(endpoint=self.endpoint, reason=reason)
+        log.info('Cancelling %s: %s', self.endpoint, reason)
+        self.greenlet.throw(RequestCancelled({'cancelled': reason}))
@@ -1,12 +1,45 @@
+import json
 import logging
+import os
+import time
 
 import six
 import zmq.green as zmq
+from gevent import GreenletExit
+
+from ooi_instrument_agent import trace
+from ooi_instrument_agent.common import DRIVER_CODEC_ENV_KEY, DEFAULT_DRIVER_CODEC
+from ooi_instrument_agent.metrics import (timed, ZMQ_LATENCY, ZMQ_IN_FLIGHT, ZMQ_TIMEOUTS, ZMQ_CANCELLED,
+                                          ZMQ_WAIT_RECOVERED)
+
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 log = logging.getLogger(__name__)
-context = zmq.Context()
 DEFAULT_TIMEOUT = 60
+MAX_IDLE_SOCKETS = 4
+MAX_SOCKET_IDLE_TIME = 300
+# seconds before a driver which answered in JSON is offered msgpack again
+CODEC_PROBE_INTERVAL = 600
+
+_context = None
+_context_pid = None
+
+
+def get_context():
+    """
+    Return the process's ZMQ context, creating it on first use.
+    A context must not be shared across fork, so a forked worker gets its own.
+    """
+    global _context, _context_pid
+    if _context is None or _context_pid != os.getpid():
+        _context = zmq.Context()
+        _context_pid = os.getpid()
+    return _context
 
 
 class TimeoutException(Exception):
@@ -25,20 +58,175 @@ class ParameterException(Exception):
         self.message = message
 
 
+class DriverUnresponsive(Exception):
+    status_code = 503
+
+    def __init__(self, message=None):
+        Exception.__init__(self)
+        self.message = message
+
+
+class RequestCancelled(Exception):
+    """
+    Raised in the greenlet serving a request whose client disconnected or whose deadline passed
+    """
+    status_code = 504
+
+    def __init__(self, message=None):
+        Exception.__init__(self)
+        self.message = message
+
+
+class SocketPool(object):
+    """
+    Pool of connected ZMQ REQ sockets, keyed by driver host and port.
+
+    A REQ socket can be reused once its last request has been answered; sockets whose
+    request timed out or failed must be discarded instead of released.
+    """
+    def __init__(self, max_idle=MAX_IDLE_SOCKETS, max_idle_time=MAX_SOCKET_IDLE_TIME):
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self.idle = {}
+
+    def acquire(self, host, port):
+        """
+        :return: A connected REQ socket for host and port, reused if one is idle
+        """
+        idle = self.idle.get((host, port))
+        now = time.time()
+        while idle:
+            socket, released = idle.pop()
+            if now - released < self.max_idle_time:
+                return socket
+            socket.close(linger=0)
+        log.debug('Connecting ZMQ socket: %s:%s', host, port)
+        socket = get_context().socket(zmq.REQ)
+        socket.connect('tcp://{host}:{port}'.format(host=host, port=port))
+        return socket
+
+    def release(self, host, port, socket):
+        idle = self.idle.setdefault((host, port), [])
+        if len(idle) < self.max_idle:
+            idle.append((socket, time.time()))
+        else:
+            socket.close(linger=0)
+
+    def prewarm(self, host, port):
+        """
+        Open an idle connection to host and port if none is pooled
+        """
+        if not self.idle.get((host, port)):
+            self.release(host, port, self.acquire(host, port))
+
+    def __len__(self):
+        return sum(len(idle) for idle in self.idle.values())
+
+    def close(self):
+        for idle in self.idle.values():
+            for socket, _ in idle:
+                socket.close(linger=0)
+        self.idle.clear()
+
+
+socket_pool = SocketPool()
+
+
+def msgpack_is_compiled():
+    """
+    The pure Python fallback is far slower than the json module, so only the C extension is worth negotiating
+    """
+    return msgpack is not None and msgpack.Packer.__module__ != 'msgpack.fallback'
+
+
+def msgpack_dumps(obj):
+    # str as msgpack raw strings, which decode to unicode as json.loads does
+    return msgpack.packb(obj, use_bin_type=False)
+
+
+def msgpack_loads(raw):
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+def is_msgpack(raw):
+    """
+    Messages are always maps: msgpack maps start with a byte >= 0x80, JSON objects with '{' or whitespace
+    """
+    return raw[:1] >= b'\x80'
+
+
+class DriverCodecs(object):
+    """
+    Wire encoding negotiated with each driver, keyed by host and port.
+
+    With msgpack preferred, a driver not known to support it is sent JSON requests carrying
+    'accept': ['msgpack']. A driver which supports msgpack replies in msgpack and is sent msgpack from
+    then on; one which replies in JSON keeps being sent plain JSON, and is offered msgpack again
+    after probe_interval seconds in case it has been upgraded. A driver which stops answering
+    msgpack requests (e.g. restarted as an older version) is forgotten and renegotiated.
+    """
+    def __init__(self, preferred=DEFAULT_DRIVER_CODEC, probe_interval=CODEC_PROBE_INTERVAL):
+        if preferred not in ('json', 'msgpack'):
+            log.warn('Unknown driver codec %r, using json', preferred)
+            preferred = 'json'
+        if preferred == 'msgpack' and not msgpack_is_compiled():
+            log.warn('Driver codec msgpack is not installed with its C extension, using json')
+            preferred = 'json'
+        self.preferred = preferred
+        self.probe_interval = probe_interval
+        self.drivers = {}
+
+    @classmethod
+    def from_environ(cls):
+        return cls(os.environ.get(DRIVER_CODEC_ENV_KEY, DEFAULT_DRIVER_CODEC))
+
+    def choose(self, host, port):
+        """
+        :return: (codec to encode the request with, True to offer the preferred codec)
+        """
+        if self.preferred == 'json':
+            return 'json', False
+        entry = self.drivers.get((host, port))
+        if entry is None:
+            return 'json', True
+        codec, recorded = entry
+        if codec == 'json' and time.time() - recorded >= self.probe_interval:
+            return 'json', True
+        return codec, False
+
+    def record(self, host, port, codec):
+        self.drivers[(host, port)] = codec, time.time()
+
+    def forget(self, host, port):
+        self.drivers.pop((host, port), None)
+
+
+driver_codecs = DriverCodecs.from_environ()
+
+
 class ZmqDriverClient(object):
     """
     A class for performing RPC with a ZMQ-based driver process
 
     Utilizes zmq.green to provide a gevent-compatible version of zmq
     """
-    def __init__(self, host, port):
+    def __init__(self, host, port, refdes=None, pool=None, codecs=None):
         """
         :param host: Hostname or IP of the target driver
         :param port: Port number of the target driver
+        :param refdes: Reference designator of the target driver, used when tracing
+        :param pool: SocketPool to borrow the connection from, otherwise a socket is created and closed
+        :param codecs: DriverCodecs to negotiate the wire encoding with, the process's by default
         """
         self.host = host
         self.port = port
+        self.refdes = refdes
+        self.pool = pool
+        self.codecs = codecs if codecs is not None else driver_codecs
         self._socket = None
+        self._reusable = True
+        self._state = None
+        self._values_stale = False
         log.debug('Start %r', self)
 
     def _connect(self):
@@ -47,10 +235,14 @@ class ZmqDriverClient(object):
         """
         if self._socket is None:
             log.debug('Connecting ZMQ client: %r', self)
-            socket = context.socket(zmq.REQ)
-            socket.connect('tcp://{host}:{port}'.format(host=self.host, port=self.port))
+            if self.pool is not None:
+                socket = self.pool.acquire(self.host, self.port)
+            else:
+                socket = get_context().socket(zmq.REQ)
+                socket.connect('tcp://{host}:{port}'.format(host=self.host, port=self.port))
             log.debug('Connected: %r', self)
             self._socket = socket
+            self._reusable = True
         return self._socket
 
     def _command(self, command, *args, **kwargs):
@@ -66,11 +258,39 @@ class ZmqDriverClient(object):
         timeout = kwargs.pop('timeout', None)
         timeout = timeout if timeout is not None else 1000
         msg = {'cmd': command, 'args': args, 'kwargs': kwargs}
-        socket.send_json(msg)
-        events = socket.poll(timeout=timeout)
-        if events:
-            response = socket.recv_json()
-            return response
+        codec, offer = self.codecs.choose(self.host, self.port)
+        if offer:
+            msg['accept'] = [self.codecs.preferred]
+        start = time.time()
+        # until a reply is received the REQ socket cannot be used for another request
+        self._reusable = False
+        with ZMQ_IN_FLIGHT.track(command=command), timed(ZMQ_LATENCY, 'zmq', command=command):
+            if codec == 'msgpack':
+                socket.send(msgpack_dumps(msg))
+            else:
+                socket.send_json(msg)
+            try:
+                events = socket.poll(timeout=timeout)
+            except (GreenletExit, RequestCancelled):
+                # abandoned by the request, the socket is discarded rather than reused
+                ZMQ_CANCELLED.inc(command=command)
+                ZMQ_WAIT_RECOVERED.inc(max(start + timeout / 1000.0 - time.time(), 0), command=command)
+                raise
+            if events:
+                raw = socket.recv()
+                self._reusable = True
+                trace.recorder.record_rpc(self.refdes, command, args, kwargs, time.time() - start, len(raw))
+                if is_msgpack(raw):
+                    if offer:
+                        self.codecs.record(self.host, self.port, 'msgpack')
+                    return msgpack_loads(raw)
+                if offer:
+                    self.codecs.record(self.host, self.port, 'json')
+                return json.loads(raw)
+        if codec != 'json':
+            self.codecs.forget(self.host, self.port)
+        ZMQ_TIMEOUTS.inc(command=command)
+        trace.recorder.record_rpc(self.refdes, command, args, kwargs, time.time() - start, None)
         raise TimeoutException({'timeout': 'no response in timeout interval %d' % timeout})
 
     def __enter__(self):
@@ -79,7 +299,10 @@ class ZmqDriverClient(object):
 
     def __exit__(self, *args, **kwargs):
         if self._socket is not None:
-            self._socket.close()
+            if self.pool is not None and self._reusable:
+                self.pool.release(self.host, self.port, self._socket)
+            else:
+                self._socket.close(linger=0)
             self._socket = None
 
     def ping(self, *args, **kwargs):
@@ -88,9 +311,9 @@ class ZmqDriverClient(object):
     def execute(self, command, *args, **kwargs):
         timeout = kwargs.pop('timeout', None)
         if timeout is None:
-            state = self.get_state()
-            timeout = _get_timeout(command, state)
+            timeout = _get_timeout(command, self._metadata_state())
         kwargs['timeout'] = timeout
+        self._values_stale = True
         return self._command('execute_resource', command, *args, **kwargs)
 
     def init_params(self, *args, **kwargs):
@@ -109,7 +332,13 @@ class ZmqDriverClient(object):
         return self._command('get_resource', *args, **kwargs)
 
     def set_resource(self, resource, *args, **kwargs):
-        state = self.get_state()
+        """
+        :param skip_unchanged: Only send parameters whose value differs from the driver's current
+                               value, returning without contacting the instrument if none do.
+                               The names of the parameters left out are returned under 'skipped'.
+        """
+        skip_unchanged = kwargs.pop('skip_unchanged', False)
+        state = self._metadata_state()
         parameter_metadata = _get_parameters(state)
 
         timeout = kwargs.pop('timeout')
@@ -118,8 +347,45 @@ class ZmqDriverClient(object):
         kwargs['timeout'] = timeout
 
         resource = _validate_parameters(parameter_metadata, resource)
+        if not skip_unchanged:
+            self._values_stale = True
+            return self._command('set_resource', resource, *args, **kwargs)
+
+        current = self._current_values(state, list(resource))
+        changed = dict((name, value) for name, value in six.iteritems(resource)
+                       if name not in current or current[name] != value)
+        skipped = sorted(set(resource) - set(changed))
+        if not changed:
+            log.debug('%r set_resource: all parameters unchanged %r', self, skipped)
+            return {'cmd': {'cmd': 'set_resource', 'args': [resource], 'kwargs': {}},
+                    'type': 'DRIVER_ASYNC_RESULT', 'time': time.time(), 'value': current, 'skipped': skipped}
+
+        self._values_stale = True
+        response = self._command('set_resource', changed, *args, **kwargs)
+        if isinstance(response, dict):
+            response['skipped'] = skipped
+        return response
+
+    def _metadata_state(self):
+        """
+        The overall state consulted for command timeouts and parameter metadata, fetched once
+        per client so a sequence of commands on one connection pays for it only once
+        """
+        if self._state is None:
+            self._state = self.get_state()
+        return self._state
 
-        return self._command('set_resource', resource, *args, **kwargs)
+    def _current_values(self, state_response, names):
+        """
+        Last known values of the named parameters, from the overall state if it carries
+        them and no command has been sent since, otherwise from the driver
+        """
+        values = None if self._values_stale else state_response.get('value', {}).get('parameters')
+        if not isinstance(values, dict) or not all(name in values for name in names):
+            values = self.get_resource(names).get('value')
+        if not isinstance(values, dict):
+            return {}
+        return dict((name, values[name]) for name in names if name in values)
 
     def discover(self, *args, **kwargs):
         return self.execute('DRIVER_EVENT_DISCOVER', *args, **kwargs)
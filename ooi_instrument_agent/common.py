@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 import datetime
@@ -6,9 +7,187 @@ from six import wraps
 SOCK_ENV_KEY = 'SNIFF_UNIX_SOCKFILE'
 DEFAULT_SOCKFILE = '/tmp/sniff.sock'
 
+SHARDS_ENV_KEY = 'SNIFF_SHARDS'
+SHARD_INDEX_ENV_KEY = 'SNIFF_SHARD_INDEX'
 
-def get_sniffer_socket():
-    return os.environ.get(SOCK_ENV_KEY, DEFAULT_SOCKFILE)
+MAX_IDLE_ENV_KEY = 'SNIFF_MAX_IDLE'
+DEFAULT_MAX_IDLE = 60
+
+REAP_INTERVAL_ENV_KEY = 'SNIFF_REAP_INTERVAL'
+DEFAULT_REAP_INTERVAL = 10
+
+MAX_BYTES_ENV_KEY = 'SNIFF_MAX_BYTES'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+RECORD_DIR_ENV_KEY = 'SNIFF_RECORD_DIR'
+RECORD_ENV_KEY = 'SNIFF_RECORD'
+RECORD_MAX_BYTES_ENV_KEY = 'SNIFF_RECORD_MAX_BYTES'
+DEFAULT_RECORD_MAX_BYTES = 10 * 1024 * 1024 * 1024
+RECORD_MAX_AGE_ENV_KEY = 'SNIFF_RECORD_MAX_AGE'
+DEFAULT_RECORD_MAX_AGE = 7 * 24 * 3600
+
+METRICS_DIR_ENV_KEY = 'AGENT_METRICS_DIR'
+
+PROFILE_TOKEN_ENV_KEY = 'AGENT_PROFILE_TOKEN'
+PROFILE_SAMPLE_ENV_KEY = 'AGENT_PROFILE_SAMPLE'
+PROFILE_DIR_ENV_KEY = 'AGENT_PROFILE_DIR'
+PROFILE_KEEP_ENV_KEY = 'AGENT_PROFILE_KEEP'
+DEFAULT_PROFILE_KEEP = 100
+
+JSON_ENCODER_ENV_KEY = 'AGENT_JSON_ENCODER'
+DEFAULT_JSON_ENCODER = 'json'
+COMPRESS_LEVEL_ENV_KEY = 'AGENT_COMPRESS_LEVEL'
+# compression runs on the gevent loop, level 1 is ~4x faster than 6 for ~20% more bytes
+DEFAULT_COMPRESS_LEVEL = 1
+COMPRESS_MIN_SIZE_ENV_KEY = 'AGENT_COMPRESS_MIN_SIZE'
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+
+DRIVER_CODEC_ENV_KEY = 'AGENT_DRIVER_CODEC'
+# msgpack is only offered to drivers when enabled, JSON-only drivers ignore the offer
+DEFAULT_DRIVER_CODEC = 'json'
+
+CACHE_ENTRIES_ENV_KEY = 'AGENT_CACHE_ENTRIES'
+DEFAULT_CACHE_ENTRIES = 5000
+CACHE_MAX_AGE_ENV_KEY = 'AGENT_CACHE_MAX_AGE'
+DEFAULT_CACHE_MAX_AGE = 0
+
+HEARTBEAT_INTERVAL_ENV_KEY = 'AGENT_HEARTBEAT_INTERVAL'
+DEFAULT_HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT_ENV_KEY = 'AGENT_HEARTBEAT_TIMEOUT'
+DEFAULT_HEARTBEAT_TIMEOUT = 1000
+HEARTBEAT_CONCURRENCY_ENV_KEY = 'AGENT_HEARTBEAT_CONCURRENCY'
+DEFAULT_HEARTBEAT_CONCURRENCY = 20
+HEARTBEAT_FAILURES_ENV_KEY = 'AGENT_HEARTBEAT_FAILURES'
+DEFAULT_HEARTBEAT_FAILURES = 2
+
+# requests per second and burst size, per worker, 0 for no limit
+CLIENT_RATE_ENV_KEY = 'AGENT_CLIENT_RATE'
+CLIENT_BURST_ENV_KEY = 'AGENT_CLIENT_BURST'
+DRIVER_RATE_ENV_KEY = 'AGENT_DRIVER_RATE'
+DRIVER_BURST_ENV_KEY = 'AGENT_DRIVER_BURST'
+DEFAULT_RATE = 0
+DEFAULT_BURST = 20
+
+# requests served at once per worker by priority class, 0 for no limit
+INTERACTIVE_CONCURRENCY_ENV_KEY = 'AGENT_INTERACTIVE_CONCURRENCY'
+DEFAULT_INTERACTIVE_CONCURRENCY = 50
+BULK_CONCURRENCY_ENV_KEY = 'AGENT_BULK_CONCURRENCY'
+DEFAULT_BULK_CONCURRENCY = 200
+QUEUE_TIMEOUT_ENV_KEY = 'AGENT_QUEUE_TIMEOUT'
+DEFAULT_QUEUE_TIMEOUT = 30
+
+# records buffered per log handler by the background writer, 0 to log synchronously
+LOG_QUEUE_SIZE_ENV_KEY = 'AGENT_LOG_QUEUE_SIZE'
+DEFAULT_LOG_QUEUE_SIZE = 10000
+# fraction of successful GETs written to the access log
+ACCESS_LOG_SAMPLE_ENV_KEY = 'AGENT_ACCESS_LOG_SAMPLE'
+DEFAULT_ACCESS_LOG_SAMPLE = 1.0
+
+# seconds the gevent hub may go without running before its stack is captured, 0 to disable
+HUB_BLOCK_THRESHOLD_ENV_KEY = 'AGENT_HUB_BLOCK_THRESHOLD'
+DEFAULT_HUB_BLOCK_THRESHOLD = 0.1
+HUB_LAG_INTERVAL_ENV_KEY = 'AGENT_HUB_LAG_INTERVAL'
+DEFAULT_HUB_LAG_INTERVAL = 0.1
+
+SHARED_DIR_ENV_KEY = 'AGENT_SHARED_DIR'
+SHARED_INTERVAL_ENV_KEY = 'AGENT_SHARED_INTERVAL'
+DEFAULT_SHARED_INTERVAL = 1
+# polling every driver's state costs instrument round trips whether or not anyone asks, so is opt in
+SHARED_STATUS_INTERVAL_ENV_KEY = 'AGENT_SHARED_STATUS_INTERVAL'
+DEFAULT_SHARED_STATUS_INTERVAL = 0
+
+ASSET_MAX_AGE_ENV_KEY = 'AGENT_ASSET_MAX_AGE'
+DEFAULT_ASSET_MAX_AGE = 24 * 3600
+
+TRACE_FILE_ENV_KEY = 'AGENT_TRACE_FILE'
+TRACE_MAX_BYTES_ENV_KEY = 'AGENT_TRACE_MAX_BYTES'
+DEFAULT_TRACE_MAX_BYTES = 64 * 1024 * 1024
+TRACE_BACKUPS_ENV_KEY = 'AGENT_TRACE_BACKUPS'
+DEFAULT_TRACE_BACKUPS = 5
+
+CONSUL_ENV_KEY = 'CONSUL_HTTP_ADDR'
+DEFAULT_CONSUL_ADDR = 'localhost:8500'
+# when set, the agent and sniffer find drivers and port agents in this file instead of Consul
+REGISTRY_FILE_ENV_KEY = 'AGENT_REGISTRY_FILE'
+
+
+def get_sniffer_socket(refdes=None):
+    """
+    Return the unix socket of the sniffer gateway.
+
+    In sharded mode (SNIFF_SHARDS > 1) each gateway process listens on its own socket. If refdes is
+    supplied, return the socket of the shard which owns it, otherwise return the socket of this
+    process's shard (SNIFF_SHARD_INDEX) or the base socket path if this is not a shard process.
+    """
+    sockfile = os.environ.get(SOCK_ENV_KEY, DEFAULT_SOCKFILE)
+    shards = get_sniffer_shards()
+    if shards == 1:
+        return sockfile
+    if refdes is not None:
+        return get_shard_socket(sockfile, get_shard(refdes, shards))
+    index = get_env_number(SHARD_INDEX_ENV_KEY, None)
+    if index is None:
+        return sockfile
+    return get_shard_socket(sockfile, index)
+
+
+def get_sniffer_sockets():
+    """
+    Return the unix sockets of all sniffer gateway shards
+    """
+    sockfile = os.environ.get(SOCK_ENV_KEY, DEFAULT_SOCKFILE)
+    shards = get_sniffer_shards()
+    if shards == 1:
+        return [sockfile]
+    return [get_shard_socket(sockfile, index) for index in range(shards)]
+
+
+def get_sniffer_shards():
+    return max(get_env_number(SHARDS_ENV_KEY, 1), 1)
+
+
+def get_shard_socket(sockfile, index):
+    return '%s.%d' % (sockfile, index)
+
+
+def get_shard(refdes, shards):
+    """
+    Assign a reference designator to one of shards buckets using jump consistent hashing
+    (Lamping & Veach), so that changing the shard count only moves the minimum number of keys
+    """
+    key = int(hashlib.md5(refdes.encode('utf-8')).hexdigest()[:16], 16)
+    b, j = -1, 0
+    while j < shards:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def get_metrics_dir():
+    return os.environ.get(METRICS_DIR_ENV_KEY)
+
+
+def get_shared_dir():
+    return os.environ.get(SHARED_DIR_ENV_KEY)
+
+
+def get_consul_address():
+    return os.environ.get(CONSUL_ENV_KEY, DEFAULT_CONSUL_ADDR)
+
+
+def get_registry_file():
+    return os.environ.get(REGISTRY_FILE_ENV_KEY)
+
+
+def get_env_number(key, default, cast=int):
+    """
+    Fetch a numeric setting from the environment, falling back to default if unset or invalid
+    """
+    try:
+        return cast(os.environ[key])
+    except (KeyError, ValueError, TypeError):
+        return default
 
 
 def stopwatch(logger):
@@ -18,7 +197,7 @@ def stopwatch(logger):
             now = datetime.datetime.utcnow()
             result = func(*args, **kwargs)
             elapsed = datetime.datetime.utcnow() - now
-            logger.error('%s took %s', func, elapsed)
+            logger.debug('%s took %s', func, elapsed)
             return result
         return inner
     return wrapper
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import time
+from logging import getLogger
+
+from ooi_instrument_agent.common import get_registry_file
+
+log = getLogger(__name__)
+
+
+class ConsulDiscovery(object):
+    """
+    Service discovery through the Consul health API, returning only passing instances
+    """
+    def __init__(self, consul):
+        """
+        :param consul: Instance of consul.Consul
+        """
+        self.consul = consul
+
+    def services(self, service_id, tag=None):
+        """
+        :return: (index, [(host, port, tags)]) of the instances of service_id, optionally only those tagged tag
+        """
+        index, matches = self.consul.health.service(service_id, tag=tag, passing=True)
+        instances = []
+        for match in matches or []:
+            host = match.get('Node', {}).get('Address')
+            port = match.get('Service', {}).get('Port')
+            instances.append((host, port, match.get('Service', {}).get('Tags') or []))
+        return index, instances
+
+
+class FileDiscovery(object):
+    """
+    Service discovery from a fixed registry file, for deployments with a known set of drivers.
+
+    The file is JSON mapping service name -> {reference designator: [host, port]}, e.g.
+
+        {"instrument_driver": {"RS10ENGC-XX00X-00-SPKIRA001": ["10.0.0.5", 42558]},
+         "sniff-port-agent": {"RS10ENGC-XX00X-00-SPKIRA001": ["10.0.0.5", 8012]}}
+
+    Every listed instance is treated as passing. The file is checked for changes at most every
+    check_interval seconds and reloaded when it changes; a file which fails to parse, or any of
+    whose entries is not a [host, port] pair, is logged and the previous registry kept. The index
+    is a digest of the file contents, so it is the same in every process reading the same file.
+    """
+    def __init__(self, path, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self.registry = {}
+        self.index = None
+        self._version = None
+        self._checked = 0
+
+    def reload(self):
+        """
+        Load the registry file if it has changed since it was last loaded
+        :return: True if the registry was reloaded
+        """
+        self._checked = time.time()
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            log.warn('Unable to read registry file %s: %s', self.path, e)
+            return False
+        version = stat.st_ino, stat.st_mtime, stat.st_size
+        if version == self._version:
+            return False
+        try:
+            with open(self.path) as fh:
+                data = fh.read()
+            registry = self.validate(json.loads(data))
+        except (IOError, ValueError) as e:
+            log.warn('Unable to load registry file %s: %s', self.path, e)
+            return False
+        self.registry = registry
+        self.index = hashlib.md5(data).hexdigest()[:16]
+        self._version = version
+        log.info('Loaded registry file %s', self.path)
+        return True
+
+    @staticmethod
+    def validate(registry):
+        """
+        :return: registry, if it has the shape described above
+        :raise ValueError: for the first entry which does not
+        """
+        if not isinstance(registry, dict):
+            raise ValueError('registry is not an object')
+        for service_id, table in registry.items():
+            if not isinstance(table, dict):
+                raise ValueError('service %r is not an object' % service_id)
+            for refdes, address in table.items():
+                if (not isinstance(address, list) or len(address) != 2 or
+                        not isinstance(address[0], basestring) or not isinstance(address[1], int)):
+                    raise ValueError('%s %r is not a [host, port] pair: %r' % (service_id, refdes, address))
+        return registry
+
+    def services(self, service_id, tag=None):
+        """
+        :return: (index, [(host, port, tags)]) of the instances of service_id, optionally only those tagged tag
+        """
+        if time.time() - self._checked >= self.check_interval:
+            self.reload()
+        table = self.registry.get(service_id, {})
+        if tag is not None:
+            table = {tag: table[tag]} if tag in table else {}
+        return self.index, [(host, port, [refdes]) for refdes, (host, port) in sorted(table.items())]
+
+
+def get_discovery(consul):
+    """
+    :param consul: Instance of consul.Consul
+    :return: FileDiscovery if a registry file is configured, otherwise ConsulDiscovery
+    """
+    path = get_registry_file()
+    if path:
+        return FileDiscovery(path)
+    return ConsulDiscovery(consul)
+
+
+def write_registry(path, services):
+    """
+    Atomically write a registry file for FileDiscovery
+    :param services: Dictionary of service name -> {reference designator: (host, port)}
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(services, fh, indent=2, sort_keys=True)
+    os.rename(tmp, path)
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import zlib
+from logging import getLogger
+
+from flask import request, Response
+
+from ooi_instrument_agent.common import (get_env_number, JSON_ENCODER_ENV_KEY, DEFAULT_JSON_ENCODER,
+                                         COMPRESS_LEVEL_ENV_KEY, DEFAULT_COMPRESS_LEVEL,
+                                         COMPRESS_MIN_SIZE_ENV_KEY, DEFAULT_COMPRESS_MIN_SIZE)
+
+log = getLogger(__name__)
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+# zlib window bits selecting the gzip or zlib (HTTP "deflate") container
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def _json_dumps(obj, sort_keys=False):
+    return json.dumps(obj, separators=(',', ':'), sort_keys=sort_keys)
+
+
+def _simplejson_dumps(obj, sort_keys=False):
+    import simplejson
+    return simplejson.dumps(obj, separators=(',', ':'), sort_keys=sort_keys)
+
+
+def _ujson_dumps(obj, sort_keys=False):
+    # ujson rounds floats to double_precision significant digits
+    import ujson
+    return ujson.dumps(obj, double_precision=15, sort_keys=sort_keys)
+
+
+ENCODERS = {
+    'json': _json_dumps,
+    'simplejson': _simplejson_dumps,
+    'ujson': _ujson_dumps,
+}
+
+
+def get_encoder(name):
+    """
+    Return the compact JSON encoding function registered as name, falling back
+    to the standard library if the module is not installed. The function takes the
+    object and optionally sort_keys.
+    """
+    encoder = ENCODERS.get(name)
+    if encoder is None:
+        log.warn('Unknown JSON encoder %r, using json', name)
+        return _json_dumps
+    try:
+        encoder({})
+    except ImportError:
+        log.warn('JSON encoder %r is not installed, using json', name)
+        return _json_dumps
+    return encoder
+
+
+dumps = get_encoder(os.environ.get(JSON_ENCODER_ENV_KEY, DEFAULT_JSON_ENCODER))
+
+
+def json_response(obj, status=200):
+    """
+    Compact JSON response using the configured encoder, in place of flask.jsonify
+    """
+    return Response(dumps(obj), status=status, mimetype='application/json')
+
+
+def conditional_json_response(obj, etag=None, volatile=('time',)):
+    """
+    JSON response carrying an ETag, or 304 Not Modified if the client already holds that version
+    :param etag: Version tag, by default a hash of obj ignoring its volatile top level keys
+    :param volatile: Keys which change on every driver reply without changing its meaning
+
+    obj is encoded at most once: with sorted keys, so that the default tag does not depend on dict
+    order, and only the small volatile part is encoded separately and spliced into the body.
+    """
+    body = extra = None
+    if etag is None:
+        if isinstance(obj, dict) and any(key in obj for key in volatile):
+            extra = dict((key, obj[key]) for key in volatile if key in obj)
+            obj = dict((key, value) for key, value in obj.iteritems() if key not in volatile)
+        body = dumps(obj, sort_keys=True)
+        etag = hashlib.md5(body).hexdigest()
+    # compressed responses carry the weak form of the tag, so compare weakly
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        if body is None:
+            body = dumps(obj)
+        elif extra is not None:
+            body = splice(body, dumps(extra, sort_keys=True))
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+def splice(encoded, extra):
+    """
+    Merge two JSON encoded objects with disjoint keys
+    """
+    if encoded == '{}':
+        return extra
+    if extra == '{}':
+        return encoded
+    return encoded[:-1] + ',' + extra[1:]
+
+
+class Compressor(object):
+    """
+    Negotiated gzip/deflate compression of responses.
+
+    Compresses compressible responses of at least min_size bytes (or of unknown size when
+    streamed) which are not already encoded, choosing the client's preferred encoding.
+    Streamed responses are compressed chunk by chunk as they are sent.
+    """
+    def __init__(self, level=DEFAULT_COMPRESS_LEVEL, min_size=DEFAULT_COMPRESS_MIN_SIZE):
+        self.level = level
+        self.min_size = min_size
+
+    @classmethod
+    def from_environ(cls):
+        return cls(level=get_env_number(COMPRESS_LEVEL_ENV_KEY, DEFAULT_COMPRESS_LEVEL),
+                   min_size=get_env_number(COMPRESS_MIN_SIZE_ENV_KEY, DEFAULT_COMPRESS_MIN_SIZE))
+
+    @staticmethod
+    def negotiate(accept_encodings):
+        """
+        :return: 'gzip', 'deflate' or None
+        """
+        best = None
+        best_quality = 0
+        for encoding in ('gzip', 'deflate'):
+            quality = accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress(self, response):
+        if (self.level <= 0 or response.status_code < 200 or response.status_code in (204, 304)
+                or 'Content-Encoding' in response.headers or response.direct_passthrough
+                or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self._stream(response.iter_encoded(), encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[encoding])
+            response.set_data(compressor.compress(data) + compressor.flush())
+        response.headers['Content-Encoding'] = encoding
+        # the compressed body is no longer byte for byte what a strong validator describes
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def _stream(self, chunks, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS[encoding])
+        try:
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                # flush each chunk so streamed data is not held back waiting for more
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
@@ -0,0 +1,145 @@
+import random
+import time
+from logging import getLogger
+
+import gevent
+from gevent.pool import Pool
+
+from ooi_instrument_agent.client import ZmqDriverClient, socket_pool
+from ooi_instrument_agent.common import (get_env_number, HEARTBEAT_INTERVAL_ENV_KEY, DEFAULT_HEARTBEAT_INTERVAL,
+                                         HEARTBEAT_TIMEOUT_ENV_KEY, DEFAULT_HEARTBEAT_TIMEOUT,
+                                         HEARTBEAT_CONCURRENCY_ENV_KEY, DEFAULT_HEARTBEAT_CONCURRENCY,
+                                         HEARTBEAT_FAILURES_ENV_KEY, DEFAULT_HEARTBEAT_FAILURES)
+from ooi_instrument_agent.metrics import HEARTBEAT_LATENCY, HEARTBEAT_FAILURES
+from ooi_instrument_agent.utils import list_driver_addresses
+
+log = getLogger(__name__)
+
+JITTER = 0.2
+
+
+class HeartbeatMonitor(object):
+    """
+    Background liveness map of the registered drivers.
+
+    Every interval seconds (+/- 20% jitter, so workers do not ping in step) each registered driver
+    is sent a process_echo, at most concurrency at a time. A driver which has missed
+    failures consecutive heartbeats is considered dead until it answers again. Results older than
+    three intervals are disregarded, so a stalled monitor never condemns a driver.
+
+    :param interval: Seconds between rounds, 0 to disable
+    :param timeout: Milliseconds to wait for each reply
+    """
+    def __init__(self, interval=DEFAULT_HEARTBEAT_INTERVAL, timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+                 concurrency=DEFAULT_HEARTBEAT_CONCURRENCY, failures=DEFAULT_HEARTBEAT_FAILURES):
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.failures = failures
+        self.drivers = {}
+        self.runner = None
+
+    @classmethod
+    def from_environ(cls):
+        return cls(interval=get_env_number(HEARTBEAT_INTERVAL_ENV_KEY, DEFAULT_HEARTBEAT_INTERVAL, float),
+                   timeout=get_env_number(HEARTBEAT_TIMEOUT_ENV_KEY, DEFAULT_HEARTBEAT_TIMEOUT),
+                   concurrency=get_env_number(HEARTBEAT_CONCURRENCY_ENV_KEY, DEFAULT_HEARTBEAT_CONCURRENCY),
+                   failures=get_env_number(HEARTBEAT_FAILURES_ENV_KEY, DEFAULT_HEARTBEAT_FAILURES))
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self, discovery):
+        """
+        Spawn the greenlet which runs a heartbeat round every interval
+        """
+        if not self.enabled or self.runner is not None:
+            return
+
+        def run():
+            # start at a random point in the first interval
+            gevent.sleep(random.uniform(0, self.interval))
+            while True:
+                try:
+                    self.check_all(list_driver_addresses(discovery))
+                except Exception as e:
+                    log.warn('Heartbeat round failed: %s', e)
+                gevent.sleep(self.interval * random.uniform(1 - JITTER, 1 + JITTER))
+        self.runner = gevent.spawn(run)
+
+    def stop(self):
+        if self.runner is not None:
+            self.runner.kill()
+            self.runner = None
+
+    def check_all(self, addresses):
+        """
+        Ping every driver in addresses, forgetting drivers no longer registered
+        :param addresses: Dictionary of reference designator -> (host, port)
+        """
+        for refdes in set(self.drivers) - set(addresses):
+            del self.drivers[refdes]
+        refdes_list = list(addresses)
+        random.shuffle(refdes_list)
+        pool = Pool(self.concurrency)
+        for refdes in refdes_list:
+            host, port = addresses[refdes]
+            pool.spawn(self.check, refdes, host, port)
+        pool.join()
+
+    def check(self, refdes, host, port):
+        start = time.time()
+        try:
+            with ZmqDriverClient(host, port, refdes=refdes, pool=socket_pool) as client:
+                client.ping(timeout=self.timeout)
+        except Exception as e:
+            HEARTBEAT_FAILURES.inc()
+            self.record(refdes, None)
+            log.debug('Heartbeat to %s failed: %s', refdes, e)
+        else:
+            latency = time.time() - start
+            HEARTBEAT_LATENCY.observe(latency)
+            self.record(refdes, latency)
+
+    def record(self, refdes, latency):
+        """
+        :param latency: Round trip time in seconds, None if unanswered
+        """
+        entry = self.drivers.setdefault(refdes, {'failures': 0, 'latency': None, 'last_seen': None})
+        entry['checked'] = time.time()
+        if latency is None:
+            entry['failures'] += 1
+        else:
+            entry['failures'] = 0
+            entry['latency'] = latency
+            entry['last_seen'] = entry['checked']
+
+    def merge(self, drivers):
+        """
+        Adopt the entries of another process's map which are newer than our own
+        """
+        for refdes, entry in drivers.items():
+            own = self.drivers.get(refdes)
+            if own is None or own['checked'] < entry['checked']:
+                self.drivers[refdes] = dict(entry)
+
+    def _current(self, refdes):
+        entry = self.drivers.get(refdes)
+        if entry is None or time.time() - entry['checked'] > self.interval * 3:
+            return None
+        return entry
+
+    def is_dead(self, refdes):
+        entry = self._current(refdes)
+        return entry is not None and entry['failures'] >= self.failures
+
+    def status(self, refdes):
+        """
+        :return: {'alive': True, False or None if unknown, 'latency', 'last_seen', 'checked'}
+        """
+        entry = self._current(refdes)
+        if entry is None:
+            return {'alive': None, 'latency': None, 'last_seen': None, 'checked': None}
+        return {'alive': entry['failures'] < self.failures, 'latency': entry['latency'],
+                'last_seen': entry['last_seen'], 'checked': entry['checked']}
@@ -0,0 +1,173 @@
+import atexit
+import gc
+import os
+import resource
+import sys
+import time
+import traceback
+from collections import deque
+from logging import getLogger
+
+import gevent
+import six
+from gevent import monkey
+from greenlet import greenlet
+
+from ooi_instrument_agent.common import (get_env_number, HUB_BLOCK_THRESHOLD_ENV_KEY, DEFAULT_HUB_BLOCK_THRESHOLD,
+                                         HUB_LAG_INTERVAL_ENV_KEY, DEFAULT_HUB_LAG_INTERVAL)
+from ooi_instrument_agent.metrics import HUB_LAG, HUB_BLOCKED
+
+log = getLogger(__name__)
+
+# the monitor must run in a real OS thread even when threading has been monkey patched
+_thread_module = six.moves._thread.__name__
+_start_new_thread = monkey.get_original(_thread_module, 'start_new_thread')
+_get_ident = monkey.get_original(_thread_module, 'get_ident')
+_sleep = monkey.get_original('time', 'sleep')
+
+
+class HubMonitor(object):
+    """
+    Watches for code which blocks the gevent hub, freezing every request in the worker.
+
+    A greenlet wakes every interval seconds and records how late it woke (the loop lag). A separate
+    OS thread checks that the greenlet keeps waking; if the hub has not run for threshold seconds
+    it captures the stack of whatever is holding it and keeps the last few such reports. The thread
+    only appends to deques: logging and metrics take gevent locks, so the reports are logged and
+    counted by the greenlet once the hub runs again.
+
+    Counting greenlets walks the whole heap while holding the hub, so the greenlet takes the count
+    only every count_interval seconds, between lag measurements, and the walk is not itself
+    reported as a block.
+
+    :param threshold: Seconds the hub may go without running before it is reported blocked, 0 to disable
+    :param interval: Seconds between lag measurements
+    :param count_interval: Seconds between greenlet counts
+    """
+    def __init__(self, threshold=DEFAULT_HUB_BLOCK_THRESHOLD, interval=DEFAULT_HUB_LAG_INTERVAL, keep=20,
+                 count_interval=60):
+        self.threshold = threshold
+        self.interval = interval
+        self.count_interval = count_interval
+        self.greenlets = None
+        self.counting = False
+        self.blocks = deque(maxlen=keep)
+        self.unreported = deque(maxlen=keep)
+        self.running = False
+        self.last_tick = None
+        self.max_lag = 0
+        self.ticker = None
+        self._hub_ident = None
+        self._reported = None
+
+    @classmethod
+    def from_environ(cls):
+        return cls(threshold=get_env_number(HUB_BLOCK_THRESHOLD_ENV_KEY, DEFAULT_HUB_BLOCK_THRESHOLD, float),
+                   interval=get_env_number(HUB_LAG_INTERVAL_ENV_KEY, DEFAULT_HUB_LAG_INTERVAL, float))
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def start(self):
+        if not self.enabled or self.ticker is not None:
+            return
+        self._hub_ident = _get_ident()
+        self.last_tick = time.time()
+        self.running = True
+        self.ticker = gevent.spawn(self.tick)
+        _start_new_thread(self.watch, ())
+        atexit.register(self.stop)
+
+    def tick(self):
+        while True:
+            start = time.time()
+            gevent.sleep(self.interval)
+            self.last_tick = time.time()
+            lag = max(self.last_tick - start - self.interval, 0)
+            self.max_lag = max(self.max_lag, lag)
+            HUB_LAG.observe(lag)
+            self.report()
+            if self.greenlets is None or self.last_tick - self.greenlets['time'] >= self.count_interval:
+                self.count()
+
+    def count(self):
+        """
+        :return: {'live': live greenlets, 'gevent': of which gevent Greenlets, 'time': when counted}
+        """
+        self.counting = True
+        try:
+            live, spawned = count_greenlets()
+            self.greenlets = {'live': live, 'gevent': spawned, 'time': time.time()}
+        finally:
+            # measure the next lag from after the walk
+            self.last_tick = time.time()
+            self.counting = False
+        return self.greenlets
+
+    def greenlet_counts(self):
+        """
+        :return: The last greenlet count, counting now only if there is none yet
+        """
+        return self.greenlets or self.count()
+
+    def report(self):
+        while self.unreported:
+            block = self.unreported.popleft()
+            HUB_BLOCKED.inc()
+            log.warn('gevent hub blocked for %.3fs in:\n%s', block['blocked_for'], block['stack'])
+
+    def watch(self):
+        while self.running:
+            _sleep(self.threshold / 2.0)
+            if not self.running:
+                # stopped, possibly by interpreter exit which tears down the modules used by check
+                break
+            self.check()
+
+    def check(self):
+        """
+        Report the hub as blocked if the ticker has not run for threshold seconds, once per blockage
+        """
+        if self.counting:
+            return
+        tick = self.last_tick
+        blocked_for = time.time() - tick - self.interval
+        if blocked_for < self.threshold or self._reported == tick:
+            return
+        self._reported = tick
+        frame = sys._current_frames().get(self._hub_ident)
+        stack = traceback.format_stack(frame, 30) if frame is not None else []
+        block = {'time': time.time(), 'blocked_for': round(blocked_for, 3), 'stack': ''.join(stack)}
+        self.blocks.append(block)
+        self.unreported.append(block)
+
+    def stop(self):
+        self.running = False
+        if self.ticker is not None:
+            self.ticker.kill()
+            self.ticker = None
+
+    def status(self):
+        return {'enabled': self.enabled, 'threshold': self.threshold, 'max_lag': round(self.max_lag, 6),
+                'blocked': list(self.blocks)}
+
+
+def open_fds():
+    """
+    :return: (open file descriptors or None if unknown, soft limit)
+    """
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    try:
+        return len(os.listdir('/proc/self/fd')), limit
+    except OSError:
+        return None, limit
+
+
+def count_greenlets():
+    """
+    Walks the whole heap, see HubMonitor.greenlet_counts
+    :return: (live greenlets, of which gevent Greenlets)
+    """
+    live = [obj for obj in gc.get_objects() if isinstance(obj, greenlet) and not obj.dead]
+    return len(live), sum(1 for obj in live if isinstance(obj, gevent.Greenlet))
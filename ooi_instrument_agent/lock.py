@@ -1,6 +1,8 @@
 from collections import MutableMapping
 from logging import getLogger
 
+from ooi_instrument_agent.metrics import timed, LOCK_LATENCY
+
 log = getLogger(__name__)
 
 
@@ -57,7 +59,8 @@ class LockManager(MutableMapping):
         else:
             modify_index = 0
 
-        success = self.consul.kv.put(key, value, cas=modify_index)
+        with timed(LOCK_LATENCY, 'lock', operation='put'):
+            success = self.consul.kv.put(key, value, cas=modify_index)
         if success:
             return key
         else:
@@ -68,22 +71,39 @@ class LockManager(MutableMapping):
         current = self._get(key)
         if current is not None:
             modify_index = current.get('ModifyIndex')
-            self.consul.kv.delete(key, cas=modify_index)
+            with timed(LOCK_LATENCY, 'lock', operation='delete'):
+                self.consul.kv.delete(key, cas=modify_index)
 
     def __len__(self):
-        index, values = self.consul.kv.get(self.prefix, recurse=True)
+        with timed(LOCK_LATENCY, 'lock', operation='list'):
+            index, values = self.consul.kv.get(self.prefix, recurse=True)
         if values is None:
             return 0
         return len(values)
 
     def __iter__(self):
-        index, values = self.consul.kv.get(self.prefix, recurse=True)
+        with timed(LOCK_LATENCY, 'lock', operation='list'):
+            index, values = self.consul.kv.get(self.prefix, recurse=True)
         if values is not None:
             for value in values:
                 yield value.get('Key').replace(self.prefix, '').lstrip('/')
 
+    def snapshot(self):
+        """
+        Fetch all current locks in a single request
+        :return: (Consul index, {key: lock holder})
+        """
+        with timed(LOCK_LATENCY, 'lock', operation='list'):
+            index, values = self.consul.kv.get(self.prefix, recurse=True)
+        locks = {}
+        for value in values or []:
+            if value.get('Value') is not None:
+                locks[value.get('Key').replace(self.prefix, '').lstrip('/')] = value.get('Value')
+        return index, locks
+
     def _get(self, item):
-        index, value = self.consul.kv.get(item)
+        with timed(LOCK_LATENCY, 'lock', operation='get'):
+            index, value = self.consul.kv.get(item)
         return value
 
     def _get_value(self, item):
@@ -0,0 +1,312 @@
+import errno
+import json
+import os
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import getLogger
+
+import gevent
+from flask import g, has_request_context
+
+log = getLogger(__name__)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 90)
+
+
+class Metric(object):
+    """
+    Base class for a labelled metric. Samples are keyed by a tuple of label values.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.samples = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def describe(self):
+        return {'kind': self.kind, 'help': self.documentation, 'labels': self.labelnames}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.samples[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Increment the gauge for the duration of the block
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        sample = self.samples.get(key)
+        if sample is None:
+            sample = self.samples[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            sample[0][index] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    def describe(self):
+        description = Metric.describe(self)
+        description['buckets'] = self.buckets
+        return description
+
+
+class Registry(object):
+    """
+    Collection of metrics which can be snapshotted, merged with other processes' snapshots
+    and rendered in the Prometheus text exposition format
+    """
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self):
+        """
+        :return: JSON serializable copy of all metrics
+        """
+        snapshot = OrderedDict()
+        for name, metric in self.metrics.iteritems():
+            description = metric.describe()
+            description['samples'] = [[list(key), value] for key, value in metric.samples.iteritems()]
+            snapshot[name] = description
+        return snapshot
+
+
+def merge(snapshots):
+    """
+    Sum the samples of several snapshots
+    :param snapshots: Iterable of (snapshot, alive) where alive is False for exited processes,
+                      whose gauges no longer apply
+    :return: Merged snapshot
+    """
+    merged = OrderedDict()
+    for snapshot, alive in snapshots:
+        for name, description in snapshot.iteritems():
+            if description['kind'] == 'gauge' and not alive:
+                continue
+            target = merged.setdefault(name, dict(description, samples={}))
+            samples = target['samples']
+            for key, value in description['samples']:
+                key = tuple(key)
+                if description['kind'] == 'histogram':
+                    current = samples.get(key)
+                    if current is None:
+                        samples[key] = [list(value[0]), value[1], value[2]]
+                    else:
+                        current[0] = [a + b for a, b in zip(current[0], value[0])]
+                        current[1] += value[1]
+                        current[2] += value[2]
+                else:
+                    samples[key] = samples.get(key, 0) + value
+    return merged
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+               for k, v in pairs)
+    return '{%s}' % ','.join(escaped)
+
+
+def render(merged):
+    """
+    Render a merged snapshot in the Prometheus text exposition format
+    """
+    lines = []
+    for name, description in merged.iteritems():
+        lines.append('# HELP %s %s' % (name, description['help']))
+        lines.append('# TYPE %s %s' % (name, description['kind']))
+        labels = description['labels']
+        for key, value in sorted(description['samples'].iteritems()):
+            if description['kind'] == 'histogram':
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(description['buckets'], counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels, key, ('le', repr(float(bound)))),
+                                                     cumulative))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, key, ('le', '+Inf')), count))
+                lines.append('%s_sum%s %r' % (name, _format_labels(labels, key), total))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels, key), count))
+            else:
+                lines.append('%s%s %r' % (name, _format_labels(labels, key), value))
+    return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def write_snapshot(directory, registry=None):
+    """
+    Atomically write this process's metrics to directory/<pid>.json
+    """
+    registry = registry or REGISTRY
+    path = os.path.join(directory, '%d.json' % os.getpid())
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(registry.snapshot(), fh)
+    os.rename(tmp, path)
+
+
+def collect(directory=None, registry=None):
+    """
+    Merge the live metrics of this process with the snapshots written by other worker processes
+    :param directory: Shared snapshot directory, or None if running a single process
+    :return: Prometheus text exposition
+    """
+    registry = registry or REGISTRY
+    snapshots = [(registry.snapshot(), True)]
+    if directory:
+        own = '%d.json' % os.getpid()
+        for name in os.listdir(directory):
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                with open(os.path.join(directory, name)) as fh:
+                    snapshot = json.load(fh, object_pairs_hook=OrderedDict)
+            except (IOError, ValueError):
+                continue
+            snapshots.append((snapshot, _pid_alive(int(name[:-5]))))
+    return render(merge(snapshots))
+
+
+def start_flusher(directory, interval=5, registry=None):
+    """
+    Spawn a greenlet which periodically writes this process's metrics to the shared directory
+    """
+    def flush():
+        while True:
+            try:
+                write_snapshot(directory, registry)
+            except (IOError, OSError) as e:
+                log.warn('Unable to write metrics snapshot: %s', e)
+            gevent.sleep(interval)
+    return gevent.spawn(flush)
+
+
+def record_phase(phase, elapsed):
+    """
+    Accumulate time spent in a phase (consul, lock, zmq) against the current request, if any
+    """
+    if has_request_context():
+        phases = getattr(g, 'phases', None)
+        if phases is None:
+            phases = g.phases = {}
+        phases[phase] = phases.get(phase, 0) + elapsed
+
+
+@contextmanager
+def timed(histogram, phase=None, **labels):
+    """
+    Time the enclosed block, observing the elapsed seconds in histogram and,
+    if phase is given, accumulating it against the current request
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        histogram.observe(elapsed, **labels)
+        if phase is not None:
+            record_phase(phase, elapsed)
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.histogram('agent_request_seconds', 'HTTP request latency',
+                                     ['endpoint', 'method', 'status'])
+REQUEST_PHASE_LATENCY = REGISTRY.histogram('agent_request_phase_seconds',
+                                           'Time spent per request in Consul discovery, lock checks and ZMQ RPC',
+                                           ['endpoint', 'phase'])
+REQUESTS_IN_FLIGHT = REGISTRY.gauge('agent_requests_in_flight', 'HTTP requests currently being served',
+                                    ['endpoint'])
+REQUEST_ERRORS = REGISTRY.counter('agent_request_errors_total', 'HTTP requests which returned an error status',
+                                  ['endpoint', 'status'])
+CONSUL_LATENCY = REGISTRY.histogram('agent_consul_seconds', 'Consul discovery request latency', ['operation'])
+LOCK_LATENCY = REGISTRY.histogram('agent_lock_seconds', 'Consul lock operation latency', ['operation'])
+ZMQ_LATENCY = REGISTRY.histogram('agent_zmq_seconds', 'Driver ZMQ RPC latency', ['command'])
+ZMQ_IN_FLIGHT = REGISTRY.gauge('agent_zmq_in_flight', 'Driver ZMQ RPCs currently awaiting a response', ['command'])
+ZMQ_TIMEOUTS = REGISTRY.counter('agent_zmq_timeouts_total', 'Driver ZMQ RPCs which timed out', ['command'])
+ZMQ_CANCELLED = REGISTRY.counter('agent_zmq_cancelled_total',
+                                 'Driver ZMQ RPCs abandoned because the request was cancelled', ['command'])
+ZMQ_WAIT_RECOVERED = REGISTRY.counter('agent_zmq_wait_recovered_seconds_total',
+                                      'RPC timeout seconds not spent waiting thanks to cancellation', ['command'])
+WORKER_STARTUP = REGISTRY.histogram('agent_worker_startup_seconds',
+                                    'Worker startup time by phase (import, setup, warm_up)', ['phase'],
+                                    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+FIRST_REQUEST_LATENCY = REGISTRY.histogram('agent_first_request_seconds', 'Latency of the first request per worker',
+                                           ['endpoint', 'warmed'])
+CACHE_REQUESTS = REGISTRY.counter('agent_cache_requests_total', 'Cached driver reads by outcome (hit, coalesced, miss)',
+                                  ['command', 'result'])
+HEARTBEAT_LATENCY = REGISTRY.histogram('agent_heartbeat_seconds', 'Background driver heartbeat round trip time')
+HEARTBEAT_FAILURES = REGISTRY.counter('agent_heartbeat_failures_total', 'Background driver heartbeats left unanswered')
+RATE_LIMITED = REGISTRY.counter('agent_rate_limited_total', 'HTTP requests refused by the client or driver rate limit',
+                                ['scope', 'endpoint'])
+QUEUE_WAIT = REGISTRY.histogram('agent_queue_wait_seconds', 'Time requests waited for a slot in their priority class',
+                                ['priority'])
+QUEUE_REJECTED = REGISTRY.counter('agent_queue_rejected_total',
+                                  'Requests refused after waiting queue_timeout for a slot', ['priority'])
+LOG_RECORDS_DROPPED = REGISTRY.counter('agent_log_records_dropped_total',
+                                       'Log records discarded because the background writer fell behind')
+REQUESTS_CANCELLED = REGISTRY.counter('agent_requests_cancelled_total',
+                                      'Requests cancelled on client disconnect or deadline', ['endpoint', 'reason'])
+HUB_LAG = REGISTRY.histogram('agent_hub_lag_seconds', 'How late the gevent hub ran a timer, sampled periodically',
+                             buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+HUB_BLOCKED = REGISTRY.counter('agent_hub_blocked_total', 'Times the gevent hub was blocked beyond the threshold')
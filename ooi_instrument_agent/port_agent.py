@@ -0,0 +1,138 @@
+import struct
+from collections import namedtuple
+
+SYNC = '\xa3\x9d\x7a'
+HEADER_FORMAT = '>3sBHHII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+NTP_FRACTION = float(2 ** 32)
+
+DATA_FROM_INSTRUMENT = 1
+DATA_FROM_DRIVER = 2
+PORT_AGENT_COMMAND = 3
+PORT_AGENT_STATUS = 4
+PORT_AGENT_FAULT = 5
+INSTRUMENT_COMMAND = 6
+HEARTBEAT = 7
+PICKLED_DATA_FROM_INSTRUMENT = 8
+PICKLED_DATA_FROM_DRIVER = 9
+
+PACKET_TYPES = {
+    'DATA_FROM_INSTRUMENT': DATA_FROM_INSTRUMENT,
+    'DATA_FROM_DRIVER': DATA_FROM_DRIVER,
+    'PORT_AGENT_COMMAND': PORT_AGENT_COMMAND,
+    'PORT_AGENT_STATUS': PORT_AGENT_STATUS,
+    'PORT_AGENT_FAULT': PORT_AGENT_FAULT,
+    'INSTRUMENT_COMMAND': INSTRUMENT_COMMAND,
+    'HEARTBEAT': HEARTBEAT,
+    'PICKLED_DATA_FROM_INSTRUMENT': PICKLED_DATA_FROM_INSTRUMENT,
+    'PICKLED_DATA_FROM_DRIVER': PICKLED_DATA_FROM_DRIVER,
+}
+
+
+Packet = namedtuple('Packet', 'type time payload raw')
+
+
+def make_packet(packet_type, payload, timestamp=0.0):
+    """
+    Build a raw port agent packet (checksum is left zeroed)
+    :param packet_type: Port agent packet type
+    :param payload: Packet payload
+    :param timestamp: NTP timestamp in seconds
+    :return: Packet bytes
+    """
+    seconds = int(timestamp)
+    fraction = int((timestamp - seconds) * NTP_FRACTION)
+    header = struct.pack(HEADER_FORMAT, SYNC, packet_type, HEADER_SIZE + len(payload), 0, seconds, fraction)
+    return header + payload
+
+
+class PacketDecoder(object):
+    """
+    Incremental decoder for a stream of port agent packets.
+
+    Data is appended to an internal buffer as it arrives and complete packets are returned from feed().
+    Bytes which have already been parsed are discarded, so each byte is only examined once. If the
+    stream is corrupt, the decoder resynchronizes on the next sync pattern.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.dropped = 0
+
+    def feed(self, data):
+        """
+        :param data: Raw bytes received from the port agent
+        :return: List of complete Packets
+        """
+        self.buffer.extend(data)
+        packets = []
+        pos = 0
+        end = len(self.buffer)
+
+        while end - pos >= HEADER_SIZE:
+            if self.buffer[pos:pos + 3] != SYNC:
+                index = self.buffer.find(SYNC, pos + 1)
+                if index == -1:
+                    # keep a possible partial sync pattern at the tail
+                    index = max(pos, end - 2)
+                self.dropped += index - pos
+                pos = index
+                continue
+
+            _, packet_type, length, _, seconds, fraction = struct.unpack_from(HEADER_FORMAT, self.buffer, pos)
+            if length < HEADER_SIZE:
+                # corrupt header, skip this sync pattern
+                self.dropped += 1
+                pos += 1
+                continue
+
+            if end - pos < length:
+                break
+
+            raw = str(self.buffer[pos:pos + length])
+            packets.append(Packet(packet_type, seconds + fraction / NTP_FRACTION, raw[HEADER_SIZE:], raw))
+            pos += length
+
+        if pos:
+            del self.buffer[:pos]
+        return packets
+
+
+class PacketFilter(object):
+    """
+    Select and render port agent packets according to the options supplied by a sniff client
+
+    :param types: Iterable of packet types (names or numbers) to keep, None for all
+    :param after: Only keep packets with an NTP timestamp greater than this value
+    :param payload: If True, strip the port agent header and return only the payload
+    """
+    def __init__(self, types=None, after=None, payload=False):
+        if isinstance(types, (basestring, int)):
+            types = [types]
+        if types is not None:
+            types = set(PACKET_TYPES.get(t, t) for t in types)
+        self.types = types
+        self.after = after
+        self.payload = payload
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        Build a filter from a sniff request options dictionary
+        """
+        return cls(types=options.get('types'), after=options.get('after'), payload=bool(options.get('payload')))
+
+    def accept(self, packet):
+        if self.types is not None and packet.type not in self.types:
+            return False
+        if self.after is not None and packet.time <= self.after:
+            return False
+        return True
+
+    def render(self, packets):
+        """
+        :param packets: Iterable of Packets
+        :return: Concatenated bytes of all accepted packets
+        """
+        if self.payload:
+            return ''.join(p.payload for p in packets if self.accept(p))
+        return ''.join(p.raw for p in packets if self.accept(p))
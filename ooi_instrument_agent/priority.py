@@ -0,0 +1,105 @@
+import time
+from logging import getLogger
+
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Pool
+
+from ooi_instrument_agent.common import (get_env_number, INTERACTIVE_CONCURRENCY_ENV_KEY,
+                                         DEFAULT_INTERACTIVE_CONCURRENCY, BULK_CONCURRENCY_ENV_KEY,
+                                         DEFAULT_BULK_CONCURRENCY, QUEUE_TIMEOUT_ENV_KEY, DEFAULT_QUEUE_TIMEOUT)
+from ooi_instrument_agent.metrics import QUEUE_WAIT, QUEUE_REJECTED, record_phase
+
+log = getLogger(__name__)
+
+# endpoints operators drive by hand, which change driver state or need a prompt answer
+INTERACTIVE_ENDPOINTS = ('instrument.execute', 'instrument.set_resource', 'instrument.discover',
+                         'instrument.set_init_params', 'instrument.shutdown', 'instrument.set_log_level',
+                         'instrument.batch', 'instrument.set_lock', 'instrument.unlock', 'instrument.ping')
+# endpoints polled by dashboards and scripts
+BULK_ENDPOINTS = ('instrument.get_drivers_status', 'instrument.resource_state', 'instrument.get_resource',
+                  'instrument.get_driver', 'instrument.sniff', 'instrument.sniffer_stats')
+
+
+class Overloaded(Exception):
+    status_code = 503
+
+    def __init__(self, message=None, retry_after=1):
+        Exception.__init__(self)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class PriorityClass(object):
+    """
+    A bounded share of a worker's capacity.
+
+    At most concurrency requests of the class are served at once, later ones queue for up to
+    queue_timeout seconds. Driver calls fanned out on behalf of the class's requests run in its
+    pool, so one request cannot flood the drivers either.
+
+    :param concurrency: Requests served at once, 0 for no limit
+    """
+    def __init__(self, name, concurrency, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.slots = BoundedSemaphore(concurrency) if concurrency > 0 else None
+        self.pool = Pool(concurrency or None)
+
+    def acquire(self):
+        """
+        Wait for a slot, recording the queue wait
+        :raises Overloaded: if none frees up within queue_timeout
+        """
+        if self.slots is None:
+            return
+        start = time.time()
+        acquired = self.slots.acquire(timeout=self.queue_timeout)
+        waited = time.time() - start
+        QUEUE_WAIT.observe(waited, priority=self.name)
+        record_phase('queue', waited)
+        if not acquired:
+            QUEUE_REJECTED.inc(priority=self.name)
+            log.warn('No %s slot free after %.1fs', self.name, waited)
+            raise Overloaded({'overloaded': self.name}, retry_after=int(self.queue_timeout) or 1)
+
+    def release(self):
+        if self.slots is not None:
+            self.slots.release()
+
+    def spawn(self, func, *args, **kwargs):
+        return self.pool.spawn(func, *args, **kwargs)
+
+
+class PriorityClasses(object):
+    """
+    Interactive and bulk priority classes with separate bounds, so that operator commands keep a
+    reserved share of each worker however much polling traffic is queued. Other endpoints (driver
+    list, locks, metrics, UI) are not bounded.
+    """
+    def __init__(self, interactive=DEFAULT_INTERACTIVE_CONCURRENCY, bulk=DEFAULT_BULK_CONCURRENCY,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.classes = {
+            'interactive': PriorityClass('interactive', interactive, queue_timeout),
+            'bulk': PriorityClass('bulk', bulk, queue_timeout),
+            'other': PriorityClass('other', 0),
+        }
+
+    @classmethod
+    def from_environ(cls):
+        return cls(interactive=get_env_number(INTERACTIVE_CONCURRENCY_ENV_KEY, DEFAULT_INTERACTIVE_CONCURRENCY),
+                   bulk=get_env_number(BULK_CONCURRENCY_ENV_KEY, DEFAULT_BULK_CONCURRENCY),
+                   queue_timeout=get_env_number(QUEUE_TIMEOUT_ENV_KEY, DEFAULT_QUEUE_TIMEOUT, float))
+
+    def __getitem__(self, name):
+        return self.classes[name]
+
+    def classify(self, endpoint):
+        """
+        :return: The PriorityClass serving endpoint
+        """
+        if endpoint in INTERACTIVE_ENDPOINTS:
+            return self.classes['interactive']
+        if endpoint in BULK_ENDPOINTS:
+            return self.classes['bulk']
+        return self.classes['other']
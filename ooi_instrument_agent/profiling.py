@@ -0,0 +1,123 @@
+import cProfile
+import itertools
+import os
+import pstats
+import time
+from logging import getLogger
+
+from flask import g, request, Response
+from six import StringIO
+
+from ooi_instrument_agent.common import (get_env_number, PROFILE_TOKEN_ENV_KEY, PROFILE_SAMPLE_ENV_KEY,
+                                         PROFILE_DIR_ENV_KEY, PROFILE_KEEP_ENV_KEY, DEFAULT_PROFILE_KEEP)
+
+log = getLogger(__name__)
+
+PROFILE_HEADER = 'X-Agent-Profile'
+PROFILE_PARAM = 'profile'
+
+
+class RequestProfiler(object):
+    """
+    Opt-in cProfile instrumentation of individual requests.
+
+    A request is profiled when it carries the configured token in the X-Agent-Profile header or the
+    "profile" query parameter; its response is replaced by the profile report. Additionally, one in
+    every sample requests is profiled and the raw stats written to directory, keeping only the newest
+    keep files. With no token and no sampling configured the hooks return immediately.
+
+    cProfile follows the OS thread, so time spent in other greenlets while this request is waiting
+    on I/O will appear in its profile. For the same reason only one request per worker is profiled at
+    a time; requests arriving while a profile is running are served without one.
+    """
+    def __init__(self, token=None, sample=0, directory=None, keep=DEFAULT_PROFILE_KEEP):
+        self.token = token
+        self.sample = sample if directory else 0
+        self.directory = directory
+        self.keep = keep
+        self.counter = itertools.count(1)
+        self.enabled = bool(self.token or self.sample)
+        self.active = None
+
+    @classmethod
+    def from_environ(cls):
+        return cls(token=os.environ.get(PROFILE_TOKEN_ENV_KEY),
+                   sample=get_env_number(PROFILE_SAMPLE_ENV_KEY, 0),
+                   directory=os.environ.get(PROFILE_DIR_ENV_KEY),
+                   keep=get_env_number(PROFILE_KEEP_ENV_KEY, DEFAULT_PROFILE_KEEP))
+
+    def _requested(self):
+        if not self.token:
+            return False
+        supplied = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_PARAM)
+        return supplied == self.token
+
+    def start(self):
+        """
+        Begin profiling the current request if it was requested or selected for sampling
+        """
+        if not self.enabled:
+            return
+        if self._requested():
+            mode = 'explicit'
+        elif self.sample and next(self.counter) % self.sample == 0:
+            mode = 'sample'
+        else:
+            return
+        if self.active is not None:
+            # enabling a second profile would take over the OS thread from the running one
+            log.debug('Not profiling %s, another request is being profiled', request.endpoint)
+            return
+        profile = self.active = cProfile.Profile()
+        g.profile = (mode, profile)
+        profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling the current request, returning the mode and profile if one was running
+        """
+        if not self.enabled:
+            return None, None
+        mode, profile = getattr(g, 'profile', (None, None))
+        if profile is not None:
+            profile.disable()
+            g.profile = (None, None)
+            self.active = None
+        return mode, profile
+
+    def finish(self, response):
+        """
+        Stop profiling and either return the report (explicit) or store the profile (sampled)
+        """
+        mode, profile = self.stop()
+        if mode == 'explicit':
+            return Response(self.report(profile), mimetype='text/plain')
+        if mode == 'sample':
+            try:
+                self.store(profile)
+            except (IOError, OSError) as e:
+                log.warn('Unable to store request profile: %s', e)
+        return response
+
+    @staticmethod
+    def report(profile, limit=50):
+        stream = StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def store(self, profile):
+        name = '%.6f-%d-%s.prof' % (time.time(), os.getpid(), request.endpoint)
+        profile.dump_stats(os.path.join(self.directory, name))
+        self.rotate()
+
+    def rotate(self):
+        """
+        Delete all but the newest keep profiles
+        """
+        profiles = sorted(name for name in os.listdir(self.directory) if name.endswith('.prof'))
+        for name in profiles[:-self.keep]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
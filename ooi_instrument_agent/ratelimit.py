@@ -0,0 +1,108 @@
+import math
+import time
+from logging import getLogger
+
+from ooi_instrument_agent.common import (get_env_number, CLIENT_RATE_ENV_KEY, CLIENT_BURST_ENV_KEY,
+                                         DRIVER_RATE_ENV_KEY, DRIVER_BURST_ENV_KEY, DEFAULT_RATE, DEFAULT_BURST)
+from ooi_instrument_agent.metrics import RATE_LIMITED
+
+log = getLogger(__name__)
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+    def __init__(self, message=None, retry_after=1):
+        Exception.__init__(self)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class TokenBuckets(object):
+    """
+    Token buckets keyed by an arbitrary name, each refilled at rate tokens per second up to burst.
+
+    A bucket which has been idle long enough to refill completely is no different from a new
+    one, so full buckets are discarded once more than max_buckets are held.
+
+    :param rate: Tokens per second, 0 for no limit
+    :param burst: Bucket capacity, at least 1
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_buckets=10000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_buckets = max_buckets
+        self.buckets = {}
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def take(self, key):
+        """
+        Take a token from key's bucket
+        :return: 0 if a token was available, otherwise seconds until one will be
+        """
+        if not self.enabled:
+            return 0
+        now = time.time()
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = tokens, now
+            return (1 - tokens) / self.rate
+        self.buckets[key] = tokens - 1, now
+        if len(self.buckets) > self.max_buckets:
+            self.prune(now)
+        return 0
+
+    def prune(self, now=None):
+        now = now or time.time()
+        for key, (tokens, updated) in list(self.buckets.items()):
+            if tokens + (now - updated) * self.rate >= self.burst:
+                del self.buckets[key]
+
+
+class RateLimiter(object):
+    """
+    Admission control by client address and by target driver.
+
+    A request must find a token in both its client's and its driver's bucket, otherwise it is
+    refused with 429 and a Retry-After. Buckets are per worker process, so the limits apply to
+    each gunicorn worker separately.
+    """
+    def __init__(self, client_rate=DEFAULT_RATE, client_burst=DEFAULT_BURST,
+                 driver_rate=DEFAULT_RATE, driver_burst=DEFAULT_BURST):
+        self.clients = TokenBuckets(client_rate, client_burst)
+        self.drivers = TokenBuckets(driver_rate, driver_burst)
+
+    @classmethod
+    def from_environ(cls):
+        return cls(client_rate=get_env_number(CLIENT_RATE_ENV_KEY, DEFAULT_RATE, float),
+                   client_burst=get_env_number(CLIENT_BURST_ENV_KEY, DEFAULT_BURST),
+                   driver_rate=get_env_number(DRIVER_RATE_ENV_KEY, DEFAULT_RATE, float),
+                   driver_burst=get_env_number(DRIVER_BURST_ENV_KEY, DEFAULT_BURST))
+
+    @property
+    def enabled(self):
+        return self.clients.enabled or self.drivers.enabled
+
+    def admit(self, client, driver_id=None, endpoint=None):
+        """
+        :param client: Client identity
+        :param driver_id: Reference designator of the target driver, if any
+        :raises RateLimited: if either bucket is empty
+        """
+        wait = self.clients.take(client)
+        if wait:
+            self._refuse('client', client, wait, endpoint)
+        if driver_id is not None:
+            wait = self.drivers.take(driver_id)
+            if wait:
+                self._refuse('driver', driver_id, wait, endpoint)
+
+    @staticmethod
+    def _refuse(scope, key, wait, endpoint):
+        RATE_LIMITED.inc(scope=scope, endpoint=endpoint)
+        log.debug('Rate limited %s %s on %s for %.3fs', scope, key, endpoint, wait)
+        raise RateLimited({'rate-limited': scope, 'retry-after': wait}, retry_after=int(math.ceil(wait)))
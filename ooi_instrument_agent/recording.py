@@ -0,0 +1,235 @@
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# Each recorded chunk is framed with its receive time and length
+FRAME_FORMAT = '>dI'
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+# Sparse index entries map a frame receive time to its offset in the segment
+INDEX_FORMAT = '>dQ'
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_INDEX_INTERVAL = 64 * 1024
+DEFAULT_READ_MAX_BYTES = 64 * 1024 * 1024
+
+
+def segment_name(timestamp):
+    # fixed width microseconds so that lexical order is time order
+    return '%020d' % int(timestamp * 1e6)
+
+
+def segment_time(name):
+    return int(name) / 1e6
+
+
+class SegmentWriter(object):
+    """
+    Append-only writer for the active segment of a single reference designator
+    """
+    def __init__(self, directory, timestamp, index_interval):
+        self.start = timestamp
+        base = os.path.join(directory, segment_name(timestamp))
+        self.data = open(base + SEGMENT_SUFFIX, 'ab')
+        self.index = open(base + INDEX_SUFFIX, 'ab')
+        self.index_interval = index_interval
+        self.size = self.data.tell()
+        self.last_indexed = None
+
+    def write(self, data, timestamp):
+        if self.last_indexed is None or self.size - self.last_indexed >= self.index_interval:
+            self.index.write(struct.pack(INDEX_FORMAT, timestamp, self.size))
+            self.last_indexed = self.size
+        self.data.write(struct.pack(FRAME_FORMAT, timestamp, len(data)))
+        self.data.write(data)
+        self.size += FRAME_SIZE + len(data)
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class SniffRecorder(object):
+    """
+    Record sniffer streams to disk, one directory per reference designator.
+
+    Each stream is split into segments of roughly segment_bytes. Alongside each segment a sparse
+    index records the offset of a frame at least every index_interval bytes, so a time range can
+    be read by seeking directly to the nearest preceding index entry rather than scanning the file.
+
+    Retention is enforced whenever a segment is rolled over: the oldest closed segments are deleted
+    while the total recorded size exceeds max_bytes or the segment is older than max_age seconds.
+
+    A single read returns at most max_read_bytes of data, so replaying an open-ended range cannot load
+    the whole retained history into memory.
+    """
+    def __init__(self, root, segment_bytes=DEFAULT_SEGMENT_BYTES, index_interval=DEFAULT_INDEX_INTERVAL,
+                 max_bytes=None, max_age=None, max_read_bytes=DEFAULT_READ_MAX_BYTES):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_read_bytes = max_read_bytes
+        self.writers = {}
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def directory(self, refdes):
+        if not refdes or os.path.basename(refdes) != refdes or refdes.startswith('.'):
+            raise ValueError('Invalid reference designator: %r' % refdes)
+        return os.path.join(self.root, refdes)
+
+    def write(self, refdes, data, timestamp):
+        """
+        Append data received at timestamp to the recording for refdes
+        """
+        writer = self.writers.get(refdes)
+        if writer is not None and writer.size >= self.segment_bytes:
+            writer.close()
+            writer = None
+            self.enforce_retention(timestamp)
+
+        if writer is None:
+            directory = self.directory(refdes)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            writer = self.writers[refdes] = SegmentWriter(directory, timestamp, self.index_interval)
+
+        writer.write(data, timestamp)
+
+    def segments(self, refdes):
+        """
+        :return: Sorted list of segment start times for refdes
+        """
+        try:
+            names = os.listdir(self.directory(refdes))
+        except OSError:
+            return []
+        return sorted(segment_time(name[:-len(SEGMENT_SUFFIX)]) for name in names if name.endswith(SEGMENT_SUFFIX))
+
+    def read(self, refdes, start, end=None):
+        """
+        Return the data recorded for refdes with a receive time in [start, end], stopping at the
+        first frame which would take the total past max_read_bytes
+        """
+        writer = self.writers.get(refdes)
+        if writer is not None:
+            writer.flush()
+
+        starts = self.segments(refdes)
+        first = max(bisect_right(starts, start) - 1, 0)
+        chunks = []
+        remaining = self.max_read_bytes
+        for segment_start in starts[first:]:
+            if end is not None and segment_start > end:
+                break
+            base = os.path.join(self.directory(refdes), segment_name(segment_start))
+            read, full = self._read_segment(base, start, end, chunks, remaining)
+            remaining -= read
+            if full:
+                log.info('Read of %s from %s stopped at %d bytes', refdes, start, self.max_read_bytes - remaining)
+                break
+        return ''.join(chunks)
+
+    @staticmethod
+    def _read_index(path):
+        with open(path, 'rb') as fh:
+            raw = fh.read()
+        count = len(raw) // INDEX_SIZE
+        return [struct.unpack_from(INDEX_FORMAT, raw, i * INDEX_SIZE) for i in xrange(count)]
+
+    def _read_segment(self, base, start, end, chunks, limit):
+        """
+        :return: (bytes appended to chunks, True if the next frame would have exceeded limit)
+        """
+        try:
+            index = self._read_index(base + INDEX_SUFFIX)
+            fh = open(base + SEGMENT_SUFFIX, 'rb')
+        except (IOError, OSError):
+            # segment removed by retention
+            return 0, False
+
+        read = 0
+        with fh:
+            size = os.fstat(fh.fileno()).st_size
+            if size == 0:
+                return 0, False
+            position = bisect_right([entry[0] for entry in index], start) - 1
+            offset = index[position][1] if position >= 0 else 0
+
+            data = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                while offset + FRAME_SIZE <= size:
+                    timestamp, length = struct.unpack_from(FRAME_FORMAT, data, offset)
+                    offset += FRAME_SIZE
+                    if end is not None and timestamp > end:
+                        break
+                    if timestamp >= start:
+                        if read + length > limit:
+                            return read, True
+                        chunks.append(data[offset:offset + length])
+                        read += length
+                    offset += length
+            finally:
+                data.close()
+        return read, False
+
+    def enforce_retention(self, now):
+        """
+        Delete the oldest closed segments which exceed the size or age limits
+        """
+        if self.max_bytes is None and self.max_age is None:
+            return
+
+        active = set(os.path.join(self.directory(refdes), segment_name(writer.start))
+                     for refdes, writer in self.writers.iteritems())
+        segments = []
+        total = 0
+        for refdes in os.listdir(self.root):
+            try:
+                directory = self.directory(refdes)
+            except ValueError:
+                # not a recording (e.g. a dot file)
+                continue
+            starts = self.segments(refdes)
+            for i, segment_start in enumerate(starts):
+                base = os.path.join(directory, segment_name(segment_start))
+                try:
+                    size = os.path.getsize(base + SEGMENT_SUFFIX)
+                except OSError:
+                    continue
+                total += size
+                if base not in active:
+                    # a segment ends where the next one begins
+                    segment_end = starts[i + 1] if i + 1 < len(starts) else os.path.getmtime(base + SEGMENT_SUFFIX)
+                    segments.append((segment_end, size, base))
+
+        for segment_end, size, base in sorted(segments):
+            expired = self.max_age is not None and now - segment_end > self.max_age
+            oversize = self.max_bytes is not None and total > self.max_bytes
+            if not expired and not oversize:
+                break
+            log.info('Removing recorded segment %s', base)
+            for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+                try:
+                    os.remove(base + suffix)
+                except OSError:
+                    pass
+            total -= size
+
+    def close(self):
+        for writer in self.writers.itervalues():
+            writer.close()
+        self.writers = {}
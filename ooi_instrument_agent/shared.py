@@ -0,0 +1,202 @@
+import errno
+import fcntl
+import json
+import os
+import time
+from logging import getLogger
+
+import gevent
+
+from ooi_instrument_agent.common import (get_env_number, get_shared_dir, SHARED_INTERVAL_ENV_KEY,
+                                         DEFAULT_SHARED_INTERVAL)
+
+log = getLogger(__name__)
+
+LOCK_FILE = 'refresher.lock'
+
+
+class SharedCache(object):
+    """
+    Snapshots shared by all worker processes on a host.
+
+    One worker, elected by holding an exclusive flock on directory/refresher.lock, runs the
+    registered refresh functions and atomically writes each result to directory/<name>.json.
+    Every worker reads the files, parsing them again only when they change, so Consul and the
+    drivers see one poller however many workers are running. The directory should be on tmpfs
+    (e.g. /dev/shm). If the refresher exits the kernel releases its lock and another worker
+    takes over within one interval; until then readers see the snapshots age and fall back to
+    fetching for themselves.
+
+    Snapshots are stamped with the time their fetch started. A write withdraws the affected
+    snapshot and records when it did so in directory/<name>.invalidated; a refresh which
+    started before the latest invalidation is discarded rather than published.
+
+    :param directory: Shared directory, None to disable
+    :param interval: Seconds between elections and the default refresh interval
+    """
+    def __init__(self, directory=None, interval=DEFAULT_SHARED_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.refreshers = {}
+        self.entries = {}
+        self.runner = None
+        self._lock = None
+        self._lock_pid = None
+
+    @classmethod
+    def from_environ(cls):
+        return cls(directory=get_shared_dir(),
+                   interval=get_env_number(SHARED_INTERVAL_ENV_KEY, DEFAULT_SHARED_INTERVAL, float))
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    @property
+    def max_age(self):
+        """
+        Age beyond which a snapshot is assumed abandoned by its refresher
+        """
+        return self.interval * 5
+
+    def register(self, name, func, interval=None):
+        """
+        :param func: Function returning a JSON serializable value to publish as name
+        :param interval: Seconds between refreshes, by default the election interval
+        """
+        self.refreshers[name] = {'func': func, 'interval': interval or self.interval, 'due': 0, 'greenlet': None}
+
+    def elect(self):
+        """
+        :return: True if this process is, or has just become, the refresher
+        """
+        if self._lock is not None and self._lock_pid == os.getpid():
+            return True
+        fh = open(os.path.join(self.directory, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            fh.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        log.info('Process %d elected shared cache refresher', os.getpid())
+        self._lock = fh
+        self._lock_pid = os.getpid()
+        return True
+
+    def start(self):
+        """
+        Spawn the greenlet which stands for election and, while elected, runs the refreshers
+        """
+        if not self.enabled or self.runner is not None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        def run():
+            while True:
+                try:
+                    if self.elect():
+                        self.refresh()
+                except Exception as e:
+                    log.warn('Shared cache refresh failed: %s', e)
+                gevent.sleep(self.interval)
+        self.runner = gevent.spawn(run)
+
+    def refresh(self):
+        """
+        Start every refresher which is due and not still running
+        """
+        now = time.time()
+        for name, refresher in self.refreshers.items():
+            running = refresher['greenlet'] is not None and not refresher['greenlet'].ready()
+            if now >= refresher['due'] and not running:
+                refresher['due'] = now + refresher['interval']
+                refresher['greenlet'] = gevent.spawn(self._refresh, name, refresher['func'])
+
+    def _refresh(self, name, func):
+        started = time.time()
+        try:
+            self.publish(name, func(), started)
+        except Exception as e:
+            log.warn('Unable to refresh shared %s: %s', name, e)
+
+    def publish(self, name, value, started=None):
+        """
+        :param started: Time the fetch of value started, now by default
+        :return: False if the value was discarded because a write invalidated it since started
+        """
+        if started is None:
+            started = time.time()
+        if started <= self.invalidated(name):
+            log.debug('Discarding shared %s fetched before the last write', name)
+            return False
+        path = os.path.join(self.directory, '%s.json' % name)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump({'time': started, 'value': value}, fh)
+        os.rename(tmp, path)
+        # a write may have invalidated the snapshot between the check and the rename
+        if started <= self.invalidated(name):
+            self._remove(path)
+            return False
+        return True
+
+    def invalidated(self, name):
+        """
+        :return: Time name was last invalidated, 0 if never
+        """
+        try:
+            with open(os.path.join(self.directory, '%s.invalidated' % name)) as fh:
+                return float(fh.read())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def get(self, name, max_age=None):
+        """
+        :param max_age: Oldest acceptable snapshot in seconds, by default max_age
+        :return: The published value, or None if disabled, missing or too old
+        """
+        if not self.enabled:
+            return None
+        if max_age is None:
+            max_age = self.max_age
+        path = os.path.join(self.directory, '%s.json' % name)
+        try:
+            stat = os.stat(path)
+            version = stat.st_ino, stat.st_mtime
+            cached = self.entries.get(name)
+            if cached is None or cached[0] != version:
+                with open(path) as fh:
+                    cached = self.entries[name] = version, json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+        entry = cached[1]
+        if time.time() - entry['time'] > max_age:
+            return None
+        return entry['value']
+
+    def invalidate(self, name):
+        """
+        Withdraw a snapshot after a write which changes it, until a refresh started afterwards publishes
+        """
+        if not self.enabled:
+            return
+        self.entries.pop(name, None)
+        marker = os.path.join(self.directory, '%s.invalidated' % name)
+        tmp = '%s.%d.tmp' % (marker, os.getpid())
+        try:
+            with open(tmp, 'w') as fh:
+                fh.write(repr(time.time()))
+            os.rename(tmp, marker)
+        except (IOError, OSError) as e:
+            log.warn('Unable to record invalidation of shared %s: %s', name, e)
+        self._remove(os.path.join(self.directory, '%s.json' % name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
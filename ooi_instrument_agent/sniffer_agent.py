@@ -1,17 +1,30 @@
 #!/usr/bin/env python
-import datetime
 import json
 import logging
+import os
+import signal
+import subprocess
+import sys
 from collections import deque
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, succeed
 from twisted.internet.endpoints import UNIXServerEndpoint
 from twisted.internet.protocol import Factory, Protocol, connectionDone, ClientCreator
+from twisted.internet.task import LoopingCall
 from twisted.python import log
 from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
 
-from ooi_instrument_agent.common import get_sniffer_socket
+from ooi_instrument_agent.common import (get_sniffer_socket, get_consul_address, get_env_number, get_shard,
+                                         get_sniffer_shards, MAX_IDLE_ENV_KEY, DEFAULT_MAX_IDLE,
+                                         REAP_INTERVAL_ENV_KEY, DEFAULT_REAP_INTERVAL, MAX_BYTES_ENV_KEY,
+                                         DEFAULT_MAX_BYTES, RECORD_DIR_ENV_KEY, RECORD_ENV_KEY,
+                                         RECORD_MAX_BYTES_ENV_KEY, DEFAULT_RECORD_MAX_BYTES, RECORD_MAX_AGE_ENV_KEY,
+                                         DEFAULT_RECORD_MAX_AGE, SHARD_INDEX_ENV_KEY, get_registry_file)
+from ooi_instrument_agent.discovery import FileDiscovery
+from ooi_instrument_agent.port_agent import PacketDecoder, PacketFilter
+from ooi_instrument_agent.recording import SniffRecorder
 
 
 class ConsulConnectionPool(HTTPConnectionPool):
@@ -23,6 +36,174 @@ pool = ConsulConnectionPool(reactor)
 agent = Agent(reactor, pool=pool)
 
 
+class ConsulLocator(object):
+    """
+    Maintain a cached table of reference designator -> (host, port) for all passing sniff port agents.
+
+    The table is kept current by a Consul blocking query on the sniff-port-agent service. Until the
+    first watch response arrives, lookups fall through to a direct Consul query, with concurrent
+    lookups for the same reference designator coalesced into a single request.
+    """
+    service = 'sniff-port-agent'
+    wait = '5m'
+    retry_delay = 5
+    # seconds within which a blocking query returning an unchanged index did not block
+    min_wait = 1
+
+    def __init__(self, address=None, http_agent=None, clock=reactor):
+        """
+        :param address: host:port of the Consul HTTP API
+        :param http_agent: twisted.web.client.Agent used for requests
+        :param clock: Reactor (or twisted.internet.task.Clock) used to schedule retries
+        """
+        self.address = address or get_consul_address()
+        self.agent = http_agent or agent
+        self.clock = clock
+        self.services = {}
+        self.index = None
+        self.pending = {}
+        self.watching = False
+        self.watch_started = None
+
+    def url(self, **params):
+        query = '&'.join('%s=%s' % (k, v) for k, v in sorted(params.items()))
+        return 'http://%s/v1/health/service/%s?passing=true&%s' % (self.address, self.service, query)
+
+    @staticmethod
+    def parse(services):
+        """
+        Build a reference designator -> (host, port) table from a Consul health response
+        """
+        table = {}
+        for svc in services:
+            addr = svc.get('Node', {}).get('Address')
+            port = svc.get('Service', {}).get('Port')
+            if addr and port:
+                for tag in svc.get('Service', {}).get('Tags') or []:
+                    table[tag] = (addr, port)
+        return table
+
+    def locate(self, refdes):
+        """
+        Return a Deferred which fires with the (host, port) of the sniff port agent for refdes,
+        or (None, None) if no such port agent is registered
+        """
+        if self.index is not None:
+            return succeed(self.services.get(refdes, (None, None)))
+
+        d = Deferred()
+        if refdes in self.pending:
+            self.pending[refdes].append(d)
+            return d
+
+        self.pending[refdes] = [d]
+        query = self.request(self.url(tag=str(refdes)))
+        query.addCallback(lambda result: self.parse(result[1]).get(refdes, (None, None)))
+        query.addErrback(self._lookup_failed, refdes)
+        query.addCallback(self._resolve, refdes)
+        return d
+
+    def _lookup_failed(self, failure, refdes):
+        log.msg('Consul lookup for %r failed: %s' % (refdes, failure.getErrorMessage()))
+        return None, None
+
+    def _resolve(self, result, refdes):
+        for d in self.pending.pop(refdes, []):
+            d.callback(result)
+
+    @inlineCallbacks
+    def request(self, url):
+        """
+        Issue a GET to Consul, returning the X-Consul-Index and the decoded JSON body
+        """
+        log.msg(url)
+        response = yield self.agent.request('GET', url, Headers({}))
+        body = yield readBody(response)
+        index = response.headers.getRawHeaders('X-Consul-Index', [None])[0]
+        returnValue((index, json.loads(body)))
+
+    def start(self):
+        """
+        Begin watching Consul for changes to the sniff port agent services
+        """
+        if not self.watching:
+            self.watching = True
+            self.watch()
+
+    def stop(self):
+        self.watching = False
+
+    def watch(self):
+        if not self.watching:
+            return
+        params = {}
+        if self.index is not None:
+            params = {'index': self.index, 'wait': self.wait}
+        self.watch_started = self.clock.seconds()
+        d = self.request(self.url(**params))
+        d.addCallbacks(self._watch_result, self._watch_failed)
+
+    def _watch_result(self, result):
+        index, services = result
+        previous = self.index
+        # per the Consul docs, reset to 1 (0 would never block) if the index is missing or goes backwards
+        reset = index is None or int(index) < 1 or (previous is not None and int(index) < int(previous))
+        if reset:
+            index = 1
+        self.index = index
+        self.services = self.parse(services)
+
+        # a blocking query which returned at once without a change would otherwise be reissued in a tight loop
+        returned_early = self.clock.seconds() - self.watch_started < self.min_wait
+        if reset or (returned_early and previous is not None and int(index) == int(previous)):
+            log.msg('Consul watch returned without waiting (index %s), retrying in %ds' % (index, self.retry_delay))
+            self.clock.callLater(self.retry_delay, self.watch)
+        else:
+            self.watch()
+
+    def _watch_failed(self, failure):
+        log.msg('Consul watch failed, retrying in %ds: %s' % (self.retry_delay, failure.getErrorMessage()))
+        self.clock.callLater(self.retry_delay, self.watch)
+
+
+class FileLocator(object):
+    """
+    Locate sniff port agents from a registry file (see discovery.FileDiscovery), without Consul.
+    Offers the same interface as ConsulLocator; the file is checked for changes on lookup.
+    """
+    service = 'sniff-port-agent'
+
+    def __init__(self, discovery):
+        self.discovery = discovery
+
+    @property
+    def services(self):
+        index, instances = self.discovery.services(self.service)
+        return dict((tag, (host, port)) for host, port, tags in instances for tag in tags)
+
+    def locate(self, refdes):
+        index, instances = self.discovery.services(self.service, tag=refdes)
+        for host, port, tags in instances:
+            return succeed((host, port))
+        return succeed((None, None))
+
+    def start(self):
+        self.discovery.reload()
+
+    def stop(self):
+        pass
+
+
+def get_locator(clock=reactor):
+    """
+    :return: FileLocator if a registry file is configured, otherwise ConsulLocator
+    """
+    path = get_registry_file()
+    if path:
+        return FileLocator(FileDiscovery(path))
+    return ConsulLocator(clock=clock)
+
+
 class RequestProtocol(Protocol):
     """
     Handle incoming requests for sniffer data
@@ -32,21 +213,37 @@ class RequestProtocol(Protocol):
         """
         Called asynchronously when data is received from this connection
         Expects a JSON-encoded, 2 element list [reference_designator, user_key]
+        or 3 element list [reference_designator, user_key, options] where options is a dictionary
+        of port agent packet filters (see set_filter), or the JSON-encoded string "stats" to
+        request the current session statistics
+
+        If options contains "start" (and optionally "end") as unix timestamps, the data is read
+        from the on-disk recording instead of a live session
 
         Any other input will be ignored
         """
         request = json.loads(data)
-        if len(request) == 2:
-            refdes, user_key = request
+        if request == 'stats':
+            self.transport.write(json.dumps(self.factory.get_stats()))
+            self.transport.loseConnection()
+        elif len(request) in (2, 3):
+            refdes, user_key = request[:2]
+            options = request[2] if len(request) == 3 else None
+            if options and 'start' in options:
+                self.transport.write(self.factory.replay(refdes, options))
+                self.transport.loseConnection()
+                return
             deferred_protocol = self.factory.get_sniffer(refdes, user_key)
-            deferred_protocol.addCallback(self.got_sniffer_protocol, refdes=refdes, user_key=user_key)
+            deferred_protocol.addCallback(self.got_sniffer_protocol, refdes=refdes, user_key=user_key,
+                                          options=options)
 
-    def got_sniffer_protocol(self, protocol, refdes=None, user_key=None):
+    def got_sniffer_protocol(self, protocol, refdes=None, user_key=None, options=None):
         """
         If a valid sniffer protocol is found, ask it for the data currently in the queue
         and return it to the requester. Otherwise, return a connection failed response.
         """
         if protocol is not None:
+            protocol.set_filter(options)
             data = protocol.get_data()
         else:
             data = 'FAILED TO CONNECT (%r, %r)\n' % (refdes, user_key)
@@ -62,9 +259,32 @@ class RequestFactory(Factory):
     """
     protocol = RequestProtocol
 
-    def __init__(self):
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE, max_bytes=DEFAULT_MAX_BYTES, clock=reactor, locator=None,
+                 recorder=None, record=None, shard=None):
+        """
+        :param max_idle: Seconds a sniffer session may go unread before it is reaped
+        :param max_bytes: Maximum number of bytes buffered across all sniffer sessions
+        :param clock: Reactor (or twisted.internet.task.Clock) used for timekeeping
+        :param locator: ConsulLocator or FileLocator used to find sniff port agents
+        :param recorder: SniffRecorder used to record streams to disk
+        :param record: List of reference designators to record, or '*' for all known port agents
+        :param shard: (index, count) of this gateway when running sharded, used to select which
+                      reference designators this process records
+        """
         self.sniff_protocols = {}
+        self.locator = locator or get_locator(clock)
         self.client_creator = ClientCreator(reactor, SniffProtocol)
+        self.record_creator = ClientCreator(reactor, RecordProtocol)
+        self.recorder = recorder
+        self.record = record or []
+        self.recordings = {}
+        self.shard = shard
+        self.max_idle = max_idle
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.buffered_bytes = 0
+        self.reaper = LoopingCall(self.reap)
+        self.reaper.clock = clock
 
     @inlineCallbacks
     def get_sniffer(self, refdes, user_key):
@@ -91,7 +311,10 @@ class RequestFactory(Factory):
                 protocol = yield self.client_creator.connectTCP(host, port, timeout=10)
                 protocol.refdes = refdes
                 protocol.key = user_key
+                protocol.clock = self.clock
+                protocol.timestamp = self.clock.seconds()
                 protocol.lost_connection_callback = self.sniffer_closed(key)
+                protocol.buffer_callback = self.buffer_changed
                 self.sniff_protocols[key] = protocol
             except Exception as e:
                 # unable to connect
@@ -104,32 +327,146 @@ class RequestFactory(Factory):
         returnValue(protocol)
 
     @inlineCallbacks
-    def locate(self, refdes):
+    def start_recording(self, refdes):
         """
-        Query Consul for the IP address and port number of the input reference designator
+        Open a dedicated connection to the sniff port agent for refdes which writes all data to the recorder
         """
-        url = 'http://localhost:8500/v1/health/service/sniff-port-agent?tag=%s&passing=true' % str(refdes)
-        log.msg(url)
-        response = yield agent.request('GET', url)
-        svc = yield readBody(response)
-        svc = json.loads(svc)
-        if len(svc) == 1:
-            svc = svc[0]
-            addr = svc['Node']['Address']
-            port = svc['Service']['Port']
-            returnValue((addr, port))
+        self.recordings[refdes] = None
+        host, port = yield self.locate(refdes)
+        if host is None or port is None:
+            del self.recordings[refdes]
+            returnValue(None)
+
+        log.msg('Recording sniffer data for %r' % refdes)
+        try:
+            protocol = yield self.record_creator.connectTCP(host, port, timeout=10)
+            protocol.refdes = refdes
+            protocol.recorder = self.recorder
+            protocol.clock = self.clock
+            protocol.lost_connection_callback = lambda ignore: self.recordings.pop(refdes, None)
+            self.recordings[refdes] = protocol
+        except Exception as e:
+            del self.recordings[refdes]
+            log.msg('Unable to record sniffer data for %r, Exception: %s' % (refdes, e))
+        returnValue(self.recordings.get(refdes))
+
+    def record_targets(self):
+        targets = self.locator.services.keys() if self.record == '*' else self.record
+        if self.shard is not None:
+            index, count = self.shard
+            targets = [refdes for refdes in targets if get_shard(refdes, count) == index]
+        return targets
+
+    def maintain_recordings(self):
+        """
+        Ensure a recording session exists for every reference designator we have been asked to record
+        """
+        if self.recorder is None:
+            return
+        for refdes in self.record_targets():
+            if refdes not in self.recordings:
+                self.start_recording(refdes)
+        self.recorder.enforce_retention(self.clock.seconds())
+
+    def replay(self, refdes, options):
+        """
+        Read recorded data for refdes between options["start"] and options["end"],
+        applying any port agent packet filters in options
+        """
+        if self.recorder is None:
+            return 'RECORDING NOT ENABLED\n'
+        try:
+            data = self.recorder.read(refdes, options['start'], options.get('end'))
+        except ValueError as e:
+            return '%s\n' % e
+
+        filter_options = dict((k, v) for k, v in options.iteritems() if k not in ('start', 'end'))
+        if filter_options:
+            data = PacketFilter.from_options(filter_options).render(PacketDecoder().feed(data))
+        return data
 
-        returnValue((None, None))
+    def locate(self, refdes):
+        """
+        Find the IP address and port number of the input reference designator
+        """
+        return self.locator.locate(refdes)
 
     def sniffer_closed(self, key):
         """
         Closure which will allow the specified sniffer protocol to
         clean itself up from the dictionary when disconnected.
         """
-        def inner(ignore):
-            del self.sniff_protocols[key]
+        def inner(protocol):
+            self.sniff_protocols.pop(key, None)
+            self.buffer_changed(protocol, -protocol.buffered)
+            protocol.buffered = 0
         return inner
 
+    def sessions(self):
+        """
+        Return all connected sniffer protocols (excluding sessions still being established)
+        """
+        return [p for p in self.sniff_protocols.itervalues() if p is not None]
+
+    def buffer_changed(self, protocol, delta):
+        """
+        Track the total number of bytes buffered across all sessions.
+        If the global budget is exceeded, evict the least recently read sessions until we are back under budget.
+        """
+        self.buffered_bytes += delta
+        if delta <= 0 or self.buffered_bytes <= self.max_bytes:
+            return
+
+        for victim in sorted(self.sessions(), key=lambda p: p.timestamp):
+            if self.buffered_bytes <= self.max_bytes:
+                break
+            log.msg('Sniffer memory budget exceeded (%d > %d), evicting %r %r' %
+                    (self.buffered_bytes, self.max_bytes, victim.refdes, victim.key))
+            self.evict(victim)
+
+    def evict(self, protocol):
+        """
+        Drop the buffered data for this session and close it
+        """
+        self.buffered_bytes -= protocol.buffered
+        protocol.buffer.clear()
+        protocol.buffered = 0
+        if protocol.transport is not None:
+            protocol.transport.loseConnection()
+
+    def reap(self):
+        """
+        Close any sniffer session which has not been read within max_idle seconds
+        and restart any dropped recording sessions.
+        Called periodically by the reaper LoopingCall.
+        """
+        now = self.clock.seconds()
+        for protocol in self.sessions():
+            if now - protocol.timestamp > self.max_idle:
+                log.msg('Reaping idle sniffer session for %r %r' % (protocol.refdes, protocol.key))
+                protocol.transport.loseConnection()
+        try:
+            self.maintain_recordings()
+        except Exception:
+            # an exception here would stop the reaper LoopingCall for good
+            log.err(None, 'Failed to maintain recordings')
+
+    def get_stats(self):
+        """
+        Return a summary of all active sniffer sessions
+        """
+        now = self.clock.seconds()
+        sessions = [{'refdes': p.refdes,
+                     'key': p.key,
+                     'buffered_bytes': p.buffered,
+                     'last_read_age': now - p.timestamp}
+                    for p in self.sessions()]
+        return {'sessions': sessions,
+                'buffered_bytes': self.buffered_bytes,
+                'max_bytes': self.max_bytes,
+                'max_idle': self.max_idle,
+                'recording': sorted(k for k, v in self.recordings.iteritems() if v is not None)}
+
 
 class SniffProtocol(Protocol):
     """
@@ -138,35 +475,71 @@ class SniffProtocol(Protocol):
     """
     def __init__(self, maxlen=1000):
         self.buffer = deque(maxlen=maxlen)
+        self.buffered = 0
         self.refdes = None
         self.key = None
+        self.clock = reactor
         self.timestamp = None
         self.lost_connection_callback = None
+        self.buffer_callback = None
+        self.decoder = None
+        self.packet_filter = None
+
+    def set_filter(self, options):
+        """
+        Enable or disable port agent packet decoding for this session.
+        Options apply to data received from this point forward.
+
+        :param options: None to forward raw bytes, otherwise a dictionary containing any of
+                        types: list of packet types (names or numbers) to keep
+                        after: only keep packets with a port agent (NTP) timestamp after this value
+                        payload: if true, strip the port agent headers
+        """
+        if not options:
+            self.decoder = None
+            self.packet_filter = None
+            return
+
+        if self.decoder is None:
+            self.decoder = PacketDecoder()
+        self.packet_filter = PacketFilter.from_options(options)
 
     def get_data(self):
         """
         Return the current contents of the internal buffer and update the timestamp.
         """
-        self.timestamp = datetime.datetime.utcnow()
+        self.timestamp = self.clock.seconds()
         return_list = []
         for i in xrange(len(self.buffer)):
             return_list.append(self.buffer.popleft())
+        self._buffer_changed(-self.buffered)
         return ''.join(return_list)
 
     def dataReceived(self, data):
         """
         Called asynchronously when data is received from this connection.
-        Append the received data to the internal buffer.
-        Compare the current time to the last time the buffer was read,
-        if this exceeds our maximum time, drop the connection.
+        Append the received data to the internal buffer, accounting for any data dropped from the
+        head of the buffer. Idle sessions are closed by the RequestFactory reaper.
+
+        If a packet filter is set, only complete packets which pass the filter are buffered.
         """
+        if self.decoder is not None:
+            data = self.packet_filter.render(self.decoder.feed(data))
+            if not data:
+                return
+
+        delta = len(data)
+        if len(self.buffer) == self.buffer.maxlen:
+            delta -= len(self.buffer[0])
         self.buffer.append(data)
-        now = datetime.datetime.utcnow()
         if self.timestamp is None:
-            self.timestamp = now
+            self.timestamp = self.clock.seconds()
+        self._buffer_changed(delta)
 
-        if now - self.timestamp > datetime.timedelta(minutes=1):
-            self.transport.loseConnection()
+    def _buffer_changed(self, delta):
+        self.buffered += delta
+        if callable(self.buffer_callback):
+            self.buffer_callback(self, delta)
 
     def connectionLost(self, reason=connectionDone):
         log.msg('Disconnected from sniffer port for %r %r' % (self.refdes, self.key))
@@ -174,10 +547,32 @@ class SniffProtocol(Protocol):
             self.lost_connection_callback(self)
 
 
+class RecordProtocol(Protocol):
+    """
+    Protocol object which writes all data received from the target port agent to a SniffRecorder
+    """
+    def __init__(self):
+        self.refdes = None
+        self.recorder = None
+        self.clock = reactor
+        self.lost_connection_callback = None
+
+    def dataReceived(self, data):
+        self.recorder.write(self.refdes, data, self.clock.seconds())
+
+    def connectionLost(self, reason=connectionDone):
+        log.msg('Disconnected from recording sniffer port for %r' % self.refdes)
+        if callable(self.lost_connection_callback):
+            self.lost_connection_callback(self)
+
+
 class SnifferGateway(object):
-    def __init__(self, sock_name):
+    def __init__(self, sock_name, reap_interval=DEFAULT_REAP_INTERVAL, **kwargs):
+        self.factory = RequestFactory(**kwargs)
+        self.factory.reaper.start(reap_interval, now=False)
+        self.factory.locator.start()
         self.server = UNIXServerEndpoint(reactor, sock_name)
-        self.server.listen(RequestFactory())
+        self.server.listen(self.factory)
 
 
 def configure_logging():
@@ -189,8 +584,58 @@ def configure_logging():
     observer.start()
 
 
+def configure_recording():
+    """
+    Build the recorder and list of reference designators to record from the environment.
+    Recording is disabled unless SNIFF_RECORD_DIR is set.
+    """
+    root = os.environ.get(RECORD_DIR_ENV_KEY)
+    if not root:
+        return {}
+
+    record = os.environ.get(RECORD_ENV_KEY, '*')
+    if record != '*':
+        record = [refdes.strip() for refdes in record.split(',') if refdes.strip()]
+
+    recorder = SniffRecorder(root,
+                             max_bytes=get_env_number(RECORD_MAX_BYTES_ENV_KEY, DEFAULT_RECORD_MAX_BYTES),
+                             max_age=get_env_number(RECORD_MAX_AGE_ENV_KEY, DEFAULT_RECORD_MAX_AGE, float))
+    return {'recorder': recorder, 'record': record}
+
+
+def run_shards(shards):
+    """
+    Start one gateway process per shard and wait for them to exit.
+    Each child is told its shard index through the environment and listens on its own socket.
+    """
+    children = []
+    for index in range(shards):
+        env = dict(os.environ)
+        env[SHARD_INDEX_ENV_KEY] = str(index)
+        children.append(subprocess.Popen([sys.executable, '-m', 'ooi_instrument_agent.sniffer_agent'], env=env))
+
+    def terminate(signum, frame):
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    return max(child.wait() for child in children)
+
+
 if __name__ == '__main__':
     configure_logging()
+    shards = get_sniffer_shards()
+    shard_index = get_env_number(SHARD_INDEX_ENV_KEY, None)
+    if shards > 1 and shard_index is None:
+        exit(run_shards(shards))
+
     sockfile = get_sniffer_socket()
-    sg = SnifferGateway(sockfile)
+    sg = SnifferGateway(sockfile,
+                        reap_interval=get_env_number(REAP_INTERVAL_ENV_KEY, DEFAULT_REAP_INTERVAL, float),
+                        max_idle=get_env_number(MAX_IDLE_ENV_KEY, DEFAULT_MAX_IDLE, float),
+                        max_bytes=get_env_number(MAX_BYTES_ENV_KEY, DEFAULT_MAX_BYTES),
+                        shard=(shard_index, shards) if shard_index is not None else None,
+                        **configure_recording())
     exit(reactor.run())
@@ -0,0 +1,33 @@
+import json
+import unittest
+
+import mock
+
+import ooi_instrument_agent
+from ooi_instrument_agent.discovery import ConsulDiscovery
+from ooi_instrument_agent.test.responses import health_response
+from ooi_instrument_agent.views import page
+
+
+class ViewTestCase(unittest.TestCase):
+    """
+    Serves the views against a mocked Consul and lock manager with no locks held, restoring the
+    replaced page attributes afterwards.
+    """
+    # further page attributes a subclass replaces, restored on tearDown
+    page_attributes = ()
+
+    def setUp(self):
+        ooi_instrument_agent.app.config['TESTING'] = True
+        self.app = ooi_instrument_agent.app.test_client()
+        names = ('consul', 'discovery', 'lock_manager') + self.page_attributes
+        self.saved = dict((name, getattr(page, name)) for name in names)
+        page.consul = mock.Mock()
+        page.consul.health.service.return_value = 7, json.loads(health_response)
+        page.discovery = ConsulDiscovery(page.consul)
+        page.lock_manager = mock.MagicMock()
+        page.lock_manager.__getitem__.return_value = None
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(page, name, value)
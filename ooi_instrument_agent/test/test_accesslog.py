@@ -0,0 +1,100 @@
+import json
+import logging
+import unittest
+from StringIO import StringIO
+
+import mock
+
+from ooi_instrument_agent.accesslog import AccessLog, LogQueue, QueueHandler, access_log
+from ooi_instrument_agent.metrics import LOG_RECORDS_DROPPED
+from ooi_instrument_agent.test import ViewTestCase
+
+
+class LogQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = StringIO()
+        self.target = logging.StreamHandler(self.stream)
+        self.target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.logger = logging.getLogger('ooi_instrument_agent.test.queued')
+        self.logger.propagate = False
+        self.logger.handlers = [self.target]
+
+    def test_queued(self):
+        queue = LogQueue(size=10, interval=60)
+        queue.install([self.logger])
+        self.addCleanup(queue.flusher.kill)
+        self.logger.warn('one %d', 1)
+        self.logger.warn('two')
+        self.assertEqual(self.stream.getvalue(), '')
+        queue.flush()
+        self.assertEqual(self.stream.getvalue(), 'WARNING one 1\nWARNING two\n')
+
+    def test_rendered_when_queued(self):
+        handler = QueueHandler([self.target])
+        self.logger.handlers = [handler]
+        values = [1]
+        self.logger.warn('values %r', values)
+        values.append(2)
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            self.logger.exception('failed')
+        self.assertIsNone(handler.queue[1].exc_info)
+        handler.drain()
+        output = self.stream.getvalue()
+        self.assertTrue(output.startswith('WARNING values [1]\nERROR failed\nTraceback'))
+        self.assertIn('ValueError: bad', output)
+
+    def test_full(self):
+        handler = QueueHandler([self.target], size=1)
+        self.logger.handlers = [handler]
+        before = LOG_RECORDS_DROPPED.samples.get((), 0)
+        self.logger.warn('kept')
+        self.logger.warn('dropped')
+        handler.drain()
+        self.assertEqual(self.stream.getvalue(), 'WARNING kept\n')
+        self.assertEqual(LOG_RECORDS_DROPPED.samples[()], before + 1)
+
+    def test_disabled(self):
+        queue = LogQueue(size=0)
+        queue.install([self.logger])
+        self.assertEqual(self.logger.handlers, [self.target])
+
+
+class AccessLogTest(unittest.TestCase):
+    def test_sampled(self):
+        log = AccessLog(get_sample=0.25)
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEqual(log.sampled('GET', 200), 0)
+            self.assertEqual(log.sampled('GET', 500), 1)
+            self.assertEqual(log.sampled('POST', 200), 1)
+        with mock.patch('random.random', return_value=0.1):
+            self.assertEqual(log.sampled('GET', 200), 0.25)
+
+
+class AccessLogViewTest(ViewTestCase):
+    def setUp(self):
+        super(AccessLogViewTest, self).setUp()
+        self.stream = StringIO()
+        self.handler = logging.StreamHandler(self.stream)
+        access_log.addHandler(self.handler)
+        self.level = access_log.level
+        access_log.setLevel(logging.INFO)
+
+    def tearDown(self):
+        super(AccessLogViewTest, self).tearDown()
+        access_log.removeHandler(self.handler)
+        access_log.setLevel(self.level)
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_record(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.get_resource_state.return_value = {'value': 'DRIVER_STATE_COMMAND'}
+        self.app.get('instrument/api/RS10ENGC-XX00X-00-SPKIRA001/state?max_age=0')
+        record = json.loads(self.stream.getvalue().splitlines()[-1])
+        self.assertEqual(record['refdes'], 'RS10ENGC-XX00X-00-SPKIRA001')
+        self.assertEqual(record['endpoint'], 'instrument.resource_state')
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['priority'], 'bulk')
+        self.assertIn('consul', record)
+        self.assertNotIn('sample', record)
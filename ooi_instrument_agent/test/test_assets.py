@@ -0,0 +1,102 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+import ooi_instrument_agent
+from ooi_instrument_agent.assets import AssetStore
+from ooi_instrument_agent.views import page
+from six import BytesIO
+
+SCRIPT = 'angular.module("agent", []);\n' * 100
+
+
+class AssetStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'js'))
+        with open(os.path.join(self.root, 'index.html'), 'w') as fh:
+            fh.write('<html></html>')
+        with open(os.path.join(self.root, 'js', 'app.js'), 'w') as fh:
+            fh.write(SCRIPT)
+
+        self.original = page.assets, page.consul, page.discovery, page.lock_manager
+        # keep the worker setup from rescanning the default asset directory
+        page.consul = mock.Mock()
+        page.assets = AssetStore(self.root, max_age=600)
+        self.assertEqual(page.assets.scan(), 2)
+        ooi_instrument_agent.app.config['TESTING'] = True
+        self.app = ooi_instrument_agent.app.test_client()
+
+    def tearDown(self):
+        page.assets, page.consul, page.discovery, page.lock_manager = self.original
+        shutil.rmtree(self.root)
+
+    def test_precompressed(self):
+        asset = page.assets.get('js/app.js')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(asset.gzipped)).read(), SCRIPT)
+        # too small to be worth compressing
+        self.assertIsNone(page.assets.get('index.html').gzipped)
+
+    def test_serve(self):
+        rv = self.app.get('instrument/js/app.js')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, SCRIPT)
+        self.assertEqual(rv.headers['Cache-Control'], 'public, max-age=600')
+        self.assertIn('javascript', rv.content_type)
+        self.assertNotIn('Content-Encoding', rv.headers)
+
+        rv = self.app.get('instrument/js/app.js', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(rv.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(rv.data, page.assets.get('js/app.js').gzipped)
+
+        rv = self.app.get('instrument/app')
+        self.assertEqual(rv.data, '<html></html>')
+        self.assertEqual(rv.headers['Cache-Control'], 'no-cache')
+
+        self.assertEqual(self.app.get('instrument/js/missing.js').status_code, 404)
+        self.assertEqual(self.app.get('instrument/css/app.js').status_code, 404)
+
+    def test_not_modified(self):
+        etag = self.app.get('instrument/js/app.js').headers['ETag']
+        rv = self.app.get('instrument/js/app.js', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, '')
+        self.assertEqual(rv.headers['ETag'], etag)
+
+        # as revalidated by a browser which was sent a compressed copy
+        rv = self.app.get('instrument/js/app.js', headers={'If-None-Match': 'W/' + etag})
+        self.assertEqual(rv.status_code, 304)
+
+        rv = self.app.get('instrument/js/app.js', headers={'If-None-Match': '"stale"'})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_gzip_etag(self):
+        identity = self.app.get('instrument/js/app.js').headers['ETag']
+        gzipped = self.app.get('instrument/js/app.js', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        self.assertEqual(gzipped, identity[:-1] + '-gz"')
+
+        # either tag is current, the 304 carries the tag of the encoding asked for
+        rv = self.app.get('instrument/js/app.js', headers={'If-None-Match': gzipped})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers['ETag'], identity)
+        rv = self.app.get('instrument/js/app.js', headers={'If-None-Match': identity, 'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers['ETag'], gzipped)
+
+    def test_reload(self):
+        filename = os.path.join(self.root, 'js', 'app.js')
+        with open(filename, 'w') as fh:
+            fh.write('changed')
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.app.get('instrument/js/app.js').data, SCRIPT)
+
+        page.assets.reload = True
+        self.assertEqual(self.app.get('instrument/js/app.js').data, 'changed')
+        os.remove(filename)
+        self.assertEqual(self.app.get('instrument/js/app.js').status_code, 404)
@@ -0,0 +1,195 @@
+import os
+import unittest
+
+import consul
+import mock
+from gevent.pywsgi import WSGIServer
+
+from ooi_instrument_agent.bench.consul_stub import ConsulStub, parse_wait
+from ooi_instrument_agent.bench.fleet import Fleet
+from ooi_instrument_agent.bench.load import percentile, summarize, compare
+from ooi_instrument_agent.client import (ZmqDriverClient, TimeoutException, SocketPool, socket_pool, DriverCodecs,
+                                         msgpack)
+from ooi_instrument_agent.common import CONSUL_ENV_KEY
+from ooi_instrument_agent.discovery import ConsulDiscovery
+from ooi_instrument_agent.lock import LockManager, Locked
+from ooi_instrument_agent.utils import list_drivers, get_host_and_port
+from ooi_instrument_agent.views import page, initialize_worker
+
+
+class FleetTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = Fleet(2, parameters=3).start()
+
+    def tearDown(self):
+        self.fleet.stop()
+
+    def test_commands(self):
+        driver = self.fleet.drivers[0]
+        with ZmqDriverClient(driver.host, driver.port) as client:
+            self.assertEqual(client.ping()['value'], 'ping from %s' % driver.refdes)
+            self.assertEqual(client.get_resource_state()['value'], 'DRIVER_STATE_COMMAND')
+            self.assertEqual(client.get_resource('DRIVER_PARAMETER_ALL')['value'],
+                             {'PARAM_00': 0, 'PARAM_01': 0, 'PARAM_02': 0})
+            client.set_resource({'PARAM_01': '5'}, timeout=None)
+            self.assertEqual(client.get_resource(['PARAM_01'])['value'], {'PARAM_01': 5})
+            self.assertEqual(client.execute('DRIVER_EVENT_ACQUIRE_SAMPLE')['value'], [None, 'OK'])
+        # the metadata is fetched once per connection
+        self.assertEqual(driver.calls['overall_state'], 1)
+
+    def test_skip_unchanged(self):
+        driver = self.fleet.drivers[0]
+        with ZmqDriverClient(driver.host, driver.port) as client:
+            response = client.set_resource({'PARAM_00': 0, 'PARAM_01': '0'}, timeout=None, skip_unchanged=True)
+            self.assertEqual(response['skipped'], ['PARAM_00', 'PARAM_01'])
+            self.assertNotIn('set_resource', driver.calls)
+
+            response = client.set_resource({'PARAM_00': 0, 'PARAM_01': 7}, timeout=None, skip_unchanged=True)
+            self.assertEqual(response['skipped'], ['PARAM_00'])
+            self.assertEqual(response['value']['PARAM_01'], 7)
+            self.assertEqual(driver.calls['set_resource'], 1)
+
+    def test_timeout_injection(self):
+        driver = self.fleet.drivers[1]
+        driver.timeout_rate = 1.0
+        with ZmqDriverClient(driver.host, driver.port) as client:
+            with self.assertRaises(TimeoutException):
+                client.ping(timeout=50)
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    @mock.patch('ooi_instrument_agent.client.msgpack_is_compiled', return_value=True)
+    def test_msgpack_negotiated(self, _):
+        driver = self.fleet.drivers[0]
+        codecs = DriverCodecs('msgpack')
+        with ZmqDriverClient(driver.host, driver.port, codecs=codecs) as client:
+            self.assertEqual(client.ping()['cmd']['accept'], ['msgpack'])
+            self.assertEqual(codecs.choose(driver.host, driver.port), ('msgpack', False))
+            response = client.get_resource('DRIVER_PARAMETER_ALL')
+        self.assertEqual(response['cmd'], {'cmd': 'get_resource', 'args': ['DRIVER_PARAMETER_ALL'], 'kwargs': {}})
+        self.assertEqual(response['value'], {'PARAM_00': 0, 'PARAM_01': 0, 'PARAM_02': 0})
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    @mock.patch('ooi_instrument_agent.client.msgpack_is_compiled', return_value=True)
+    def test_msgpack_fallback(self, _):
+        driver = self.fleet.drivers[1]
+        driver.accept_msgpack = False
+        codecs = DriverCodecs('msgpack')
+        with ZmqDriverClient(driver.host, driver.port, codecs=codecs) as client:
+            self.assertEqual(client.ping()['value'], 'ping from %s' % driver.refdes)
+            self.assertEqual(codecs.choose(driver.host, driver.port), ('json', False))
+            self.assertNotIn('accept', client.ping()['cmd'])
+
+        # a driver which stops understanding msgpack is renegotiated after one timeout
+        codecs.record(driver.host, driver.port, 'msgpack')
+        with ZmqDriverClient(driver.host, driver.port, codecs=codecs) as client:
+            with self.assertRaises(TimeoutException):
+                client.ping(timeout=50)
+        self.assertEqual(codecs.choose(driver.host, driver.port), ('json', True))
+
+
+class ConsulStubTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = ConsulStub()
+        self.server = WSGIServer(('127.0.0.1', 0), self.stub, log=None)
+        self.server.start()
+        self.consul = consul.Consul(port=self.server.server_port)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_health(self):
+        self.stub.register('instrument_driver', 'DRIVER_A', '10.0.0.1', 4000)
+        self.stub.register('instrument_driver', 'DRIVER_B', '10.0.0.2', 4001)
+        self.assertEqual(list_drivers(ConsulDiscovery(self.consul)), ['DRIVER_A', 'DRIVER_B'])
+        self.assertEqual(get_host_and_port(ConsulDiscovery(self.consul), 'DRIVER_B'), ('10.0.0.2', 4001))
+
+    def test_blocking_query(self):
+        index, _ = self.consul.health.service('instrument_driver')
+        self.assertEqual(self.consul.health.service('instrument_driver', index=index, wait='10ms')[0], index)
+
+    def test_locks(self):
+        locks = LockManager(self.consul, prefix='bench/locks')
+        locks['DRIVER_A'] = 'me'
+        self.assertEqual(locks['DRIVER_A'], 'me')
+        with self.assertRaises(Locked):
+            locks['DRIVER_A'] = 'you'
+        self.assertEqual(dict(locks.iteritems()), {'DRIVER_A': 'me'})
+        del locks['DRIVER_A']
+        self.assertIsNone(locks['DRIVER_A'])
+        self.assertEqual(len(locks), 0)
+
+    def test_parse_wait(self):
+        self.assertEqual(parse_wait('5m'), 300)
+        self.assertEqual(parse_wait('10s'), 10)
+        self.assertEqual(parse_wait('250ms'), 0.25)
+        self.assertEqual(parse_wait(None, 7), 7)
+
+
+class LoadTest(unittest.TestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_compare(self):
+        baseline = summarize({'state': {'latencies': [0.01] * 100, 'errors': 0, 'bytes': 0}}, 10)
+        same = summarize({'state': {'latencies': [0.011] * 100, 'errors': 0, 'bytes': 0}}, 10)
+        slower = summarize({'state': {'latencies': [0.02] * 50, 'errors': 0, 'bytes': 0}}, 10)
+        self.assertEqual(compare(same, baseline), [])
+        self.assertEqual(len(compare(slower, baseline)), 2)
+
+
+class SocketPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = Fleet(1).start()
+        self.driver = self.fleet.drivers[0]
+        self.pool = SocketPool(max_idle=1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.fleet.stop()
+
+    def test_reuse(self):
+        self.pool.prewarm(self.driver.host, self.driver.port)
+        self.assertEqual(len(self.pool), 1)
+        with ZmqDriverClient(self.driver.host, self.driver.port, pool=self.pool) as client:
+            socket = client._connect()
+            self.assertEqual(len(self.pool), 0)
+            client.ping()
+            client.ping()
+        self.assertEqual(len(self.pool), 1)
+        with ZmqDriverClient(self.driver.host, self.driver.port, pool=self.pool) as client:
+            self.assertIs(client._connect(), socket)
+
+    def test_discard_after_timeout(self):
+        self.driver.timeout_rate = 1.0
+        with ZmqDriverClient(self.driver.host, self.driver.port, pool=self.pool) as client:
+            with self.assertRaises(TimeoutException):
+                client.ping(timeout=50)
+        # a REQ socket awaiting a reply cannot be reused
+        self.assertEqual(len(self.pool), 0)
+
+
+class WorkerInitTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = Fleet(3).start()
+        self.stub = ConsulStub()
+        self.fleet.register(self.stub)
+        self.server = WSGIServer(('127.0.0.1', 0), self.stub, log=None)
+        self.server.start()
+        self.saved = page.consul, page.discovery, page.lock_manager, page.warmed
+
+    def tearDown(self):
+        page.consul, page.discovery, page.lock_manager, page.warmed = self.saved
+        socket_pool.close()
+        self.server.stop()
+        self.fleet.stop()
+
+    def test_initialize_worker(self):
+        socket_pool.close()
+        with mock.patch.dict(os.environ, {CONSUL_ENV_KEY: '127.0.0.1:%d' % self.server.server_port}):
+            timings = initialize_worker()
+        self.assertEqual(sorted(timings), ['setup', 'warm_up'])
+        self.assertTrue(page.warmed)
+        self.assertEqual(len(socket_pool), 3)
@@ -0,0 +1,95 @@
+import shutil
+import tempfile
+import unittest
+
+import gevent
+import gevent.event
+import mock
+
+from ooi_instrument_agent.cache import DriverCache
+from ooi_instrument_agent.shared import SharedCache
+
+
+class DriverCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DriverCache(max_entries=3)
+        self.fetch = mock.Mock(side_effect=lambda: {'value': self.fetch.call_count})
+
+    def test_max_age(self):
+        self.assertEqual(self.cache.get('a', 'get_resource', ['ALL'], self.fetch, 10), {'value': 1})
+        self.assertEqual(self.cache.get('a', 'get_resource', ['ALL'], self.fetch, 10), {'value': 1})
+        # different arguments are different entries
+        self.assertEqual(self.cache.get('a', 'get_resource', ['X'], self.fetch, 10), {'value': 2})
+        # zero always fetches
+        self.assertEqual(self.cache.get('a', 'get_resource', ['ALL'], self.fetch, 0), {'value': 3})
+
+        with mock.patch('time.time', return_value=1e12):
+            self.assertEqual(self.cache.get('a', 'get_resource', ['ALL'], self.fetch, 10), {'value': 4})
+
+    def test_default_max_age(self):
+        self.cache.default_max_age = 10
+        self.cache.get('a', 'get_resource_state', (), self.fetch)
+        self.cache.get('a', 'get_resource_state', (), self.fetch)
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_lru(self):
+        for refdes in 'abc':
+            self.cache.get(refdes, 'get_resource_state', (), self.fetch, 10)
+        self.cache.get('a', 'get_resource_state', (), self.fetch, 10)
+        self.cache.get('d', 'get_resource_state', (), self.fetch, 10)
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(sorted(key[0] for key in self.cache.entries), ['a', 'c', 'd'])
+
+    def test_coalesce(self):
+        def slow():
+            gevent.sleep(0.01)
+            return self.fetch()
+
+        greenlets = [gevent.spawn(self.cache.get, 'a', 'get_resource_state', (), slow, 10) for _ in range(5)]
+        gevent.joinall(greenlets)
+        self.assertEqual([g.value for g in greenlets], [{'value': 1}] * 5)
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_error_not_cached(self):
+        fetch = mock.Mock(side_effect=[ValueError(), {'value': 1}])
+        self.assertRaises(ValueError, self.cache.get, 'a', 'get_resource_state', (), fetch, 10)
+        self.assertEqual(self.cache.get('a', 'get_resource_state', (), fetch, 10), {'value': 1})
+
+    def test_invalidate(self):
+        self.cache.get('a', 'get_resource_state', (), self.fetch, 10)
+        self.cache.get('b', 'get_resource_state', (), self.fetch, 10)
+        self.cache.invalidate('a')
+        self.assertEqual([key[0] for key in self.cache.entries], ['b'])
+
+    def test_invalidate_during_fetch(self):
+        started = gevent.event.Event()
+
+        def slow():
+            started.set()
+            gevent.sleep(0.01)
+            return self.fetch()
+
+        greenlet = gevent.spawn(self.cache.get, 'a', 'get_resource_state', (), slow, 10)
+        started.wait()
+        self.cache.invalidate('a')
+        # a reader arriving after the write does not join the stale fetch
+        self.assertEqual(self.cache.get('a', 'get_resource_state', (), self.fetch, 10), {'value': 1})
+        greenlet.join()
+        self.assertEqual(greenlet.value, {'value': 2})
+        self.assertEqual(self.cache.get('a', 'get_resource_state', (), self.fetch, 10), {'value': 1})
+
+    def test_invalidate_shared(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # one cache per worker, sharing only the directory
+        first = DriverCache(shared=SharedCache(directory))
+        second = DriverCache(shared=SharedCache(directory))
+        first.get('a', 'get_resource_state', (), self.fetch, 10)
+        second.get('a', 'get_resource_state', (), self.fetch, 10)
+        second.get('b', 'get_resource_state', (), self.fetch, 10)
+        self.assertEqual(self.fetch.call_count, 3)
+
+        first.invalidate('a')
+        self.assertEqual(second.get('a', 'get_resource_state', (), self.fetch, 10), {'value': 4})
+        self.assertEqual(second.get('a', 'get_resource_state', (), self.fetch, 10), {'value': 4})
+        self.assertEqual(second.get('b', 'get_resource_state', (), self.fetch, 10), {'value': 3})
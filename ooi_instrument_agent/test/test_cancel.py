@@ -0,0 +1,153 @@
+import json
+import socket
+import unittest
+
+import gevent
+import mock
+
+from ooi_instrument_agent.bench.fleet import Fleet
+from ooi_instrument_agent.cache import DriverCache
+from ooi_instrument_agent.cancel import RequestWatch, disconnected
+from ooi_instrument_agent.client import ZmqDriverClient, RequestCancelled, SocketPool
+from ooi_instrument_agent.metrics import ZMQ_CANCELLED, ZMQ_WAIT_RECOVERED, REQUESTS_CANCELLED
+from ooi_instrument_agent.priority import PriorityClasses
+from ooi_instrument_agent.test import ViewTestCase
+from ooi_instrument_agent.views import page
+
+
+class RequestWatchTest(unittest.TestCase):
+    def test_disconnected(self):
+        ours, theirs = socket.socketpair()
+        self.assertFalse(disconnected(ours))
+        theirs.close()
+        self.assertTrue(disconnected(ours))
+        ours.close()
+
+    def test_half_closed(self):
+        ours, theirs = socket.socketpair()
+        # the client has sent its request and still awaits the reply
+        theirs.shutdown(socket.SHUT_WR)
+        self.assertFalse(disconnected(ours))
+        theirs.close()
+        self.assertTrue(disconnected(ours))
+        ours.close()
+
+    def test_deadline(self):
+        def serve():
+            watch = RequestWatch(gevent.getcurrent(), 'test', deadline=0).start()
+            try:
+                gevent.sleep(5)
+            except RequestCancelled as e:
+                return e.message, watch.cancelled
+        self.assertEqual(gevent.spawn(serve).get(timeout=1), ({'cancelled': 'deadline'}, 'deadline'))
+
+    def test_disconnect(self):
+        ours, theirs = socket.socketpair()
+
+        def serve():
+            RequestWatch(gevent.getcurrent(), 'test', sock=ours, interval=0.01).start()
+            gevent.sleep(5)
+        greenlet = gevent.spawn(serve)
+        gevent.sleep(0.05)
+        self.assertFalse(greenlet.ready())
+        theirs.close()
+        greenlet.join(1)
+        self.assertIsInstance(greenlet.exception, RequestCancelled)
+        ours.close()
+
+    def test_stopped(self):
+        watch = RequestWatch(gevent.getcurrent(), 'test', deadline=0).start()
+        watch.stop()
+        gevent.sleep(0.01)
+        self.assertIsNone(watch.cancelled)
+
+    def test_stopped_after_firing(self):
+        def serve():
+            watch = RequestWatch(gevent.getcurrent(), 'test', deadline=0)
+            # the watch fires as the request finishes, before it is stopped
+            watch.cancel('deadline')
+            watch.stop()
+            gevent.sleep(0.01)
+            return watch.cancelled
+        self.assertEqual(gevent.spawn(serve).get(timeout=1), 'deadline')
+
+
+class CancelledRpcTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = Fleet(1, latency=5).start()
+        self.driver = self.fleet.drivers[0]
+
+    def tearDown(self):
+        self.fleet.stop()
+
+    def test_abandoned(self):
+        pool = SocketPool()
+        recovered = ZMQ_WAIT_RECOVERED.samples.get(('process_echo',), 0)
+        cancelled = ZMQ_CANCELLED.samples.get(('process_echo',), 0)
+
+        def ping():
+            with ZmqDriverClient(self.driver.host, self.driver.port, pool=pool) as client:
+                client.ping(timeout=10000)
+        greenlet = gevent.spawn(ping)
+        gevent.sleep(0.05)
+        gevent.kill(greenlet, RequestCancelled({'cancelled': 'disconnected'}))
+        greenlet.join(1)
+        self.assertIsInstance(greenlet.exception, RequestCancelled)
+        self.assertEqual(ZMQ_CANCELLED.samples[('process_echo',)], cancelled + 1)
+        self.assertGreater(ZMQ_WAIT_RECOVERED.samples[('process_echo',)] - recovered, 9)
+        # the socket still awaiting a reply is not returned to the pool
+        self.assertEqual(len(pool), 0)
+
+    def test_coalesced_reader_refetches(self):
+        cache = DriverCache()
+        fetch = mock.Mock(return_value='fresh')
+
+        def slow():
+            gevent.sleep(5)
+        first = gevent.spawn(cache.get, 'A', 'get_resource_state', (), slow, 10)
+        gevent.sleep(0)
+        second = gevent.spawn(cache.get, 'A', 'get_resource_state', (), fetch, 10)
+        gevent.sleep(0.01)
+        gevent.kill(first, RequestCancelled())
+        self.assertEqual(second.get(timeout=1), 'fresh')
+
+
+class CancelViewTest(ViewTestCase):
+    def setUp(self):
+        super(CancelViewTest, self).setUp()
+        page.driver_cache.entries.clear()
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_deadline(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.get_resource_state.side_effect = lambda *args, **kwargs: gevent.sleep(5)
+        before = REQUESTS_CANCELLED.samples.get(('instrument.get_drivers_status', 'deadline'), 0)
+        rv = gevent.spawn(self.app.get, 'instrument/api/status?deadline=0.05&max_age=0').get(timeout=2)
+        self.assertEqual(rv.status_code, 504)
+        self.assertEqual(json.loads(rv.data), {'cancelled': 'deadline'})
+        self.assertEqual(REQUESTS_CANCELLED.samples[('instrument.get_drivers_status', 'deadline')], before + 1)
+
+        # the greenlets already spawned are killed when the deadline passes while waiting for the pool
+        killed = []
+
+        def slow(*args, **kwargs):
+            try:
+                gevent.sleep(5)
+            except gevent.GreenletExit:
+                killed.append(True)
+                raise
+        instance.get_resource_state.side_effect = slow
+        saved, page.priorities = page.priorities, PriorityClasses(bulk=1)
+        try:
+            rv = gevent.spawn(self.app.get, 'instrument/api/status?deadline=0.05&max_age=0').get(timeout=2)
+        finally:
+            page.priorities = saved
+        self.assertEqual(rv.status_code, 504)
+        gevent.sleep(0.01)
+        self.assertEqual(killed, [True])
+
+        # without a deadline nothing is watched
+        instance.get_resource_state.side_effect = None
+        instance.get_resource_state.return_value = {'value': 'DRIVER_STATE_COMMAND'}
+        rv = self.app.get('instrument/api/status?max_age=0')
+        self.assertEqual(rv.status_code, 200)
@@ -1,8 +1,10 @@
+import json
 import unittest
 import mock
 import zmq
 
-from ooi_instrument_agent.client import ZmqDriverClient, TimeoutException
+from ooi_instrument_agent.client import ZmqDriverClient, TimeoutException, DriverCodecs, msgpack
+from ooi_instrument_agent.metrics import ZMQ_TIMEOUTS
 
 
 class ClientTest(unittest.TestCase):
@@ -13,6 +15,7 @@ class ClientTest(unittest.TestCase):
     def assert_rpc_call(mock_socket, method, command, args, kwargs, timeout=1000, poll=True):
         instance = mock_socket.return_value
         instance.poll.return_value = poll
+        instance.recv.return_value = '{}'
 
         client = ZmqDriverClient(None, None)
         client_method = getattr(client, method, None)
@@ -46,6 +49,13 @@ class ClientTest(unittest.TestCase):
         with self.assertRaises(TimeoutException):
             self.assert_rpc_call(mocked_socket, 'ping', 'process_echo', tuple(), {}, poll=False)
 
+    @mock.patch('ooi_instrument_agent.client.zmq._Context._socket_class', autospec=zmq.sugar.Socket)
+    def test_timeout_counted(self, mocked_socket):
+        before = ZMQ_TIMEOUTS.samples.get(('process_echo',), 0)
+        with self.assertRaises(TimeoutException):
+            self.assert_rpc_call(mocked_socket, 'ping', 'process_echo', tuple(), {}, poll=False)
+        self.assertEqual(ZMQ_TIMEOUTS.samples[('process_echo',)], before + 1)
+
     @mock.patch('ooi_instrument_agent.client.zmq._Context._socket_class', autospec=zmq.sugar.Socket)
     def test_init_params(self, mocked_socket):
         self.assert_rpc_call(mocked_socket, 'init_params', 'set_init_params', ({'parameters': {}},), {})
@@ -66,6 +76,32 @@ class ClientTest(unittest.TestCase):
     def test_set_resource(self, mocked_socket):
         self.assert_rpc_call(mocked_socket, 'set_resource', 'set_resource', ({'param': 'value'},), {})
 
+    @mock.patch('ooi_instrument_agent.client.zmq._Context._socket_class', autospec=zmq.sugar.Socket)
+    def test_set_resource_skip_unchanged(self, mocked_socket):
+        instance = mocked_socket.return_value
+        instance.poll.return_value = True
+        metadata = {'parameters': {'A': {'visibility': 'READ_WRITE', 'value': {'type': 'string'}},
+                                   'B': {'visibility': 'READ_WRITE', 'value': {'type': 'string'}}}}
+        instance.recv.side_effect = [
+            json.dumps({'value': {'metadata': metadata, 'parameters': {'A': 'a', 'B': 'b'}}}),
+            json.dumps({'type': 'DRIVER_ASYNC_RESULT', 'value': None}),
+            json.dumps({'value': {'B': 'new'}}),
+        ]
+
+        client = ZmqDriverClient(None, None)
+        # current values come from the overall state, only the changed parameter is sent
+        response = client.set_resource({'A': 'a', 'B': 'new'}, skip_unchanged=True, timeout=1000)
+        self.assertEqual(response['skipped'], ['A'])
+        # once a write has been sent the values in the overall state are stale, ask the driver
+        response = client.set_resource({'B': 'new'}, skip_unchanged=True, timeout=1000)
+        self.assertEqual(response['skipped'], ['B'])
+        self.assertEqual(response['value'], {'B': 'new'})
+
+        sent = [call[0][0] for call in instance.send_json.call_args_list]
+        self.assertEqual([(msg['cmd'], msg['args']) for msg in sent],
+                         [('overall_state', ()), ('set_resource', ({'B': 'new'},)),
+                          ('get_resource', (['B'],))])
+
     @mock.patch('ooi_instrument_agent.client.zmq._Context._socket_class', autospec=zmq.sugar.Socket)
     def test_get_discover(self, mocked_socket):
         self.assert_rpc_call(mocked_socket, 'discover', 'discover_state', tuple(), {})
@@ -77,3 +113,27 @@ class ClientTest(unittest.TestCase):
     def test_client_repr(self):
         client = ZmqDriverClient(None, None)
         self.assertEqual(repr(client), 'ZmqDriverClient(None, None)')
+
+
+class DriverCodecsTest(unittest.TestCase):
+    def test_json(self):
+        self.assertEqual(DriverCodecs('json').choose('host', 1), ('json', False))
+        self.assertEqual(DriverCodecs('bogus').preferred, 'json')
+
+    @mock.patch('ooi_instrument_agent.client.msgpack_is_compiled', return_value=False)
+    def test_fallback_not_negotiated(self, _):
+        self.assertEqual(DriverCodecs('msgpack').preferred, 'json')
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    @mock.patch('ooi_instrument_agent.client.msgpack_is_compiled', return_value=True)
+    def test_probe(self, _):
+        codecs = DriverCodecs('msgpack', probe_interval=60)
+        self.assertEqual(codecs.choose('host', 1), ('json', True))
+        codecs.record('host', 1, 'json')
+        self.assertEqual(codecs.choose('host', 1), ('json', False))
+        with mock.patch('time.time', return_value=1e12):
+            self.assertEqual(codecs.choose('host', 1), ('json', True))
+        codecs.record('host', 1, 'msgpack')
+        self.assertEqual(codecs.choose('host', 1), ('msgpack', False))
+        codecs.forget('host', 1)
+        self.assertEqual(codecs.choose('host', 1), ('json', True))
@@ -0,0 +1,48 @@
+import os
+import unittest
+
+import mock
+
+from ooi_instrument_agent.common import get_shard, get_sniffer_socket, get_sniffer_sockets
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.refdes = ['RS10ENGC-XX00X-00-SPKIRA%03d' % i for i in range(1000)]
+
+    def test_shard_range(self):
+        for refdes in self.refdes:
+            self.assertIn(get_shard(refdes, 4), range(4))
+        self.assertEqual(set(get_shard(refdes, 1) for refdes in self.refdes), {0})
+
+    def test_shard_balance(self):
+        counts = [0] * 4
+        for refdes in self.refdes:
+            counts[get_shard(refdes, 4)] += 1
+        for count in counts:
+            self.assertGreater(count, 150)
+
+    def test_shard_consistent(self):
+        # growing from 4 to 5 shards should only move keys to the new shard
+        moved = 0
+        for refdes in self.refdes:
+            before, after = get_shard(refdes, 4), get_shard(refdes, 5)
+            if before != after:
+                self.assertEqual(after, 4)
+                moved += 1
+        self.assertLess(moved, 300)
+
+    def test_socket_unsharded(self):
+        with mock.patch.dict(os.environ, {'SNIFF_UNIX_SOCKFILE': '/tmp/test.sock'}):
+            self.assertEqual(get_sniffer_socket('refdes'), '/tmp/test.sock')
+            self.assertEqual(get_sniffer_sockets(), ['/tmp/test.sock'])
+
+    def test_socket_sharded(self):
+        with mock.patch.dict(os.environ, {'SNIFF_UNIX_SOCKFILE': '/tmp/test.sock', 'SNIFF_SHARDS': '3'}):
+            refdes = self.refdes[0]
+            self.assertEqual(get_sniffer_socket(refdes), '/tmp/test.sock.%d' % get_shard(refdes, 3))
+            self.assertEqual(get_sniffer_socket(), '/tmp/test.sock')
+            self.assertEqual(get_sniffer_sockets(), ['/tmp/test.sock.0', '/tmp/test.sock.1', '/tmp/test.sock.2'])
+
+            with mock.patch.dict(os.environ, {'SNIFF_SHARD_INDEX': '1'}):
+                self.assertEqual(get_sniffer_socket(), '/tmp/test.sock.1')
@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ooi_instrument_agent.common import REGISTRY_FILE_ENV_KEY
+from ooi_instrument_agent.discovery import ConsulDiscovery, FileDiscovery, get_discovery, write_registry
+from ooi_instrument_agent.test.responses import health_response
+from ooi_instrument_agent.utils import get_client, get_driver_registry, get_port_agent
+
+
+class ConsulDiscoveryTest(unittest.TestCase):
+    def test_services(self):
+        consul_mock = mock.Mock()
+        consul_mock.health.service.return_value = (5, json.loads(health_response))
+        index, instances = ConsulDiscovery(consul_mock).services('instrument_driver', tag='X')
+        consul_mock.health.service.assert_called_with('instrument_driver', tag='X', passing=True)
+        self.assertEqual(index, 5)
+        self.assertEqual(instances[0], (u'128.6.240.39', 42558, [u'RS10ENGC-XX00X-00-SPKIRA001']))
+
+
+class FileDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'registry.json')
+        write_registry(self.path, {
+            'instrument_driver': {'A': ['10.0.0.1', 4001], 'B': ['10.0.0.2', 4002]},
+            'port-agent': {'A': ['10.0.0.1', 5001]},
+            'sniff-port-agent': {'A': ['10.0.0.1', 5002]},
+        })
+        self.discovery = FileDiscovery(self.path, check_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_services(self):
+        index, instances = self.discovery.services('instrument_driver')
+        self.assertEqual(instances, [('10.0.0.1', 4001, ['A']), ('10.0.0.2', 4002, ['B'])])
+        self.assertEqual(self.discovery.services('instrument_driver', tag='B')[1], [('10.0.0.2', 4002, ['B'])])
+        self.assertEqual(self.discovery.services('instrument_driver', tag='C')[1], [])
+        self.assertEqual(self.discovery.services('da-port-agent')[1], [])
+        # the index depends only on the contents
+        self.assertEqual(FileDiscovery(self.path).services('port-agent')[0], index)
+
+    def test_reload(self):
+        index = self.discovery.services('instrument_driver')[0]
+        write_registry(self.path, {'instrument_driver': {'C': ['10.0.0.3', 4003]}})
+        index2, instances = self.discovery.services('instrument_driver')
+        self.assertEqual(instances, [('10.0.0.3', 4003, ['C'])])
+        self.assertNotEqual(index, index2)
+
+        # a broken file leaves the last good registry in place
+        with open(self.path, 'w') as fh:
+            fh.write('{"instrument_driver": ')
+        self.assertEqual(self.discovery.services('instrument_driver'), (index2, instances))
+
+        # as does an entry which is not a host and port
+        write_registry(self.path, {'instrument_driver': {'C': ['10.0.0.3', 4003], 'D': '10.0.0.4:4004'}})
+        self.assertEqual(self.discovery.services('instrument_driver'), (index2, instances))
+        write_registry(self.path, {'instrument_driver': {'D': ['10.0.0.4']}})
+        self.assertEqual(self.discovery.services('instrument_driver'), (index2, instances))
+
+    def test_throttled(self):
+        discovery = FileDiscovery(self.path, check_interval=60)
+        discovery.services('instrument_driver')
+        write_registry(self.path, {})
+        self.assertEqual(len(discovery.services('instrument_driver')[1]), 2)
+
+    def test_utils(self):
+        registry = get_driver_registry(self.discovery)
+        self.assertEqual(registry['drivers'], ['A', 'B'])
+        self.assertEqual(registry['addresses'], {'A': ['10.0.0.1', 4001], 'B': ['10.0.0.2', 4002]})
+        client = get_client(self.discovery, 'B')
+        self.assertEqual((client.host, client.port), ('10.0.0.2', 4002))
+        self.assertEqual(get_port_agent(self.discovery, 'A'), {'data': {'host': '10.0.0.1', 'port': 5001},
+                                                               'sniff': {'host': '10.0.0.1', 'port': 5002}})
+
+    def test_get_discovery(self):
+        with mock.patch.dict(os.environ, {REGISTRY_FILE_ENV_KEY: self.path}):
+            self.assertIsInstance(get_discovery(mock.Mock()), FileDiscovery)
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertIsInstance(get_discovery(mock.Mock()), ConsulDiscovery)
@@ -0,0 +1,102 @@
+import gzip
+import json
+import unittest
+import zlib
+
+import mock
+from flask import Flask, Response
+from six import BytesIO
+
+from ooi_instrument_agent.encoding import Compressor, get_encoder, json_response, conditional_json_response
+
+app = Flask(__name__)
+
+
+class EncoderTest(unittest.TestCase):
+    def test_compact(self):
+        encoder = get_encoder('json')
+        self.assertEqual(encoder({'a': [1, 2]}), '{"a":[1,2]}')
+
+    def test_fallback(self):
+        self.assertIs(get_encoder('nonesuch'), get_encoder('json'))
+        with mock.patch.dict('sys.modules', {'ujson': None}):
+            self.assertIs(get_encoder('ujson'), get_encoder('json'))
+
+    def test_json_response(self):
+        with app.test_request_context():
+            response = json_response({'error': 'x'}, status=409)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(json.loads(response.get_data()), {'error': 'x'})
+
+    def test_conditional(self):
+        reply = {'value': {'b': 1, 'a': [1.5, None]}, 'type': 'DRIVER_ASYNC_RESULT', 'time': 1000.25}
+        with app.test_request_context():
+            response = conditional_json_response(reply)
+        self.assertEqual(json.loads(response.get_data()), reply)
+        etag = response.get_etag()[0]
+
+        # the volatile time is not part of the tag, and key order does not matter
+        with app.test_request_context():
+            self.assertEqual(conditional_json_response(dict(reversed(list(reply.items())), time=2000)).get_etag()[0],
+                             etag)
+        with mock.patch('ooi_instrument_agent.encoding.dumps') as dumps:
+            with app.test_request_context(headers={'If-None-Match': 'W/"%s"' % etag}):
+                dumps.side_effect = get_encoder('json')
+                response = conditional_json_response(reply)
+        self.assertEqual(response.status_code, 304)
+        # encoded once for the tag, and no 200 body is built
+        self.assertEqual([call[0][0] for call in dumps.call_args_list],
+                         [dict((k, v) for k, v in reply.items() if k != 'time')])
+
+        with app.test_request_context():
+            self.assertEqual(json.loads(conditional_json_response({'time': 1}).get_data()), {'time': 1})
+            self.assertEqual(json.loads(conditional_json_response([1, 2]).get_data()), [1, 2])
+
+
+class CompressorTest(unittest.TestCase):
+    def setUp(self):
+        self.compressor = Compressor(min_size=100)
+        self.payload = {'RS10ENGC-XX00X-00-SIMDRV%03d' % i: 'DRIVER_STATE_COMMAND' for i in range(100)}
+
+    def compress(self, response, accept):
+        with app.test_request_context(headers={'Accept-Encoding': accept}):
+            return self.compressor.compress(response)
+
+    def test_negotiate(self):
+        response = self.compress(json_response(self.payload), 'gzip, deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(json.loads(gzip.GzipFile(fileobj=BytesIO(response.get_data())).read()), self.payload)
+        self.assertEqual(response.content_length, len(response.get_data()))
+
+        response = self.compress(json_response(self.payload), 'gzip;q=0.5, deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(response.get_data())), self.payload)
+
+        response = self.compress(json_response(self.payload), 'identity')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_skipped(self):
+        response = self.compress(json_response({'small': True}), 'gzip')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = self.compress(Response('x' * 1000, mimetype='image/png'), 'gzip')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = Response('x' * 1000, mimetype='text/css', headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(self.compress(response, 'gzip').get_data(), 'x' * 1000)
+
+    def test_weak_etag(self):
+        response = json_response(self.payload)
+        response.set_etag('abc')
+        response = self.compress(response, 'gzip')
+        self.assertEqual(response.get_etag(), ('abc', True))
+
+    def test_streamed(self):
+        chunks = ['{"chunk": %d}\n' % i for i in range(50)]
+        response = self.compress(Response(iter(chunks), mimetype='application/json'), 'gzip')
+        self.assertIsNone(response.content_length)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        body = ''.join(response.response)
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(body)).read(), ''.join(chunks))
@@ -0,0 +1,76 @@
+import unittest
+
+import gevent
+import mock
+
+from ooi_instrument_agent.client import TimeoutException
+from ooi_instrument_agent.heartbeat import HeartbeatMonitor
+
+
+class HeartbeatMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.monitor = HeartbeatMonitor(interval=10, failures=2, concurrency=2)
+
+    def test_record(self):
+        self.assertEqual(self.monitor.status('a')['alive'], None)
+        self.monitor.record('a', 0.01)
+        self.assertEqual(self.monitor.status('a')['alive'], True)
+        self.assertEqual(self.monitor.status('a')['latency'], 0.01)
+
+        self.monitor.record('a', None)
+        self.assertFalse(self.monitor.is_dead('a'))
+        self.monitor.record('a', None)
+        self.assertTrue(self.monitor.is_dead('a'))
+        self.assertEqual(self.monitor.status('a')['alive'], False)
+        # the last good reply is kept
+        self.assertEqual(self.monitor.status('a')['latency'], 0.01)
+
+        self.monitor.record('a', 0.02)
+        self.assertFalse(self.monitor.is_dead('a'))
+
+    def test_stale(self):
+        self.monitor.record('a', None)
+        self.monitor.record('a', None)
+        with mock.patch('time.time', return_value=1e12):
+            self.assertFalse(self.monitor.is_dead('a'))
+            self.assertEqual(self.monitor.status('a')['alive'], None)
+
+    @mock.patch('ooi_instrument_agent.heartbeat.ZmqDriverClient')
+    def test_check_all(self, client_mock):
+        running = []
+        peak = []
+
+        def ping(host):
+            running.append(host)
+            peak.append(len(running))
+            gevent.sleep(0.01)
+            running.remove(host)
+            if host == 'dead':
+                raise TimeoutException()
+
+        def make_client(host, port, refdes=None, pool=None):
+            client = mock.MagicMock()
+            client.__enter__.return_value = client
+            # ignore the heartbeats of monitors started by other tests
+            if refdes in addresses:
+                client.ping.side_effect = lambda timeout=None: ping(host)
+            return client
+
+        client_mock.side_effect = make_client
+        self.monitor.record('gone', 0.01)
+
+        addresses = dict(('driver%d' % i, ('host', 1000 + i)) for i in range(5))
+        addresses['dead'] = ('dead', 2000)
+        self.monitor.check_all(addresses)
+        self.monitor.check_all(addresses)
+
+        self.assertEqual(len(peak), 12)
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(sorted(self.monitor.drivers), sorted(addresses))
+        self.assertTrue(self.monitor.is_dead('dead'))
+        self.assertFalse(self.monitor.is_dead('driver0'))
+
+    def test_disabled(self):
+        monitor = HeartbeatMonitor(interval=0)
+        monitor.start(mock.Mock())
+        self.assertIsNone(monitor.runner)
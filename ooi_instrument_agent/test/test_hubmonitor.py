@@ -0,0 +1,94 @@
+import json
+import unittest
+
+import gevent
+import mock
+from gevent import monkey
+
+import ooi_instrument_agent
+from ooi_instrument_agent.hubmonitor import HubMonitor, count_greenlets, open_fds
+from ooi_instrument_agent.metrics import HUB_BLOCKED
+from ooi_instrument_agent.views import page
+
+
+def block_the_hub(seconds):
+    # time.sleep is patched to be cooperative
+    monkey.get_original('time', 'sleep')(seconds)
+
+
+class HubMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.monitor = HubMonitor(threshold=0.05, interval=0.01)
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def test_blocked(self):
+        before = HUB_BLOCKED.samples.get((), 0)
+        self.monitor.start()
+        gevent.sleep(0.05)
+        self.assertEqual(list(self.monitor.blocks), [])
+
+        block_the_hub(0.3)
+        # the monitor thread only records the report, it is logged and counted once the hub runs
+        self.assertEqual(len(self.monitor.unreported), 1)
+        self.assertEqual(HUB_BLOCKED.samples.get((), 0), before)
+        gevent.sleep(0.05)
+        self.assertEqual(len(self.monitor.unreported), 0)
+        self.assertEqual(len(self.monitor.blocks), 1)
+        self.assertIn('block_the_hub', self.monitor.blocks[0]['stack'])
+        # other monitors started by earlier tests may count the block too
+        self.assertGreater(HUB_BLOCKED.samples[()], before)
+        self.assertGreater(self.monitor.max_lag, 0.2)
+
+    @mock.patch('ooi_instrument_agent.hubmonitor.count_greenlets')
+    def test_count(self, count_mock):
+        # a slow heap walk
+        count_mock.side_effect = lambda: block_the_hub(0.2) or (5, 2)
+        self.monitor.start()
+        gevent.sleep(0.3)
+        self.assertEqual(count_mock.call_count, 1)
+        self.assertEqual(self.monitor.greenlet_counts()['live'], 5)
+        # taken between lag measurements, and not reported as a block
+        self.assertEqual(list(self.monitor.blocks), [])
+        self.assertLess(self.monitor.max_lag, 0.1)
+
+    def test_stop(self):
+        self.monitor.start()
+        self.monitor.stop()
+        self.assertFalse(self.monitor.running)
+        self.assertIsNone(self.monitor.ticker)
+
+    def test_disabled(self):
+        monitor = HubMonitor(threshold=0)
+        monitor.start()
+        self.assertIsNone(monitor.ticker)
+
+    def test_counts(self):
+        greenlet = gevent.spawn(gevent.sleep, 1)
+        gevent.sleep(0)
+        live, spawned = count_greenlets()
+        self.assertGreaterEqual(spawned, 1)
+        self.assertGreaterEqual(live, spawned)
+        greenlet.kill()
+        fds, limit = open_fds()
+        self.assertGreater(limit, 0)
+
+
+class RuntimeViewTest(unittest.TestCase):
+    def setUp(self):
+        ooi_instrument_agent.app.config['TESTING'] = True
+        self.app = ooi_instrument_agent.app.test_client()
+        self.saved = page.consul
+        page.consul = mock.Mock()
+
+    def tearDown(self):
+        page.consul = self.saved
+
+    def test_runtime(self):
+        rv = self.app.get('instrument/admin/runtime')
+        data = json.loads(rv.data)
+        self.assertGreater(data['greenlets']['live'], 0)
+        self.assertIn('pooled', data['zmq_sockets'])
+        self.assertIn('open', data['fds'])
+        self.assertEqual(data['hub']['threshold'], page.hub_monitor.threshold)
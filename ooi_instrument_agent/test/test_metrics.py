@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from flask import g
+
+import ooi_instrument_agent
+from ooi_instrument_agent import metrics
+from ooi_instrument_agent.metrics import Registry, merge, render, collect, write_snapshot, timed
+from ooi_instrument_agent.test.responses import health_response
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = self.registry.counter('test_total', 'A counter', ['command'])
+        self.gauge = self.registry.gauge('test_in_flight', 'A gauge')
+        self.histogram = self.registry.histogram('test_seconds', 'A histogram', ['command'], buckets=(1, 5))
+
+    def test_render(self):
+        self.counter.inc(command='ping')
+        self.counter.inc(2, command='ping')
+        self.gauge.inc()
+        self.histogram.observe(0.5, command='ping')
+        self.histogram.observe(3, command='ping')
+        self.histogram.observe(10, command='ping')
+
+        text = render(merge([(self.registry.snapshot(), True)]))
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{command="ping"} 3', text)
+        self.assertIn('test_in_flight 1', text)
+        self.assertIn('test_seconds_bucket{command="ping",le="1.0"} 1', text)
+        self.assertIn('test_seconds_bucket{command="ping",le="5.0"} 2', text)
+        self.assertIn('test_seconds_bucket{command="ping",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_sum{command="ping"} 13.5', text)
+        self.assertIn('test_seconds_count{command="ping"} 3', text)
+
+    def test_gauge_track(self):
+        with self.gauge.track():
+            self.assertEqual(self.gauge.samples[()], 1)
+        self.assertEqual(self.gauge.samples[()], 0)
+
+    def test_merge(self):
+        self.counter.inc(command='ping')
+        self.gauge.inc()
+        self.histogram.observe(0.5, command='ping')
+        snapshot = json.loads(json.dumps(self.registry.snapshot()))
+
+        merged = merge([(snapshot, True), (snapshot, False)])
+        self.assertEqual(merged['test_total']['samples'][('ping',)], 2)
+        # gauges from exited processes are dropped
+        self.assertEqual(merged['test_in_flight']['samples'][()], 1)
+        self.assertEqual(merged['test_seconds']['samples'][('ping',)], [[2, 0], 1.0, 2])
+
+    def test_collect_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            other = Registry()
+            other.counter('test_total', 'A counter', ['command']).inc(5, command='ping')
+            with open(os.path.join(directory, '%d.json' % os.getppid()), 'w') as fh:
+                json.dump(other.snapshot(), fh)
+
+            self.counter.inc(command='ping')
+            write_snapshot(directory, self.registry)
+            text = collect(directory, self.registry)
+            self.assertIn('test_total{command="ping"} 6', text)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_timed_phase(self):
+        with ooi_instrument_agent.app.test_request_context('/'):
+            with timed(self.histogram, 'zmq', command='ping'):
+                pass
+            with timed(self.histogram, 'zmq', command='ping'):
+                pass
+            self.assertIn('zmq', g.phases)
+        self.assertEqual(self.histogram.samples[('ping',)][2], 2)
+
+
+class MetricsViewTest(unittest.TestCase):
+    def setUp(self):
+        ooi_instrument_agent.app.config['TESTING'] = True
+        self.app = ooi_instrument_agent.app.test_client()
+
+    @mock.patch('ooi_instrument_agent.views.Consul')
+    def test_metrics(self, consul_mock):
+        instance = consul_mock.return_value
+        instance.health.service.return_value = 1, json.loads(health_response)
+
+        self.app.get('instrument/api')
+        rv = self.app.get('instrument/metrics')
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        self.assertIn('agent_request_seconds_count{endpoint="instrument.get_drivers",method="GET",status="200"}',
+                      rv.data)
+        self.assertIn('agent_request_phase_seconds_count{endpoint="instrument.get_drivers",phase="consul"}', rv.data)
+        self.assertIn('agent_consul_seconds_count{operation="list_drivers"}', rv.data)
+        self.assertEqual(metrics.REQUESTS_IN_FLIGHT.samples.get(('instrument.get_drivers',)), 0)
@@ -0,0 +1,63 @@
+import unittest
+
+from ooi_instrument_agent.port_agent import (PacketDecoder, PacketFilter, make_packet, HEADER_SIZE,
+                                             DATA_FROM_INSTRUMENT, DATA_FROM_DRIVER, HEARTBEAT)
+
+
+class PacketDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.packets = [make_packet(DATA_FROM_INSTRUMENT, 'sample 1\r\n', 100.5),
+                        make_packet(DATA_FROM_DRIVER, 'command\r\n', 101.0),
+                        make_packet(HEARTBEAT, '', 102.25)]
+        self.stream = ''.join(self.packets)
+
+    def test_decode(self):
+        decoder = PacketDecoder()
+        packets = decoder.feed(self.stream)
+        self.assertEqual([p.type for p in packets], [DATA_FROM_INSTRUMENT, DATA_FROM_DRIVER, HEARTBEAT])
+        self.assertEqual([p.time for p in packets], [100.5, 101.0, 102.25])
+        self.assertEqual(packets[0].payload, 'sample 1\r\n')
+        self.assertEqual(packets[1].raw, self.packets[1])
+        self.assertEqual(len(decoder.buffer), 0)
+
+    def test_decode_incremental(self):
+        decoder = PacketDecoder()
+        packets = []
+        for i in xrange(len(self.stream)):
+            packets.extend(decoder.feed(self.stream[i]))
+            # never hold more than one partial packet
+            self.assertLess(len(decoder.buffer), max(len(p) for p in self.packets))
+        self.assertEqual([p.raw for p in packets], self.packets)
+
+    def test_resync(self):
+        decoder = PacketDecoder()
+        packets = decoder.feed('garbage\xa3' + self.stream)
+        self.assertEqual([p.raw for p in packets], self.packets)
+        self.assertEqual(decoder.dropped, 8)
+
+    def test_partial_header(self):
+        decoder = PacketDecoder()
+        self.assertEqual(decoder.feed(self.packets[0][:HEADER_SIZE - 1]), [])
+        self.assertEqual(len(decoder.feed(self.packets[0][HEADER_SIZE - 1:])), 1)
+
+
+class PacketFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.packets = PacketDecoder().feed(make_packet(DATA_FROM_INSTRUMENT, 'A', 100) +
+                                            make_packet(DATA_FROM_DRIVER, 'B', 101) +
+                                            make_packet(DATA_FROM_INSTRUMENT, 'C', 102))
+
+    def test_all(self):
+        self.assertEqual(PacketFilter(payload=True).render(self.packets), 'ABC')
+        self.assertEqual(PacketFilter().render(self.packets), ''.join(p.raw for p in self.packets))
+
+    def test_types(self):
+        self.assertEqual(PacketFilter(types=['DATA_FROM_INSTRUMENT'], payload=True).render(self.packets), 'AC')
+        self.assertEqual(PacketFilter(types=DATA_FROM_DRIVER, payload=True).render(self.packets), 'B')
+
+    def test_after(self):
+        self.assertEqual(PacketFilter(after=100, payload=True).render(self.packets), 'BC')
+
+    def test_from_options(self):
+        packet_filter = PacketFilter.from_options({'types': [1], 'after': 101, 'payload': 1})
+        self.assertEqual(packet_filter.render(self.packets), 'C')
@@ -0,0 +1,68 @@
+import json
+import unittest
+
+import gevent
+import mock
+
+from ooi_instrument_agent.metrics import QUEUE_WAIT, QUEUE_REJECTED
+from ooi_instrument_agent.priority import PriorityClasses, PriorityClass, Overloaded
+from ooi_instrument_agent.test import ViewTestCase
+from ooi_instrument_agent.views import page
+
+
+class PriorityClassTest(unittest.TestCase):
+    def test_classify(self):
+        classes = PriorityClasses()
+        self.assertEqual(classes.classify('instrument.execute').name, 'interactive')
+        self.assertEqual(classes.classify('instrument.get_drivers_status').name, 'bulk')
+        self.assertEqual(classes.classify('instrument.get_metrics').name, 'other')
+
+    def test_queue(self):
+        priority = PriorityClass('test', 1, queue_timeout=1)
+        priority.acquire()
+        waiter = gevent.spawn(priority.acquire)
+        gevent.sleep(0.01)
+        self.assertFalse(waiter.ready())
+        priority.release()
+        waiter.join(1)
+        self.assertTrue(waiter.successful())
+        self.assertEqual(QUEUE_WAIT.samples[('test',)][2], 2)
+
+    def test_timeout(self):
+        priority = PriorityClass('test-timeout', 1, queue_timeout=0.01)
+        priority.acquire()
+        with self.assertRaises(Overloaded):
+            priority.acquire()
+        self.assertEqual(QUEUE_REJECTED.samples[('test-timeout',)], 1)
+
+    def test_unbounded(self):
+        priority = PriorityClass('other', 0)
+        for _ in range(10):
+            priority.acquire()
+
+
+class PriorityViewTest(ViewTestCase):
+    page_attributes = ('priorities',)
+
+    def setUp(self):
+        super(PriorityViewTest, self).setUp()
+        page.priorities = PriorityClasses(interactive=1, bulk=1, queue_timeout=0.01)
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_reserved(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.get_resource_state.return_value = {'value': 'DRIVER_STATE_COMMAND'}
+        instance.ping.return_value = {'value': 'pong'}
+        url = 'instrument/api/RS10ENGC-XX00X-00-SPKIRA001'
+        self.assertEqual(self.app.get(url + '/state').status_code, 200)
+
+        # with every bulk slot taken, polling is refused but operators still get through
+        page.priorities['bulk'].acquire()
+        rv = self.app.get(url + '/state')
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(json.loads(rv.data), {'overloaded': 'bulk'})
+        self.assertIn('Retry-After', rv.headers)
+        self.assertEqual(self.app.get(url + '/ping').status_code, 200)
+        self.assertEqual(self.app.get('instrument/api').status_code, 200)
+        page.priorities['bulk'].release()
+        self.assertEqual(self.app.get(url + '/state').status_code, 200)
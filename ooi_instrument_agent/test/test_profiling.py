@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import ooi_instrument_agent
+from ooi_instrument_agent.profiling import RequestProfiler
+from ooi_instrument_agent.test.responses import health_response
+from ooi_instrument_agent.views import page
+
+
+class ProfilingTest(unittest.TestCase):
+    def setUp(self):
+        ooi_instrument_agent.app.config['TESTING'] = True
+        self.app = ooi_instrument_agent.app.test_client()
+        self.directory = tempfile.mkdtemp()
+        self.original = page.profiler
+
+    def tearDown(self):
+        page.profiler = self.original
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        profiler = RequestProfiler()
+        self.assertFalse(profiler.enabled)
+        # sampling requires somewhere to store the profiles
+        self.assertFalse(RequestProfiler(sample=1).enabled)
+
+    @mock.patch('ooi_instrument_agent.views.Consul')
+    def test_explicit(self, consul_mock):
+        consul_mock.return_value.health.service.return_value = 1, json.loads(health_response)
+        page.profiler = RequestProfiler(token='secret')
+
+        rv = self.app.get('instrument/api', headers={'X-Agent-Profile': 'secret'})
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        self.assertIn('function calls', rv.data)
+
+        rv = self.app.get('instrument/api?profile=secret')
+        self.assertIn('function calls', rv.data)
+
+        rv = self.app.get('instrument/api', headers={'X-Agent-Profile': 'wrong'})
+        self.assertEqual(rv.content_type, 'application/json')
+
+    @mock.patch('ooi_instrument_agent.views.Consul')
+    def test_one_at_a_time(self, consul_mock):
+        consul_mock.return_value.health.service.return_value = 1, json.loads(health_response)
+        page.profiler = RequestProfiler(token='secret')
+
+        # another request in this worker is being profiled
+        page.profiler.active = mock.Mock()
+        rv = self.app.get('instrument/api', headers={'X-Agent-Profile': 'secret'})
+        self.assertEqual(rv.content_type, 'application/json')
+
+        page.profiler.active = None
+        rv = self.app.get('instrument/api', headers={'X-Agent-Profile': 'secret'})
+        self.assertIn('function calls', rv.data)
+        self.assertIsNone(page.profiler.active)
+
+    @mock.patch('ooi_instrument_agent.views.Consul')
+    def test_sample(self, consul_mock):
+        consul_mock.return_value.health.service.return_value = 1, json.loads(health_response)
+        page.profiler = RequestProfiler(sample=2, directory=self.directory, keep=2)
+
+        for _ in range(8):
+            rv = self.app.get('instrument/api')
+            self.assertEqual(rv.content_type, 'application/json')
+
+        profiles = os.listdir(self.directory)
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(name.endswith('instrument.get_drivers.prof') for name in profiles))
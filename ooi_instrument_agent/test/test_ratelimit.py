@@ -0,0 +1,67 @@
+import json
+import unittest
+
+import mock
+
+from ooi_instrument_agent.metrics import RATE_LIMITED
+from ooi_instrument_agent.ratelimit import RateLimiter, RateLimited, TokenBuckets
+from ooi_instrument_agent.test import ViewTestCase
+from ooi_instrument_agent.views import page
+
+
+class TokenBucketsTest(unittest.TestCase):
+    @mock.patch('time.time')
+    def test_take(self, time_mock):
+        time_mock.return_value = 100.0
+        buckets = TokenBuckets(rate=2, burst=3)
+        self.assertEqual([buckets.take('a') for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(buckets.take('a'), 0.5)
+        # other keys have their own bucket
+        self.assertEqual(buckets.take('b'), 0)
+
+        time_mock.return_value = 100.5
+        self.assertEqual(buckets.take('a'), 0)
+        self.assertAlmostEqual(buckets.take('a'), 0.5)
+
+        time_mock.return_value = 200.0
+        buckets.prune()
+        self.assertEqual(buckets.buckets, {})
+
+    def test_disabled(self):
+        buckets = TokenBuckets(rate=0, burst=1)
+        self.assertEqual([buckets.take('a') for _ in range(5)], [0] * 5)
+        self.assertEqual(buckets.buckets, {})
+
+    def test_admit(self):
+        limiter = RateLimiter(client_rate=0, driver_rate=1, driver_burst=1)
+        limiter.admit('me', 'A')
+        limiter.admit('me', 'B')
+        limiter.admit('me')
+        with self.assertRaises(RateLimited) as context:
+            limiter.admit('you', 'A', 'instrument.get_driver')
+        self.assertEqual(context.exception.retry_after, 1)
+        self.assertEqual(context.exception.message['rate-limited'], 'driver')
+
+
+class RateLimitViewTest(ViewTestCase):
+    page_attributes = ('rate_limiter',)
+
+    def setUp(self):
+        super(RateLimitViewTest, self).setUp()
+        page.rate_limiter = RateLimiter(client_rate=0.01, client_burst=2)
+
+    def test_client_limit(self):
+        before = RATE_LIMITED.samples.get(('client', 'instrument.get_drivers'), 0)
+        self.assertEqual(self.app.get('instrument/api').status_code, 200)
+        self.assertEqual(self.app.get('instrument/api').status_code, 200)
+        rv = self.app.get('instrument/api')
+        self.assertEqual(rv.status_code, 429)
+        self.assertEqual(int(rv.headers['Retry-After']), 100)
+        self.assertEqual(json.loads(rv.data)['rate-limited'], 'client')
+        self.assertEqual(RATE_LIMITED.samples[('client', 'instrument.get_drivers')], before + 1)
+        self.assertEqual(page.consul.health.service.call_count, 2)
+
+        # a new lock key is not a new client, another address is, and metrics are never limited
+        self.assertEqual(self.app.get('instrument/api?key=operator').status_code, 429)
+        self.assertEqual(self.app.get('instrument/api', environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code, 200)
+        self.assertEqual(self.app.get('instrument/metrics').status_code, 200)
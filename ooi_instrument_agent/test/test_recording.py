@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ooi_instrument_agent.recording import SniffRecorder, INDEX_SIZE
+
+
+class RecordingTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.refdes = 'RS10ENGC-XX00X-00-BOTPTA001'
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_read_range(self):
+        recorder = SniffRecorder(self.root)
+        for i in range(10):
+            recorder.write(self.refdes, 'chunk%d ' % i, 1000 + i)
+
+        self.assertEqual(recorder.read(self.refdes, 1003, 1005), 'chunk3 chunk4 chunk5 ')
+        self.assertEqual(recorder.read(self.refdes, 1008), 'chunk8 chunk9 ')
+        self.assertEqual(recorder.read(self.refdes, 2000), '')
+        self.assertEqual(recorder.read('unknown', 0), '')
+
+    def test_segments(self):
+        recorder = SniffRecorder(self.root, segment_bytes=100)
+        for i in range(20):
+            recorder.write(self.refdes, 'x' * 40 + str(i % 10), 1000 + i)
+
+        starts = recorder.segments(self.refdes)
+        self.assertGreater(len(starts), 1)
+        self.assertEqual(starts[0], 1000)
+        # a range spanning several segments
+        expected = ''.join('x' * 40 + str(i % 10) for i in range(3, 15))
+        self.assertEqual(recorder.read(self.refdes, 1003, 1014), expected)
+
+    def test_sparse_index(self):
+        recorder = SniffRecorder(self.root, index_interval=100)
+        for i in range(100):
+            recorder.write(self.refdes, 'x' * 10, 1000 + i)
+        recorder.close()
+
+        directory = os.path.join(self.root, self.refdes)
+        index = [name for name in os.listdir(directory) if name.endswith('.idx')][0]
+        entries = os.path.getsize(os.path.join(directory, index)) // INDEX_SIZE
+        self.assertGreater(entries, 1)
+        self.assertLess(entries, 100)
+        self.assertEqual(recorder.read(self.refdes, 1050, 1051), 'x' * 20)
+
+    def test_retention_size(self):
+        recorder = SniffRecorder(self.root, segment_bytes=100, max_bytes=300)
+        for i in range(50):
+            recorder.write(self.refdes, 'x' * 50, 1000 + i)
+
+        total = sum(os.path.getsize(os.path.join(self.root, self.refdes, name))
+                    for name in os.listdir(os.path.join(self.root, self.refdes)) if name.endswith('.seg'))
+        self.assertLessEqual(total, 300 + 200)
+        self.assertEqual(recorder.read(self.refdes, 1000, 1010), '')
+        self.assertEqual(recorder.read(self.refdes, 1049), 'x' * 50)
+
+    def test_retention_age(self):
+        recorder = SniffRecorder(self.root, segment_bytes=100, max_age=10)
+        for i in range(20):
+            recorder.write(self.refdes, 'x' * 50, 1000 + i)
+        recorder.enforce_retention(1030)
+        self.assertEqual(recorder.segments(self.refdes), [1018])
+
+    def test_invalid_refdes(self):
+        recorder = SniffRecorder(self.root)
+        with self.assertRaises(ValueError):
+            recorder.write('../etc', 'x', 0)
+
+    def test_read_limit(self):
+        recorder = SniffRecorder(self.root, segment_bytes=100, max_read_bytes=120)
+        for i in range(10):
+            recorder.write(self.refdes, 'x' * 50, 1000 + i)
+        self.assertEqual(recorder.read(self.refdes, 1000), 'x' * 100)
+        self.assertEqual(recorder.read(self.refdes, 1008), 'x' * 100)
+
+    def test_retention_missing_root(self):
+        root = os.path.join(self.root, 'recordings')
+        recorder = SniffRecorder(root, max_bytes=100)
+        recorder.enforce_retention(1000)
+        open(os.path.join(root, '.lock'), 'w').close()
+        recorder.write(self.refdes, 'x' * 50, 1000)
+        recorder.enforce_retention(1000)
+        self.assertEqual(recorder.segments(self.refdes), [1000])
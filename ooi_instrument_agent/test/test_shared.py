@@ -0,0 +1,140 @@
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+import gevent
+import mock
+
+from ooi_instrument_agent.shared import SharedCache
+from ooi_instrument_agent.test import ViewTestCase
+from ooi_instrument_agent.views import page
+
+
+class SharedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = SharedCache(self.directory, interval=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        cache = SharedCache()
+        self.assertFalse(cache.enabled)
+        self.assertIsNone(cache.get('drivers'))
+        cache.invalidate('drivers')
+
+    def test_publish(self):
+        self.assertIsNone(self.cache.get('drivers'))
+        self.cache.publish('drivers', {'drivers': ['A']})
+        reader = SharedCache(self.directory)
+        self.assertEqual(reader.get('drivers'), {'drivers': ['A']})
+
+        self.cache.publish('drivers', {'drivers': ['A', 'B']})
+        self.assertEqual(reader.get('drivers'), {'drivers': ['A', 'B']})
+
+        with mock.patch('time.time', return_value=1e12):
+            self.assertIsNone(reader.get('drivers'))
+        self.assertIsNone(reader.get('drivers', max_age=-1))
+
+        self.cache.invalidate('drivers')
+        self.assertIsNone(reader.get('drivers'))
+
+    def test_invalidate_during_refresh(self):
+        reader = SharedCache(self.directory)
+        started = time.time()
+        self.cache.invalidate('locks')
+        # a refresh which was already running when the lock changed
+        self.assertFalse(self.cache.publish('locks', {'locks': {'A': 'old'}}, started))
+        self.assertIsNone(reader.get('locks'))
+
+        self.assertTrue(self.cache.publish('locks', {'locks': {'A': 'new'}}))
+        self.assertEqual(reader.get('locks'), {'locks': {'A': 'new'}})
+
+    def test_fetch_time(self):
+        func = mock.Mock(side_effect=lambda: gevent.sleep(0.05) or ['A'])
+        self.cache.register('status', func)
+        before = time.time()
+        self.cache.refresh()
+        gevent.sleep(0.1)
+        self.assertEqual(self.cache.get('status'), ['A'])
+        # stamped when the fetch started, not when it was published
+        self.assertLess(self.cache.entries['status'][1]['time'] - before, 0.04)
+
+    def test_elect(self):
+        other = SharedCache(self.directory)
+        self.assertTrue(self.cache.elect())
+        self.assertTrue(self.cache.elect())
+        self.assertFalse(other.elect())
+
+        # the lock is released with its holder
+        self.cache._lock.close()
+        self.cache._lock = None
+        self.assertTrue(other.elect())
+
+    def test_refresh(self):
+        func = mock.Mock(return_value=['A'])
+        self.cache.register('drivers', func, interval=60)
+        self.cache.refresh()
+        self.cache.refresh()
+        gevent.sleep(0.01)
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(self.cache.get('drivers'), ['A'])
+
+        # a failed refresh leaves the last snapshot
+        self.cache.refreshers['drivers']['due'] = 0
+        func.side_effect = ValueError()
+        self.cache.refresh()
+        gevent.sleep(0.01)
+        self.assertEqual(self.cache.get('drivers'), ['A'])
+
+
+class SharedViewTest(ViewTestCase):
+    page_attributes = ('shared',)
+
+    def setUp(self):
+        super(SharedViewTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        page.shared = SharedCache(self.directory)
+        page.shared.publish('drivers', {'index': 9, 'drivers': ['RS10ENGC-XX00X-00-SPKIRA001'],
+                                        'addresses': {'RS10ENGC-XX00X-00-SPKIRA001': ['shared-host', 5000]}})
+        page.shared.publish('locks', {'index': 4, 'locks': {'RS10ENGC-XX00X-00-SPKIRA001': 'me'}})
+
+    def tearDown(self):
+        super(SharedViewTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_discovery(self):
+        rv = self.app.get('instrument/api')
+        self.assertEqual(json.loads(rv.data), ['RS10ENGC-XX00X-00-SPKIRA001'])
+        self.assertEqual(rv.headers['ETag'], '"drivers-9"')
+        self.assertFalse(page.consul.health.service.called)
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_driver(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.get_state.return_value = {'value': {}}
+        rv = self.app.get('instrument/api/RS10ENGC-XX00X-00-SPKIRA001')
+        self.assertEqual(json.loads(rv.data)['locked-by'], 'me')
+        self.assertEqual(client_mock.call_args[0], ('shared-host', 5000))
+        self.assertFalse(page.consul.health.service.called)
+        self.assertFalse(page.lock_manager.snapshot.called)
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_driver_unshared(self, client_mock):
+        page.shared = SharedCache()
+        page.lock_manager.__getitem__.return_value = 'other'
+        client_mock.return_value.__enter__.return_value.get_state.return_value = {'value': {}}
+        rv = self.app.get('instrument/api/RS10ENGC-XX00X-00-SPKIRA001')
+        self.assertEqual(json.loads(rv.data)['locked-by'], 'other')
+        # the one lock, not all of them
+        page.lock_manager.__getitem__.assert_called_once_with('RS10ENGC-XX00X-00-SPKIRA001')
+        self.assertFalse(page.lock_manager.snapshot.called)
+
+    def test_lock_invalidates(self):
+        page.lock_manager.snapshot.return_value = 5, {}
+        self.app.post('instrument/api/RS10ENGC-XX00X-00-SPKIRA001/unlock')
+        rv = self.app.get('instrument/api/locks')
+        self.assertEqual(json.loads(rv.data), {'locks': {}})
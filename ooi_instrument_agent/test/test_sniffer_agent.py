@@ -0,0 +1,419 @@
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from ooi_instrument_agent.common import get_sniffer_socket, get_sniffer_sockets
+from ooi_instrument_agent.discovery import FileDiscovery, write_registry
+from ooi_instrument_agent.sniffer_agent import (RequestFactory, SniffProtocol, ConsulLocator, FileLocator,
+                                                SnifferGateway)
+from ooi_instrument_agent.port_agent import make_packet, DATA_FROM_INSTRUMENT, DATA_FROM_DRIVER
+from ooi_instrument_agent.recording import SniffRecorder
+from ooi_instrument_agent.test.responses import port_agent_response
+
+
+class SnifferTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.factory = RequestFactory(max_idle=60, max_bytes=100, clock=self.clock)
+
+    def add_session(self, refdes, key='user'):
+        """
+        Register a connected sniffer session with the factory, as get_sniffer would
+        """
+        protocol = SniffProtocol()
+        protocol.refdes = refdes
+        protocol.key = key
+        protocol.clock = self.clock
+        protocol.timestamp = self.clock.seconds()
+        protocol.lost_connection_callback = self.factory.sniffer_closed((refdes, key))
+        protocol.buffer_callback = self.factory.buffer_changed
+        protocol.makeConnection(StringTransport())
+        self.factory.sniff_protocols[(refdes, key)] = protocol
+        return protocol
+
+    def test_buffer_accounting(self):
+        protocol = self.add_session('A')
+        protocol.dataReceived('x' * 10)
+        protocol.dataReceived('y' * 5)
+        self.assertEqual(protocol.buffered, 15)
+        self.assertEqual(self.factory.buffered_bytes, 15)
+
+        self.assertEqual(protocol.get_data(), 'x' * 10 + 'y' * 5)
+        self.assertEqual(protocol.buffered, 0)
+        self.assertEqual(self.factory.buffered_bytes, 0)
+
+    def test_buffer_accounting_maxlen(self):
+        protocol = self.add_session('A')
+        protocol.buffer = type(protocol.buffer)(maxlen=2)
+        for _ in range(5):
+            protocol.dataReceived('x' * 10)
+        self.assertEqual(protocol.buffered, 20)
+        self.assertEqual(self.factory.buffered_bytes, 20)
+
+    def test_reap_idle(self):
+        idle = self.add_session('A')
+        self.clock.advance(30)
+        active = self.add_session('B')
+
+        self.clock.advance(31)
+        self.factory.reap()
+        self.assertTrue(idle.transport.disconnecting)
+        self.assertFalse(active.transport.disconnecting)
+
+    def test_reap_after_read(self):
+        protocol = self.add_session('A')
+        self.clock.advance(59)
+        protocol.get_data()
+        self.clock.advance(59)
+        self.factory.reap()
+        self.assertFalse(protocol.transport.disconnecting)
+
+    def test_reaper_loop(self):
+        protocol = self.add_session('A')
+        self.factory.reaper.start(10, now=False)
+        self.clock.pump([10] * 7)
+        self.assertTrue(protocol.transport.disconnecting)
+        self.factory.reaper.stop()
+
+    def test_reaper_survives_recording_errors(self):
+        self.factory.reaper.start(10, now=False)
+        with mock.patch.object(self.factory, 'maintain_recordings', side_effect=OSError('gone')) as maintain:
+            self.clock.pump([10] * 3)
+        self.assertEqual(maintain.call_count, 3)
+        self.assertTrue(self.factory.reaper.running)
+        self.factory.reaper.stop()
+
+    def test_budget_evicts_lru(self):
+        stale = self.add_session('A')
+        self.clock.advance(5)
+        fresh = self.add_session('B')
+
+        stale.dataReceived('x' * 60)
+        fresh.dataReceived('y' * 60)
+
+        self.assertTrue(stale.transport.disconnecting)
+        self.assertFalse(fresh.transport.disconnecting)
+        self.assertEqual(stale.buffered, 0)
+        self.assertEqual(self.factory.buffered_bytes, 60)
+
+    def test_connection_lost_releases_budget(self):
+        protocol = self.add_session('A')
+        protocol.dataReceived('x' * 50)
+        protocol.connectionLost()
+        self.assertEqual(self.factory.buffered_bytes, 0)
+        self.assertEqual(self.factory.sniff_protocols, {})
+
+    def test_packet_filter(self):
+        protocol = self.add_session('A')
+        protocol.set_filter({'types': ['DATA_FROM_INSTRUMENT'], 'payload': True})
+        stream = make_packet(DATA_FROM_INSTRUMENT, 'sample', 1) + make_packet(DATA_FROM_DRIVER, 'command', 2)
+        protocol.dataReceived(stream[:20])
+        self.assertEqual(protocol.buffered, 0)
+        protocol.dataReceived(stream[20:])
+        self.assertEqual(protocol.get_data(), 'sample')
+
+        protocol.set_filter(None)
+        protocol.dataReceived(stream)
+        self.assertEqual(protocol.get_data(), stream)
+
+    def test_stats(self):
+        protocol = self.add_session('A', 'bob')
+        protocol.dataReceived('x' * 10)
+        self.factory.sniff_protocols['pending'] = None
+        self.clock.advance(3)
+
+        stats = self.factory.get_stats()
+        self.assertEqual(stats['buffered_bytes'], 10)
+        self.assertEqual(stats['sessions'], [{'refdes': 'A', 'key': 'bob', 'buffered_bytes': 10,
+                                              'last_read_age': 3}])
+
+    def test_stats_request(self):
+        self.add_session('A')
+        protocol = self.factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(json.dumps('stats'))
+        self.assertEqual(json.loads(transport.value())['sessions'][0]['refdes'], 'A')
+
+    def test_replay(self):
+        root = tempfile.mkdtemp()
+        try:
+            self.factory.recorder = SniffRecorder(root)
+            self.factory.recorder.write('A', make_packet(DATA_FROM_INSTRUMENT, 'one', 1), 100)
+            self.factory.recorder.write('A', make_packet(DATA_FROM_DRIVER, 'two', 2), 101)
+            self.factory.recorder.write('A', make_packet(DATA_FROM_INSTRUMENT, 'three', 3), 102)
+
+            protocol = self.factory.buildProtocol(None)
+            transport = StringTransport()
+            protocol.makeConnection(transport)
+            protocol.dataReceived(json.dumps(['A', 'user', {'start': 100, 'end': 101.5,
+                                                            'types': [DATA_FROM_INSTRUMENT], 'payload': True}]))
+            self.assertEqual(transport.value(), 'one')
+            self.assertEqual(self.factory.sniff_protocols, {})
+        finally:
+            shutil.rmtree(root)
+
+    def test_replay_disabled(self):
+        self.assertEqual(self.factory.replay('A', {'start': 0}), 'RECORDING NOT ENABLED\n')
+
+
+class FileLocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'registry.json')
+        write_registry(path, {'sniff-port-agent': {'A': ['10.0.0.1', 8001], 'B': ['10.0.0.2', 8002]}})
+        self.locator = FileLocator(FileDiscovery(path))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_locate(self):
+        results = []
+        self.locator.locate('A').addCallback(results.append)
+        self.locator.locate('C').addCallback(results.append)
+        self.assertEqual(results, [('10.0.0.1', 8001), (None, None)])
+        self.assertEqual(self.locator.services, {'A': ('10.0.0.1', 8001), 'B': ('10.0.0.2', 8002)})
+
+
+class ConsulLocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.locator = ConsulLocator(address='consul:8500', clock=self.clock)
+        self.requests = []
+        self.locator.request = self.fake_request
+        self.services = json.loads(port_agent_response)
+        self.refdes = 'RS10ENGC-XX00X-00-BOTPTA001'
+
+    def fake_request(self, url):
+        d = Deferred()
+        self.requests.append((url, d))
+        return d
+
+    def collect(self, d):
+        results = []
+        d.addCallback(results.append)
+        return results
+
+    def test_coalesced_lookup(self):
+        first = self.collect(self.locator.locate(self.refdes))
+        second = self.collect(self.locator.locate(self.refdes))
+        self.assertEqual(len(self.requests), 1)
+
+        url, d = self.requests[0]
+        self.assertTrue(url.startswith('http://consul:8500/v1/health/service/sniff-port-agent?'))
+        self.assertIn('tag=%s' % self.refdes, url)
+
+        d.callback(('5', self.services))
+        self.assertEqual(first, [(u'128.6.240.39', 41347)])
+        self.assertEqual(second, [(u'128.6.240.39', 41347)])
+        self.assertEqual(self.locator.pending, {})
+
+    def test_lookup_failure(self):
+        result = self.collect(self.locator.locate(self.refdes))
+        self.requests[0][1].errback(Exception('boom'))
+        self.assertEqual(result, [(None, None)])
+
+    def test_watch(self):
+        self.locator.start()
+        url, d = self.requests[0]
+        self.assertNotIn('index=', url)
+        d.callback(('5', self.services))
+
+        # served from the cache, a blocking query is outstanding
+        result = self.collect(self.locator.locate(self.refdes))
+        missing = self.collect(self.locator.locate('missing'))
+        self.assertEqual(result, [(u'128.6.240.39', 41347)])
+        self.assertEqual(missing, [(None, None)])
+        self.assertEqual(len(self.requests), 2)
+        self.assertIn('index=5', self.requests[1][0])
+        self.assertIn('wait=5m', self.requests[1][0])
+
+        # service deregistered
+        self.requests[1][1].callback(('6', []))
+        self.assertEqual(self.collect(self.locator.locate(self.refdes)), [(None, None)])
+
+    def test_watch_retry(self):
+        self.locator.start()
+        self.requests[0][1].errback(Exception('boom'))
+        self.assertEqual(len(self.requests), 1)
+        self.clock.advance(self.locator.retry_delay)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_watch_reset(self):
+        self.locator.start()
+        self.requests[0][1].callback(('5', self.services))
+        # a restarted Consul reports a lower index
+        self.requests[1][1].callback(('2', self.services))
+        self.assertEqual(len(self.requests), 2)
+        self.clock.advance(self.locator.retry_delay)
+        self.assertIn('index=1&', self.requests[2][0])
+        # and no index at all
+        self.requests[2][1].callback((None, self.services))
+        self.assertEqual(self.locator.index, 1)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_watch_backoff(self):
+        self.locator.start()
+        self.requests[0][1].callback(('5', self.services))
+        # the index is unchanged at once, the query did not block
+        self.requests[1][1].callback(('5', self.services))
+        self.assertEqual(len(self.requests), 2)
+        self.clock.advance(self.locator.retry_delay)
+        self.assertEqual(len(self.requests), 3)
+
+        # the wait expired without a change
+        self.clock.advance(300)
+        self.requests[2][1].callback(('5', self.services))
+        self.assertEqual(len(self.requests), 4)
+
+
+class FloodProtocol(Protocol):
+    """
+    Simulated sniff port agent which writes data as fast as the connection will accept it
+    """
+    chunk = 'x' * 4096
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, False)
+
+    def resumeProducing(self):
+        self.transport.write(self.chunk)
+
+    def stopProducing(self):
+        pass
+
+
+def run_shard(sockfile):
+    """
+    Run a sniffer gateway whose sessions all connect to a local flooding port agent
+    """
+    from twisted.internet import reactor
+    port = reactor.listenTCP(0, Factory.forProtocol(FloodProtocol), interface='127.0.0.1')
+    gateway = SnifferGateway(sockfile)
+    gateway.factory.locator.stop()
+    gateway.factory.locate = lambda refdes: succeed(('127.0.0.1', port.getHost().port))
+    reactor.run()
+
+
+class ShardTest(unittest.TestCase):
+    duration = 3
+    clients = 16
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.refdes = ['RS10ENGC-XX00X-00-SPKIRA%03d' % i for i in range(self.clients)]
+        self.old_env = dict(os.environ)
+        self.children = []
+
+    def tearDown(self):
+        self.stop_shards()
+        os.environ.clear()
+        os.environ.update(self.old_env)
+        shutil.rmtree(self.root)
+
+    def start_shards(self, shards):
+        """
+        Start the requested number of gateway shards, each flooding its sessions from a local port agent
+        """
+        os.environ.update({'SNIFF_UNIX_SOCKFILE': os.path.join(self.root, 'sniff%d.sock' % shards),
+                           'SNIFF_SHARDS': str(shards)})
+        for sockfile in get_sniffer_sockets():
+            code = 'from ooi_instrument_agent.test.test_sniffer_agent import run_shard; run_shard(%r)' % sockfile
+            self.children.append(subprocess.Popen([sys.executable, '-c', code]))
+            while not os.path.exists(sockfile):
+                time.sleep(0.05)
+
+    def stop_shards(self):
+        for child in self.children:
+            child.terminate()
+            child.wait()
+        self.children = []
+
+    def poll(self, duration):
+        """
+        Poll every reference designator from its own thread for duration seconds
+        :return: List of bytes received per reference designator
+        """
+        totals = [0] * len(self.refdes)
+        deadline = time.time() + duration
+
+        def poll(i, refdes):
+            sockfile = get_sniffer_socket(refdes)
+            buf = bytearray(1 << 20)
+            while time.time() < deadline:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(sockfile)
+                sock.send(json.dumps([refdes, 'bench']))
+                while True:
+                    n = sock.recv_into(buf)
+                    if not n:
+                        break
+                    totals[i] += n
+                sock.close()
+
+        threads = [threading.Thread(target=poll, args=(i, refdes)) for i, refdes in enumerate(self.refdes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return totals
+
+    @staticmethod
+    def stats(sockfile):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(sockfile)
+        sock.send(json.dumps('stats'))
+        chunks = []
+        while True:
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        sock.close()
+        return json.loads(''.join(chunks))
+
+    def measure(self, shards):
+        """
+        :return: Sniffed bytes per second delivered to clients polling a fixed set of reference designators
+        """
+        self.start_shards(shards)
+        try:
+            return sum(self.poll(self.duration)) / float(self.duration)
+        finally:
+            self.stop_shards()
+
+    def test_work_split(self):
+        self.start_shards(4)
+        totals = self.poll(1)
+        self.assertTrue(all(totals))
+
+        # each shard process holds the sessions of exactly the reference designators it owns
+        served = []
+        for index, sockfile in enumerate(get_sniffer_sockets()):
+            owned = set(refdes for refdes in self.refdes if get_sniffer_socket(refdes) == sockfile)
+            sessions = set(session['refdes'] for session in self.stats(sockfile)['sessions'])
+            self.assertTrue(owned, 'shard %d owns nothing' % index)
+            self.assertEqual(sessions, owned)
+            served.append(sessions)
+        self.assertEqual(set.union(*served), set(self.refdes))
+
+    @unittest.skipUnless(multiprocessing.cpu_count() >= 4 or os.environ.get('SNIFF_SHARD_BENCHMARK'),
+                         'requires at least 4 CPUs')
+    def test_throughput_scales(self):
+        single = self.measure(1)
+        sharded = self.measure(4)
+        self.assertGreater(sharded, single * 1.5)
@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+from gevent.pywsgi import WSGIServer
+
+import ooi_instrument_agent
+from ooi_instrument_agent import trace
+from ooi_instrument_agent.bench.fleet import Fleet
+from ooi_instrument_agent.bench.replay import replay, trace_refdes, rpc_latency, recorded_results
+from ooi_instrument_agent.client import ZmqDriverClient
+from ooi_instrument_agent.test.responses import health_response
+from ooi_instrument_agent.trace import TraceRecorder, read_trace, trace_files, HTTP, RPC
+
+
+class TraceRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'trace.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        recorder = TraceRecorder()
+        recorder.record_rpc('REFDES', 'process_echo', [], {}, 0.1, 10)
+        self.assertEqual(recorder.pending, [])
+
+    def test_batch(self):
+        recorder = TraceRecorder(self.path, batch=3)
+        recorder.record_rpc('REFDES', 'process_echo', [], {}, 0.1, 10)
+        recorder.record_http('REFDES', 'instrument.ping', 'GET', '/instrument/api/REFDES/ping?', None, 0.2, 50, 200)
+        self.assertFalse(os.path.exists(recorder.file))
+        recorder.record_rpc('REFDES', 'get_resource', ['DRIVER_PARAMETER_ALL'], {}, 0.3, 100)
+        self.assertEqual(recorder.pending, [])
+
+        records = read_trace(self.path)
+        self.assertEqual([record[0] for record in records], [RPC, HTTP, RPC])
+        self.assertEqual(records[0][3], 'get_resource')
+        self.assertEqual(read_trace(self.path, kinds=(HTTP,))[0][5], '/instrument/api/REFDES/ping?')
+
+    def test_rotate(self):
+        recorder = TraceRecorder(self.path, max_bytes=200, backups=2, batch=1)
+        for i in range(20):
+            recorder.record_rpc('REFDES', 'command_%d' % i, [], {}, 0, 10)
+        path = recorder.file
+        self.assertEqual(path, '%s-%d' % (self.path, os.getpid()))
+        files = trace_files(path)
+        self.assertEqual(files, [path + '.2', path + '.1', path])
+        self.assertTrue(all(os.path.getsize(name) <= 200 for name in files))
+        # the newest records survive, in order
+        commands = [record[3] for record in read_trace(self.path)]
+        self.assertEqual(commands[-1], 'command_19')
+        self.assertEqual(commands, sorted(commands, key=lambda c: int(c.split('_')[1])))
+
+    def test_processes(self):
+        # workers write separate files, read back as one trace
+        for pid, command in ((100, 'first'), (200, 'second')):
+            with mock.patch('os.getpid', return_value=pid):
+                recorder = TraceRecorder(self.path)
+                recorder.record_rpc('REFDES', command, [], {}, 0, 10)
+                recorder.flush()
+        self.assertTrue(os.path.exists(self.path + '-100'))
+        self.assertEqual(sorted(record[3] for record in read_trace(self.path)), ['first', 'second'])
+
+    def test_redact(self):
+        recorder = TraceRecorder(self.path, batch=1)
+        recorder.record_http('REFDES', 'instrument.set_lock', 'POST', '/instrument/api/REFDES/lock?key=bob&profile=s3',
+                             ['json', {'key': 'bob', 'timeout': 5}], 0.1, 10, 200)
+        recorder.record_http('REFDES', 'instrument.ping', 'GET', '/instrument/api/REFDES/ping?', None, 0.1, 10, 200)
+        locked, ping = read_trace(self.path)
+        self.assertEqual(locked[5], '/instrument/api/REFDES/lock?key=redacted&profile=redacted')
+        self.assertEqual(locked[6], ['json', {'key': 'redacted', 'timeout': 5}])
+        self.assertEqual(ping[5:7], ['/instrument/api/REFDES/ping?', None])
+
+
+class TraceIntegrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'trace.jsonl')
+        self.original = trace.recorder
+        trace.recorder = TraceRecorder(self.path)
+
+    def tearDown(self):
+        trace.recorder = self.original
+        shutil.rmtree(self.directory)
+
+    def test_client(self):
+        fleet = Fleet(1).start()
+        try:
+            driver = fleet.drivers[0]
+            with ZmqDriverClient(driver.host, driver.port, refdes=driver.refdes) as client:
+                client.ping()
+        finally:
+            fleet.stop()
+        trace.recorder.flush()
+        record, = read_trace(self.path)
+        self.assertEqual(record[:6], [RPC, record[1], driver.refdes, 'process_echo', [], {}])
+        self.assertGreater(record[7], 0)
+
+    @mock.patch('ooi_instrument_agent.views.Consul')
+    def test_views(self, consul_mock):
+        consul_mock.return_value.health.service.return_value = 1, json.loads(health_response)
+        ooi_instrument_agent.app.config['TESTING'] = True
+        app = ooi_instrument_agent.app.test_client()
+        rv = app.get('instrument/api')
+        trace.recorder.flush()
+
+        record, = read_trace(self.path)
+        self.assertEqual(record[0], HTTP)
+        self.assertEqual(record[3:7], ['instrument.get_drivers', 'GET', '/instrument/api?', None])
+        self.assertEqual(record[8], len(rv.data))
+        self.assertEqual(record[9], 200)
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+
+        def application(environ, start_response):
+            self.requests.append((time.time(), environ['REQUEST_METHOD'], environ['PATH_INFO'],
+                                  environ['wsgi.input'].read()))
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return ['{}']
+
+        self.server = WSGIServer(('127.0.0.1', 0), application, log=None)
+        self.server.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        now = time.time()
+        self.records = [
+            [HTTP, now, 'A', 'instrument.ping', 'GET', '/instrument/api/A/ping?', None, 0.01, 2, 200],
+            [RPC, now, 'A', 'process_echo', [], {}, 0.004, 20],
+            [HTTP, now + 0.2, 'B', 'instrument.set_lock', 'POST', '/instrument/api/B/lock?',
+             ['json', {'key': 'me'}], 0.02, 10, 200],
+            [RPC, now + 0.3, 'B', 'overall_state', [], {}, 0.008, None],
+        ]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_helpers(self):
+        self.assertEqual(trace_refdes(self.records), ['A', 'B'])
+        self.assertEqual(rpc_latency(self.records), 0.004)
+        self.assertEqual(recorded_results(self.records)['instrument.set_lock']['latencies'], [0.02])
+
+    def test_replay(self):
+        results, elapsed, _ = replay(self.base_url, self.records, speed=1)
+        self.assertEqual([request[1:3] for request in self.requests],
+                         [('GET', '/instrument/api/A/ping'), ('POST', '/instrument/api/B/lock')])
+        self.assertEqual(json.loads(self.requests[1][3]), {'key': 'me'})
+        self.assertGreaterEqual(self.requests[1][0] - self.requests[0][0], 0.15)
+        self.assertEqual(len(results['instrument.ping']['latencies']), 1)
+
+        # ten times faster
+        del self.requests[:]
+        replay(self.base_url, self.records, speed=10)
+        self.assertLess(self.requests[1][0] - self.requests[0][0], 0.1)
@@ -6,6 +6,7 @@ from consul import Consul
 from werkzeug.exceptions import NotFound
 
 from ooi_instrument_agent.client import ZmqDriverClient
+from ooi_instrument_agent.discovery import ConsulDiscovery
 from ooi_instrument_agent.test.responses import health_response, port_agent_response
 from ooi_instrument_agent.utils import (list_drivers, get_client, get_host_and_port, get_service_host_and_port,
                                         get_port_agent, get_from_request, get_timeout)
@@ -17,7 +18,7 @@ class UtilsTest(unittest.TestCase):
         consul_mock = mock.Mock()
         consul_mock.health.service.return_value = (1, json.loads(health_response))
 
-        result = list_drivers(consul_mock)
+        result = list_drivers(ConsulDiscovery(consul_mock))
         self.assertEqual(result, ["RS10ENGC-XX00X-00-SPKIRA001", "RS10ENGC-XX00X-00-TMPSFA001"])
 
     def test_list_drivers_empty(self):
@@ -25,7 +26,7 @@ class UtilsTest(unittest.TestCase):
         consul_mock = mock.Mock()
         consul_mock.health.service.return_value = (1, [])
 
-        result = list_drivers(consul_mock)
+        result = list_drivers(ConsulDiscovery(consul_mock))
         self.assertEqual(result, [])
 
     def test_get_client(self):
@@ -33,7 +34,7 @@ class UtilsTest(unittest.TestCase):
         consul_mock = mock.Mock()
         consul_mock.health.service.return_value = (1, json.loads(health_response))
 
-        result = get_client(consul_mock, 'test_driver_id')
+        result = get_client(ConsulDiscovery(consul_mock), 'test_driver_id')
         self.assertIsInstance(result, ZmqDriverClient)
 
     def test_get_client_missing(self):
@@ -42,14 +43,14 @@ class UtilsTest(unittest.TestCase):
         consul_mock.health.service.return_value = (1, {})
 
         with self.assertRaises(NotFound):
-            get_client(consul_mock, 'test_driver_id')
+            get_client(ConsulDiscovery(consul_mock), 'test_driver_id')
 
     def test_get_host_and_port(self):
         # mock the response from Consul
         consul_mock = mock.Mock()
         consul_mock.health.service.return_value = (1, json.loads(health_response))
 
-        host_and_port = get_host_and_port(consul_mock, 'test_driver_id')
+        host_and_port = get_host_and_port(ConsulDiscovery(consul_mock), 'test_driver_id')
         self.assertEqual(host_and_port, (u'128.6.240.39', 42558))
 
     def test_get_host_and_port_missing(self):
@@ -58,14 +59,15 @@ class UtilsTest(unittest.TestCase):
         consul_mock.health.service.return_value = (1, {})
 
         with self.assertRaises(NotFound):
-            get_host_and_port(consul_mock, 'test_driver_id')
+            get_host_and_port(ConsulDiscovery(consul_mock), 'test_driver_id')
 
     def test_get_service_host_and_port(self):
         # mock the response from Consul
         consul_mock = mock.Mock()
         consul_mock.health.service.return_value = (1, json.loads(health_response))
 
-        host_and_port = get_service_host_and_port(consul_mock, 'instrument_driver', tag='test_driver_id')
+        host_and_port = get_service_host_and_port(ConsulDiscovery(consul_mock), 'instrument_driver',
+                                                  tag='test_driver_id')
         self.assertEqual(host_and_port, (u'128.6.240.39', 42558))
 
     def test_get_service_host_and_port_missing(self):
@@ -73,7 +75,7 @@ class UtilsTest(unittest.TestCase):
         consul_mock = mock.Mock()
         consul_mock.health.service.return_value = (1, {})
 
-        response = get_service_host_and_port(consul_mock, 'instrument_driver', tag='test_driver_id')
+        response = get_service_host_and_port(ConsulDiscovery(consul_mock), 'instrument_driver', tag='test_driver_id')
         self.assertIsNone(response)
 
     def test_get_port_agent(self):
@@ -82,7 +84,7 @@ class UtilsTest(unittest.TestCase):
         consul_mock = mock.Mock()
         consul_mock.health.service.return_value = (1, json.loads(port_agent_response))
 
-        pa_dict = get_port_agent(consul_mock, 'test_driver_id')
+        pa_dict = get_port_agent(ConsulDiscovery(consul_mock), 'test_driver_id')
         self.assertEqual(pa_dict, {'command': {'host': u'128.6.240.39', 'port': 41347},
                                    'data': {'host': u'128.6.240.39', 'port': 41347},
                                    'sniff': {'host': u'128.6.240.39', 'port': 41347},
@@ -94,7 +96,7 @@ class UtilsTest(unittest.TestCase):
         consul_mock.health.service.return_value = (1, {})
 
         with self.assertRaises(NotFound):
-            get_port_agent(consul_mock, 'test_driver_id')
+            get_port_agent(ConsulDiscovery(consul_mock), 'test_driver_id')
 
     # GET FROM REQUEST
     @mock.patch('ooi_instrument_agent.utils.request')
@@ -2,10 +2,13 @@ import json
 import unittest
 
 import mock
+import zmq
 import ooi_instrument_agent
-from ooi_instrument_agent.lock import Locked
+from ooi_instrument_agent.lock import Locked, LockManager
+from ooi_instrument_agent.test import ViewTestCase
 from ooi_instrument_agent.test.responses import health_response
-from ooi_instrument_agent.views import lockout
+from ooi_instrument_agent.client import TimeoutException, ZmqDriverClient
+from ooi_instrument_agent.views import lockout, page
 
 
 class ViewTest(unittest.TestCase):
@@ -101,4 +104,204 @@ class ViewTest(unittest.TestCase):
         # now, lock it and test
         lock_mock[locker] = locker
         with self.assertRaises(Locked):
-            inner(driver_id=locker)
\ No newline at end of file
+            inner(driver_id=locker)
+
+
+class ConditionalGetTest(ViewTestCase):
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        page.lock_manager = LockManager(page.consul)
+
+    def assert_not_modified(self, url):
+        rv = self.app.get(url)
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, '')
+        self.assertEqual(rv.headers['ETag'], etag)
+        return etag
+
+    def test_drivers(self):
+        self.assertEqual(self.assert_not_modified('instrument/api'), '"drivers-7"')
+        page.consul.health.service.return_value = 8, json.loads(health_response)
+        self.assertEqual(self.app.get('instrument/api', headers={'If-None-Match': '"drivers-7"'}).status_code, 200)
+
+    def test_locks(self):
+        page.consul.kv.get.return_value = 3, [{'Key': 'agent/lock/RS10ENGC-XX00X-00-SPKIRA001', 'Value': 'me'}]
+        self.assertEqual(self.assert_not_modified('instrument/api/locks'), '"locks-3"')
+        self.assertEqual(json.loads(self.app.get('instrument/api/locks').data),
+                         {'locks': {'RS10ENGC-XX00X-00-SPKIRA001': 'me'}})
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_state(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.get_resource_state.return_value = {'value': 'DRIVER_STATE_COMMAND', 'time': 1.0}
+        etag = self.assert_not_modified('instrument/api/RS10ENGC-XX00X-00-SPKIRA001/state')
+
+        # the reply time alone does not make a new version
+        instance.get_resource_state.return_value = {'value': 'DRIVER_STATE_COMMAND', 'time': 2.0}
+        rv = self.app.get('instrument/api/RS10ENGC-XX00X-00-SPKIRA001/state', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+
+        instance.get_resource_state.return_value = {'value': 'DRIVER_STATE_AUTOSAMPLE', 'time': 3.0}
+        rv = self.app.get('instrument/api/RS10ENGC-XX00X-00-SPKIRA001/state', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+
+class DriverCacheViewTest(ViewTestCase):
+    def setUp(self):
+        super(DriverCacheViewTest, self).setUp()
+        page.driver_cache.entries.clear()
+
+    def tearDown(self):
+        super(DriverCacheViewTest, self).tearDown()
+        page.driver_cache.entries.clear()
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_max_age(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.get_resource.return_value = {'value': {'PARAM': 1}}
+        url = 'instrument/api/RS10ENGC-XX00X-00-SPKIRA001/resource'
+
+        self.app.get(url)
+        self.app.get(url)
+        self.assertEqual(instance.get_resource.call_count, 2)
+
+        # the last fresh reply is reused
+        self.app.get(url + '?max_age=30')
+        self.app.get(url + '?max_age=30')
+        self.assertEqual(instance.get_resource.call_count, 2)
+
+        # a write drops the cached reply
+        instance.set_resource.return_value = {'value': {'PARAM': 2}}
+        self.app.post(url, data={'resource': json.dumps({'PARAM': 2})})
+        instance.get_resource.return_value = {'value': {'PARAM': 2}}
+        rv = self.app.get(url + '?max_age=30')
+        self.assertEqual(json.loads(rv.data), {'value': {'PARAM': 2}})
+        self.assertEqual(instance.get_resource.call_count, 3)
+
+
+class HeartbeatViewTest(ViewTestCase):
+    def setUp(self):
+        super(HeartbeatViewTest, self).setUp()
+        self.drivers = page.heartbeat.drivers
+        page.heartbeat.drivers = {}
+        page.heartbeat.record('RS10ENGC-XX00X-00-SPKIRA001', 0.005)
+        for _ in range(page.heartbeat.failures):
+            page.heartbeat.record('RS10ENGC-XX00X-00-TMPSFA001', None)
+
+    def tearDown(self):
+        super(HeartbeatViewTest, self).tearDown()
+        page.heartbeat.drivers = self.drivers
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_fail_fast(self, client_mock):
+        rv = self.app.get('instrument/api/RS10ENGC-XX00X-00-TMPSFA001/resource')
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(json.loads(rv.data)['unresponsive'], 'RS10ENGC-XX00X-00-TMPSFA001')
+        rv = self.app.post('instrument/api/RS10ENGC-XX00X-00-TMPSFA001/execute', data={'command': 'hello'})
+        self.assertEqual(rv.status_code, 503)
+        self.assertFalse(client_mock.called)
+
+        instance = client_mock.return_value.__enter__.return_value
+        instance.get_resource_state.return_value = {'value': 'DRIVER_STATE_COMMAND'}
+        rv = self.app.get('instrument/api/status')
+        self.assertEqual(json.loads(rv.data), {'RS10ENGC-XX00X-00-SPKIRA001': 'DRIVER_STATE_COMMAND',
+                                               'RS10ENGC-XX00X-00-TMPSFA001': None})
+
+    def test_liveness(self):
+        rv = self.app.get('instrument/api?liveness=true')
+        data = json.loads(rv.data)
+        self.assertEqual(data['RS10ENGC-XX00X-00-SPKIRA001']['alive'], True)
+        self.assertEqual(data['RS10ENGC-XX00X-00-SPKIRA001']['latency'], 0.005)
+        self.assertEqual(data['RS10ENGC-XX00X-00-TMPSFA001']['alive'], False)
+        self.assertFalse(page.consul.kv.get.called)
+
+
+class BatchViewTest(ViewTestCase):
+    def setUp(self):
+        super(BatchViewTest, self).setUp()
+        self.locks = {}
+        page.lock_manager.__getitem__.side_effect = self.locks.get
+        page.lock_manager.__setitem__.side_effect = self.locks.__setitem__
+        page.lock_manager.__delitem__.side_effect = self.locks.pop
+        self.url = 'instrument/api/RS10ENGC-XX00X-00-SPKIRA001/batch'
+
+    def post(self, operations, key='me'):
+        rv = self.app.post(self.url, data=json.dumps({'key': key, 'operations': operations}),
+                           content_type='application/json')
+        return rv.status_code, json.loads(rv.data)
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_sequence(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.set_resource.return_value = {'value': {'PARAM': 2}}
+        instance.execute.return_value = {'value': [None, 'OK']}
+        instance.get_resource.return_value = {'value': {'PARAM': 2}}
+        status, data = self.post([{'op': 'lock'},
+                                  {'op': 'set_resource', 'resource': {'PARAM': 2}},
+                                  {'op': 'execute', 'command': 'DRIVER_EVENT_ACQUIRE_SAMPLE'},
+                                  {'op': 'get_resource'},
+                                  {'op': 'unlock'}])
+        self.assertEqual(status, 200)
+        self.assertTrue(data['completed'])
+        self.assertEqual([result['op'] for result in data['results']],
+                         ['lock', 'set_resource', 'execute', 'get_resource', 'unlock'])
+        self.assertEqual(data['results'][3]['result'], {'value': {'PARAM': 2}})
+        self.assertEqual(self.locks, {})
+        # one connection and one discovery lookup for the whole batch
+        self.assertEqual(client_mock.call_count, 1)
+        self.assertEqual(page.consul.health.service.call_count, 1)
+        instance.execute.assert_called_once_with('DRIVER_EVENT_ACQUIRE_SAMPLE')
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_stops_at_failure(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.execute.side_effect = TimeoutException({'timeout': 'no response'})
+        status, data = self.post([{'op': 'execute', 'command': 'DRIVER_EVENT_DISCOVER'}, {'op': 'get_resource'}])
+        self.assertFalse(data['completed'])
+        self.assertEqual(data['results'][0]['status'], 408)
+        self.assertEqual(len(data['results']), 1)
+        self.assertFalse(instance.get_resource.called)
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_locked(self, client_mock):
+        self.locks['RS10ENGC-XX00X-00-SPKIRA001'] = 'other'
+        client_mock.return_value.__enter__.return_value.get_resource_state.return_value = {'value': 'STATE'}
+        status, data = self.post([{'op': 'state'}, {'op': 'set_resource', 'resource': {}}])
+        self.assertEqual(data['results'][0]['status'], 200)
+        self.assertEqual(data['results'][1], {'op': 'set_resource', 'status': 409, 'error': {'locked-by': 'other'},
+                                              'elapsed': data['results'][1]['elapsed']})
+        self.assertFalse(client_mock.return_value.__enter__.return_value.set_resource.called)
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_init_params(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value = mock.MagicMock(spec=ZmqDriverClient)
+        instance.init_params.return_value = {'value': None}
+        status, data = self.post([{'op': 'lock'}, {'op': 'set_init_params', 'config': {'PARAM': 1}},
+                                  {'op': 'unlock'}])
+        self.assertTrue(data['completed'])
+        instance.init_params.assert_called_once_with({'PARAM': 1}, timeout=mock.ANY)
+
+    @mock.patch('ooi_instrument_agent.utils.ZmqDriverClient')
+    def test_unexpected_error_releases_lock(self, client_mock):
+        instance = client_mock.return_value.__enter__.return_value
+        instance.set_resource.side_effect = zmq.ZMQError(zmq.ETERM)
+        status, data = self.post([{'op': 'lock'}, {'op': 'set_resource', 'resource': {'PARAM': 2}},
+                                  {'op': 'unlock'}])
+        self.assertEqual(status, 200)
+        self.assertFalse(data['completed'])
+        self.assertEqual([result['status'] for result in data['results']], [200, 500])
+        self.assertIn('ZMQError', data['results'][1]['error'])
+        self.assertEqual(self.locks, {})
+
+        # a lock held before the batch is left alone
+        self.locks['RS10ENGC-XX00X-00-SPKIRA001'] = 'me'
+        self.post([{'op': 'lock'}, {'op': 'set_resource', 'resource': {'PARAM': 2}}])
+        self.assertEqual(self.locks, {'RS10ENGC-XX00X-00-SPKIRA001': 'me'})
+
+    def test_invalid(self):
+        self.assertEqual(self.post([{'op': 'format_disk'}])[0], 400)
+        self.assertEqual(self.post({'op': 'state'})[0], 400)
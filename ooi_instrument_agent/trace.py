@@ -0,0 +1,181 @@
+import atexit
+import glob
+import json
+import os
+import re
+import time
+from logging import getLogger
+
+import gevent
+from six.moves.urllib.parse import parse_qsl, urlencode
+
+from ooi_instrument_agent.common import (get_env_number, TRACE_FILE_ENV_KEY, TRACE_MAX_BYTES_ENV_KEY,
+                                         DEFAULT_TRACE_MAX_BYTES, TRACE_BACKUPS_ENV_KEY, DEFAULT_TRACE_BACKUPS)
+
+log = getLogger(__name__)
+
+# Record kinds, the first element of each trace line
+HTTP = 'h'
+RPC = 'r'
+
+# request fields which are credentials (lock keys, the profiling token) rather than traffic
+REDACTED_FIELDS = ('key', 'profile')
+REDACTED = 'redacted'
+
+
+class TraceRecorder(object):
+    """
+    Low overhead recorder of agent traffic for later replay.
+
+    Each record is a compact JSON array on its own line:
+
+    ["h", timestamp, refdes, endpoint, method, path, body, latency, response_size, status]
+    ["r", timestamp, refdes, command, args, kwargs, latency, response_size]
+
+    Records are buffered in memory and written in batches, either when batch records have
+    accumulated or by the periodic flusher greenlet. Each process writes its own file, path
+    suffixed with -<pid>, which is rotated like a logging.handlers.RotatingFileHandler once it
+    exceeds max_bytes, keeping backups old files. Lock keys and the profiling token are redacted
+    from recorded paths and bodies.
+    """
+    def __init__(self, path=None, max_bytes=DEFAULT_TRACE_MAX_BYTES, backups=DEFAULT_TRACE_BACKUPS, batch=500):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch = batch
+        self.pending = []
+        self.enabled = bool(path)
+        self.flusher = None
+
+    @classmethod
+    def from_environ(cls):
+        return cls(path=os.environ.get(TRACE_FILE_ENV_KEY),
+                   max_bytes=get_env_number(TRACE_MAX_BYTES_ENV_KEY, DEFAULT_TRACE_MAX_BYTES),
+                   backups=get_env_number(TRACE_BACKUPS_ENV_KEY, DEFAULT_TRACE_BACKUPS))
+
+    @property
+    def file(self):
+        # resolved on each write, the recorder is created before gunicorn forks its workers
+        return '%s-%d' % (self.path, os.getpid())
+
+    def record_http(self, refdes, endpoint, method, path, body, latency, size, status):
+        if self.enabled:
+            self._append([HTTP, time.time() - latency, refdes, endpoint, method, redact_path(path),
+                          redact_body(body), round(latency, 6), size, status])
+
+    def record_rpc(self, refdes, command, args, kwargs, latency, size):
+        if self.enabled:
+            self._append([RPC, time.time() - latency, refdes, command, args, kwargs, round(latency, 6), size])
+
+    def _append(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        records, self.pending = self.pending, []
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        path = self.file
+        try:
+            if os.path.exists(path) and os.path.getsize(path) + len(data) > self.max_bytes:
+                self.rotate(path)
+            with open(path, 'a') as fh:
+                fh.write(data)
+        except (IOError, OSError) as e:
+            log.warn('Unable to write trace records: %s', e)
+
+    def rotate(self, path):
+        for i in range(self.backups - 1, 0, -1):
+            source = '%s.%d' % (path, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (path, i + 1))
+        if self.backups > 0:
+            os.rename(path, path + '.1')
+        else:
+            os.remove(path)
+
+    def start_flusher(self, interval=1):
+        """
+        Spawn a greenlet which periodically writes buffered records
+        """
+        if not self.enabled or self.flusher is not None:
+            return
+
+        def flush():
+            while True:
+                gevent.sleep(interval)
+                self.flush()
+        self.flusher = gevent.spawn(flush)
+        atexit.register(self.flush)
+
+
+def redact_path(path):
+    """
+    :return: path with the values of any REDACTED_FIELDS in its query string replaced
+    """
+    base, _, query = path.partition('?')
+    params = parse_qsl(query, keep_blank_values=True)
+    if not any(name in REDACTED_FIELDS for name, _ in params):
+        return path
+    return '%s?%s' % (base, urlencode([(name, REDACTED if name in REDACTED_FIELDS else value)
+                                       for name, value in params]))
+
+
+def redact_body(body):
+    """
+    :return: A traced ["json", value] or ["form", dict] body with any REDACTED_FIELDS replaced
+    """
+    if not body or not isinstance(body[1], dict):
+        return body
+    kind, value = body
+    return [kind, dict((name, REDACTED if name in REDACTED_FIELDS else field) for name, field in value.items())]
+
+
+def process_files(path):
+    """
+    Return the per-process trace files written for path (excluding their rotated backups)
+    """
+    pattern = re.compile(re.escape(path) + r'-\d+$')
+    return sorted(name for name in glob.glob(path + '-*') if pattern.match(name))
+
+
+def trace_files(path):
+    """
+    Return the trace file and its rotated backups, oldest first
+    """
+    backups = []
+    i = 1
+    while os.path.exists('%s.%d' % (path, i)):
+        backups.append('%s.%d' % (path, i))
+        i += 1
+    files = list(reversed(backups))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_trace(path, kinds=(HTTP, RPC)):
+    """
+    Return the records of a trace (every process's files, including rotated backups) in time order
+    """
+    names = trace_files(path)
+    for process_path in process_files(path):
+        names.extend(trace_files(process_path))
+    records = []
+    for name in names:
+        with open(name) as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record and record[0] in kinds:
+                    records.append(record)
+    # records are written on completion, sort back into start order
+    records.sort(key=lambda record: record[1])
+    return records
+
+
+recorder = TraceRecorder.from_environ()
@@ -1,72 +1,101 @@
 import json
 import logging
+import time
 
 from flask import request
 from werkzeug.exceptions import abort
 
-from ooi_instrument_agent.client import ZmqDriverClient
+from ooi_instrument_agent.client import ZmqDriverClient, socket_pool
+from ooi_instrument_agent.metrics import timed, CONSUL_LATENCY
 
 DEFAULT_TIMEOUT = 90000
 log = logging.getLogger(__name__)
 
 
-def get_client(consul, driver_id):
+def get_client(discovery, driver_id, addresses=None):
     """
     Create a ZmqDriverClient for the specified driver_id
-    :param consul: Instance of consul.Consul
+    :param discovery: Discovery backend, see ooi_instrument_agent.discovery
     :param driver_id: Reference designator of target driver
+    :param addresses: Known driver addresses (see get_driver_registry), discovery is asked for drivers not listed
     :return: ZmqDriverClient if found, otherwise 404
     """
-    return ZmqDriverClient(*get_host_and_port(consul, driver_id))
+    if addresses and driver_id in addresses:
+        host, port = addresses[driver_id]
+    else:
+        host, port = get_host_and_port(discovery, driver_id)
+    return ZmqDriverClient(host, port, refdes=driver_id, pool=socket_pool)
 
 
-def get_host_and_port(consul, driver_id):
+def get_host_and_port(discovery, driver_id):
     """
     Return the host and port for the specified driver_id
-    :param consul: Instance of consul.Consul
+    :param discovery: Discovery backend
     :param driver_id: Reference designator of target driver
     :return: host, port if found, otherwise 404
     """
-    host_and_port = get_service_host_and_port(consul, 'instrument_driver', tag=driver_id)
+    host_and_port = get_service_host_and_port(discovery, 'instrument_driver', tag=driver_id)
     if host_and_port is None:
         abort(404)
     return host_and_port
 
 
-def get_service_host_and_port(consul, service_id, tag=None):
+def get_service_host_and_port(discovery, service_id, tag=None):
     """
     Return the first passing host and port for the specified service_id
-    :param consul: Instance of consul.Consul
+    :param discovery: Discovery backend
     :param service_id: service_id
     :param tag: tag
     :return: host, port if found, otherwise None
     """
-    index, matches = consul.health.service(service_id, tag=tag, passing=True)
-    for match in matches:
-        host = match.get('Node', {}).get('Address')
-        port = match.get('Service', {}).get('Port')
+    with timed(CONSUL_LATENCY, 'consul', operation=service_id):
+        index, instances = discovery.services(service_id, tag=tag)
+    for host, port, tags in instances:
         if host and port:
             return host, port
 
 
-def list_drivers(consul):
+def list_drivers(discovery):
     """
-    Return a list of all passing drivers currently registered in Consul
-    :param consul: Instance of consul.Consul
+    Return a list of all passing drivers currently registered
+    :param discovery: Discovery backend
     :return: List of reference designators
     """
+    return get_driver_registry(discovery)['drivers']
+
+
+def list_driver_addresses(discovery):
+    """
+    Return the host and port of all passing drivers currently registered
+    :param discovery: Discovery backend
+    :return: Dictionary of reference designator -> (host, port)
+    """
+    return dict((refdes, tuple(address)) for refdes, address in get_driver_registry(discovery)['addresses'].items())
+
+
+def get_driver_registry(discovery):
+    """
+    Return everything known about the passing drivers from a single registry query
+    :param discovery: Discovery backend
+    :return: {'index': registry index, 'drivers': list of reference designators,
+              'addresses': {reference designator: [host, port]}}
+    """
     drivers = []
-    index, passing = consul.health.service('instrument_driver', passing=True)
-    for each in passing:
-        tags = each.get('Service', {}).get('Tags', [])
+    addresses = {}
+    with timed(CONSUL_LATENCY, 'consul', operation='list_drivers'):
+        index, instances = discovery.services('instrument_driver')
+    for host, port, tags in instances:
         drivers.extend(tags)
-    return drivers
+        if host and port:
+            for tag in tags:
+                addresses[tag] = [host, port]
+    return {'index': index, 'drivers': drivers, 'addresses': addresses}
 
 
-def get_port_agent(consul, driver_id):
+def get_port_agent(discovery, driver_id):
     """
-    Fetch the port agent information for the specified driver from Consul
-    :param consul: Instance of consul.Consul
+    Fetch the port agent information for the specified driver
+    :param discovery: Discovery backend
     :param driver_id: Reference designator of target driver
     :return: Dictionary containing the port agent data for the specified driver
     """
@@ -75,7 +104,7 @@ def get_port_agent(consul, driver_id):
                              ('command', 'command-port-agent'),
                              ('sniff', 'sniff-port-agent'),
                              ('da', 'da-port-agent')]:
-        host_and_port = get_service_host_and_port(consul, service_id, tag=driver_id)
+        host_and_port = get_service_host_and_port(discovery, service_id, tag=driver_id)
         if host_and_port:
             host, port = host_and_port
             return_dict[name] = {'host': host, 'port': port}
@@ -125,3 +154,29 @@ def get_timeout():
         return int(val)
     except (ValueError, TypeError):
         return DEFAULT_TIMEOUT
+
+
+def get_max_age():
+    """
+    Get the oldest acceptable cached reply, in seconds, from the request object
+    :return: max_age as a float, or None for the configured default
+    """
+    val = get_from_request('max_age')
+
+    try:
+        return max(float(val), 0)
+    except (ValueError, TypeError):
+        return None
+
+
+def get_deadline():
+    """
+    Get the time by which the request must complete from the request object's deadline, in seconds from now
+    :return: deadline as a timestamp, or None if not given
+    """
+    val = get_from_request('deadline')
+
+    try:
+        return time.time() + max(float(val), 0)
+    except (ValueError, TypeError):
+        return None
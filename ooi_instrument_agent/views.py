@@ -2,25 +2,60 @@ import json
 import logging
 import os
 import socket
+import time
 import gevent
 import requests
 from functools import wraps
 
 from consul import Consul
-from flask import jsonify, request, Blueprint, send_file, safe_join, Response
-
-from ooi_instrument_agent.client import TimeoutException, ParameterException
-from ooi_instrument_agent.common import get_sniffer_socket, stopwatch
+from flask import request, Blueprint, Response, g
+
+from ooi_instrument_agent import metrics, trace
+from ooi_instrument_agent.accesslog import AccessLog, LogQueue
+from ooi_instrument_agent.assets import AssetStore
+from ooi_instrument_agent.cache import DriverCache
+from ooi_instrument_agent.cancel import RequestWatch, client_socket
+from ooi_instrument_agent.encoding import json_response, conditional_json_response, Compressor
+from ooi_instrument_agent.client import (TimeoutException, ParameterException, DriverUnresponsive, RequestCancelled,
+                                         socket_pool, get_context)
+from ooi_instrument_agent.common import (get_sniffer_socket, get_sniffer_sockets, get_metrics_dir, get_consul_address,
+                                         get_env_number, SHARED_STATUS_INTERVAL_ENV_KEY,
+                                         DEFAULT_SHARED_STATUS_INTERVAL)
+from ooi_instrument_agent.discovery import get_discovery
+from ooi_instrument_agent.heartbeat import HeartbeatMonitor
+from ooi_instrument_agent.hubmonitor import HubMonitor, open_fds
 from ooi_instrument_agent.lock import LockManager, Locked
-from ooi_instrument_agent.utils import list_drivers, get_client, get_port_agent, get_from_request, get_timeout
+from ooi_instrument_agent.priority import PriorityClasses, Overloaded
+from ooi_instrument_agent.profiling import RequestProfiler
+from ooi_instrument_agent.ratelimit import RateLimiter, RateLimited
+from ooi_instrument_agent.shared import SharedCache
+from ooi_instrument_agent.utils import (get_client, get_port_agent, get_from_request, get_timeout,
+                                        list_driver_addresses, get_max_age, get_driver_registry, get_deadline)
 
 
 page = Blueprint('instrument', __name__)
 page.lock_manager = None
 page.consul = None
+page.discovery = None
+page.profiler = RequestProfiler.from_environ()
+page.assets = AssetStore.from_environ()
+page.compressor = Compressor.from_environ()
+page.shared = SharedCache.from_environ()
+page.driver_cache = DriverCache.from_environ(page.shared)
+page.heartbeat = HeartbeatMonitor.from_environ()
+page.rate_limiter = RateLimiter.from_environ()
+page.priorities = PriorityClasses.from_environ()
+page.access_log = AccessLog.from_environ()
+page.log_queue = LogQueue.from_environ()
+page.hub_monitor = HubMonitor.from_environ()
+page.warmed = False
+page.served_first = False
 
 log = logging.getLogger(__name__)
-sniff_sockfile = get_sniffer_socket()
+
+# monitoring and the UI are never rate limited
+UNLIMITED_ENDPOINTS = ('instrument.get_metrics', 'instrument.runtime', 'instrument.app', 'instrument.css',
+                       'instrument.js', 'instrument.partials')
 
 
 def lockout(func):
@@ -37,39 +72,302 @@ def lockout(func):
     return inner
 
 
+def responsive(func):
+    """
+    Decorator which fails fast if the target driver has stopped answering heartbeats,
+    rather than waiting out the RPC timeout
+    """
+    @wraps(func)
+    def inner(driver_id):
+        heartbeat = liveness()
+        if heartbeat.is_dead(driver_id):
+            status = heartbeat.status(driver_id)
+            raise DriverUnresponsive({'unresponsive': driver_id, 'last_seen': status['last_seen']})
+        return func(driver_id)
+    return inner
+
+
+def invalidates(func):
+    """
+    Decorator for commands which may change driver state, dropping the driver's cached replies
+    both before the command (so no read started meanwhile is kept) and once it has completed
+    """
+    @wraps(func)
+    def inner(driver_id):
+        page.driver_cache.invalidate(driver_id)
+        page.shared.invalidate('status')
+        try:
+            return func(driver_id)
+        finally:
+            page.driver_cache.invalidate(driver_id)
+            page.shared.invalidate('status')
+    return inner
+
+
+def cached_read(driver_id, command, args=(), max_age=None, timeout=None):
+    """
+    Perform a read-only client command through the driver cache
+    """
+    def fetch():
+        with driver_client(driver_id) as client:
+            return getattr(client, command)(*args, timeout=timeout)
+    return page.driver_cache.get(driver_id, command, args, fetch, max_age)
+
+
+def driver_registry():
+    """
+    The passing drivers, from the shared snapshot if it is current, otherwise from discovery
+    """
+    registry = page.shared.get('drivers')
+    if registry is None:
+        registry = get_driver_registry(page.discovery)
+    return registry
+
+
+def driver_client(driver_id):
+    registry = page.shared.get('drivers')
+    return get_client(page.discovery, driver_id, registry and registry['addresses'])
+
+
+def current_locks():
+    """
+    :return: (index, {driver_id: lock holder}), from the shared snapshot if it is current
+    """
+    locks = page.shared.get('locks')
+    if locks is None:
+        return page.lock_manager.snapshot()
+    return locks['index'], locks['locks']
+
+
+def lock_holder(driver_id):
+    """
+    :return: Holder of the lock on driver_id, from the shared snapshot if it is current, otherwise by
+             looking up that one lock
+    """
+    locks = page.shared.get('locks')
+    if locks is None:
+        return page.lock_manager[driver_id]
+    return locks['locks'].get(driver_id)
+
+
+def liveness():
+    """
+    :return: The heartbeat monitor, updated from the shared refresher's heartbeats
+    """
+    drivers = page.shared.get('liveness')
+    if drivers is not None:
+        page.heartbeat.merge(drivers)
+    return page.heartbeat
+
+
 @page.before_request
 def before_request():
-    log.info('Request: %r', request.url)
+    log.debug('Request: %r', request.url)
+    g.start = time.time()
+    g.phases = {}
+    if page.consul is None:
+        # not initialized by the gunicorn worker hook, e.g. the development server
+        setup()
+    metrics.REQUESTS_IN_FLIGHT.inc(endpoint=request.endpoint)
+    page.profiler.start()
+    if page.rate_limiter.enabled and request.endpoint not in UNLIMITED_ENDPOINTS:
+        # not the lock key, which a caller could change on every request to get a fresh bucket
+        page.rate_limiter.admit(request.remote_addr, (request.view_args or {}).get('driver_id'), request.endpoint)
+    priority = page.priorities.classify(request.endpoint)
+    g.priority_class = priority.name
+    if priority.name != 'other':
+        # requests which may wait on drivers are abandoned when nobody is left to answer
+        g.watch = RequestWatch(gevent.getcurrent(), request.endpoint, client_socket(request.environ),
+                               get_deadline()).start()
+    priority.acquire()
+    g.priority = priority
+
+
+@page.after_request
+def after_request(response):
+    stop_watch()
+    g.status = response.status_code
+    g.response_size = response.content_length
+    response = page.profiler.finish(response)
+    return page.compressor.compress(response)
+
+
+@page.teardown_request
+def teardown_request(exception=None):
+    stop_watch()
+    page.profiler.stop()
+    priority = getattr(g, 'priority', None)
+    if priority is not None:
+        priority.release()
+        g.priority = None
+    start = getattr(g, 'start', None)
+    if start is None:
+        return
+    endpoint = request.endpoint
+    status = getattr(g, 'status', 500)
+    elapsed = time.time() - start
+    metrics.REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+    metrics.REQUEST_LATENCY.observe(elapsed, endpoint=endpoint, method=request.method, status=status)
+    for phase, seconds in g.phases.iteritems():
+        metrics.REQUEST_PHASE_LATENCY.observe(seconds, endpoint=endpoint, phase=phase)
+    if not page.served_first:
+        page.served_first = True
+        metrics.FIRST_REQUEST_LATENCY.observe(elapsed, endpoint=endpoint, warmed=str(page.warmed).lower())
+        log.info('First request (%s, warmed=%s) took %.3fs', endpoint, page.warmed, elapsed)
+    if status >= 400:
+        metrics.REQUEST_ERRORS.inc(endpoint=endpoint, status=status)
+    page.access_log.record(request.method, request.full_path, endpoint, (request.view_args or {}).get('driver_id'),
+                           status, elapsed, getattr(g, 'response_size', None), request.remote_addr,
+                           getattr(g, 'priority_class', None), g.phases)
+    if trace.recorder.enabled:
+        trace.recorder.record_http((request.view_args or {}).get('driver_id'), endpoint, request.method,
+                                   request.full_path, get_request_body(), elapsed,
+                                   getattr(g, 'response_size', None), status)
+
+
+def stop_watch():
+    watch = getattr(g, 'watch', None)
+    if watch is not None:
+        watch.stop()
+        g.watch = None
+
+
+def get_request_body():
+    """
+    :return: The body of a non-GET request as ["json", value] or ["form", dict], for tracing
+    """
+    if request.method == 'GET':
+        return None
+    if request.is_json:
+        return ['json', request.get_json(silent=True)]
+    if request.form:
+        return ['form', request.form.to_dict()]
+    return None
 
 
 @page.errorhandler(Locked)
 @page.errorhandler(TimeoutException)
 @page.errorhandler(ParameterException)
+@page.errorhandler(DriverUnresponsive)
+@page.errorhandler(RequestCancelled)
 def handle_locked(error):
-    response = jsonify(error.message)
-    response.status_code = error.status_code
+    return json_response(error.message, status=error.status_code)
+
+
+@page.errorhandler(RateLimited)
+@page.errorhandler(Overloaded)
+def handle_retry_later(error):
+    response = json_response(error.message, status=error.status_code)
+    response.headers['Retry-After'] = str(error.retry_after)
     return response
 
 
-@page.before_app_first_request
 def setup():
-    page.consul = Consul()
+    """
+    Create the Consul client, discovery backend and lock manager, load the UI assets and start the background
+    flushers, hub monitor and driver heartbeats, or the shared cache refresher which runs them
+    """
+    host, port = get_consul_address().rsplit(':', 1)
+    page.consul = Consul(host=host, port=int(port))
     adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=100)
     page.consul.http.session.mount('http://', adapter)
     page.lock_manager = LockManager(page.consul)
+    page.discovery = get_discovery(page.consul)
+    page.assets.scan()
+    metrics_dir = get_metrics_dir()
+    if metrics_dir:
+        metrics.start_flusher(metrics_dir)
+    trace.recorder.start_flusher()
+    page.hub_monitor.start()
+    if page.shared.enabled:
+        start_shared_refresher()
+    else:
+        page.heartbeat.start(page.discovery)
+
+
+def start_shared_refresher():
+    """
+    Stand for election as the process which polls Consul and the drivers on behalf of all workers
+    """
+    def locks():
+        index, current = page.lock_manager.snapshot()
+        return {'index': index, 'locks': current}
+
+    def heartbeats():
+        page.heartbeat.check_all(driver_registry()['addresses'])
+        return page.heartbeat.drivers
+
+    def status():
+        greenlets = [(driver_id, page.priorities['bulk'].spawn(get_driver_resource_state, driver_id, 0))
+                     for driver_id in driver_registry()['drivers'] if not page.heartbeat.is_dead(driver_id)]
+        gevent.joinall([greenlet for _, greenlet in greenlets])
+        return dict((driver_id, greenlet.value) for driver_id, greenlet in greenlets if greenlet.successful())
+
+    page.shared.register('drivers', lambda: get_driver_registry(page.discovery))
+    page.shared.register('locks', locks)
+    if page.heartbeat.enabled:
+        page.shared.register('liveness', heartbeats, page.heartbeat.interval)
+    status_interval = get_env_number(SHARED_STATUS_INTERVAL_ENV_KEY, DEFAULT_SHARED_STATUS_INTERVAL, float)
+    if status_interval > 0:
+        page.shared.register('status', status, status_interval)
+    page.shared.start()
+
+
+def warm_up():
+    """
+    Open pooled connections to Consul, the lock store and every running driver
+    :return: Number of drivers connected
+    """
+    addresses = list_driver_addresses(page.discovery)
+    len(page.lock_manager)
+    for host, port in set(addresses.values()):
+        socket_pool.prewarm(host, port)
+    page.warmed = True
+    return len(addresses)
+
+
+def initialize_worker(warm=True):
+    """
+    Prepare this worker before it accepts traffic, recording how long each phase took
+    :return: Dictionary of phase -> seconds
+    """
+    timings = {}
+    start = time.time()
+    setup()
+    timings['setup'] = time.time() - start
+    if warm:
+        start = time.time()
+        try:
+            drivers = warm_up()
+        except Exception as e:
+            # a worker which cannot warm up can still serve, paying the cost on demand
+            log.warn('Worker warm up failed: %s', e)
+        else:
+            log.info('Connected to %d drivers', drivers)
+        timings['warm_up'] = time.time() - start
+    for phase, elapsed in timings.iteritems():
+        metrics.WORKER_STARTUP.observe(elapsed, phase=phase)
+    log.info('Worker %d initialized: %s', os.getpid(),
+             ', '.join('%s %.3fs' % (phase, elapsed) for phase, elapsed in sorted(timings.items())))
+    return timings
 
 
 @page.route('/api')
 def get_drivers():
-    running_drivers = list_drivers(page.consul)
-    return Response(json.dumps(running_drivers), mimetype='application/json')
+    registry = driver_registry()
+    if get_from_request('liveness'):
+        # annotated from the heartbeat map, no driver is contacted
+        heartbeat = liveness()
+        return conditional_json_response(dict((driver_id, heartbeat.status(driver_id))
+                                              for driver_id in registry['drivers']))
+    return conditional_json_response(registry['drivers'], etag='drivers-%s' % registry['index'])
 
 
 @page.route('/api/status')
 def get_drivers_status():
     startswith = get_from_request('startswith')
     contains = get_from_request('contains')
-    running_drivers = list_drivers(page.consul)
+    running_drivers = driver_registry()['drivers']
 
     if startswith:
         drivers = [x for x in running_drivers if x.startswith(startswith)]
@@ -79,175 +377,381 @@ def get_drivers_status():
         drivers = running_drivers
 
     # fetch all
+    max_age = get_max_age()
+    if max_age is None:
+        max_age = page.driver_cache.default_max_age
+    shared = page.shared.get('status', max_age) if max_age > 0 else None
+    heartbeat = liveness()
     greenlets = []
-    for driver_id in drivers:
-        greenlets.append((driver_id, gevent.spawn(get_driver_resource_state, driver_id)))
-
-    # resolve results
     result = {}
-    for each in greenlets:
-        driver_id, greenlet = each
-        status = greenlet.get()
-        result[driver_id] = status
-
-    return Response(json.dumps(result), mimetype='application/json')
+    try:
+        for driver_id in drivers:
+            if heartbeat.is_dead(driver_id):
+                result[driver_id] = None
+                continue
+            if shared and driver_id in shared:
+                result[driver_id] = shared[driver_id]
+                continue
+            # blocks while the bulk pool is full
+            greenlets.append((driver_id, page.priorities['bulk'].spawn(get_driver_resource_state, driver_id,
+                                                                       max_age)))
+
+        # resolve results
+        for each in greenlets:
+            driver_id, greenlet = each
+            status = greenlet.get()
+            result[driver_id] = status
+    except RequestCancelled:
+        gevent.killall([greenlet for _, greenlet in greenlets], block=False)
+        raise
+
+    return json_response(result)
 
 
-@stopwatch(log)
 @page.route('/api/<driver_id>')
+@responsive
 def get_driver(driver_id):
-    return jsonify(get_driver_overall_state(driver_id))
+    return conditional_json_response(get_driver_overall_state(driver_id))
 
 
 def get_driver_overall_state(driver_id):
-    locker = page.lock_manager[driver_id]
-    with get_client(page.consul, driver_id) as client:
+    locker = lock_holder(driver_id)
+    with driver_client(driver_id) as client:
         state = client.get_state()
         state['locked-by'] = locker
         return state
 
 
-def get_driver_resource_state(driver_id):
-    with get_client(page.consul, driver_id) as client:
-        state = client.get_resource_state().get('value')
-        return state
+def get_driver_resource_state(driver_id, max_age=None):
+    return cached_read(driver_id, 'get_resource_state', max_age=max_age).get('value')
 
 
 @page.route('/api/<driver_id>/portagent')
 def get_driver_port_agent(driver_id):
-    return jsonify(get_port_agent(page.consul, driver_id))
+    return json_response(get_port_agent(page.discovery, driver_id))
 
 
 @page.route('/api/<driver_id>/ping')
 def ping(driver_id):
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.ping())
+    start = time.time()
+    with driver_client(driver_id) as client:
+        try:
+            response = client.ping()
+        except TimeoutException:
+            page.heartbeat.record(driver_id, None)
+            raise
+    # a live ping revives a driver without waiting for the next heartbeat
+    page.heartbeat.record(driver_id, time.time() - start)
+    return json_response(response)
 
 
 @page.route('/api/<driver_id>/state')
+@responsive
 def resource_state(driver_id):
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.get_resource_state())
+    return conditional_json_response(cached_read(driver_id, 'get_resource_state', max_age=get_max_age()))
 
 
 @page.route('/api/<driver_id>/discover', methods=['POST'])
+@responsive
 @lockout
+@invalidates
 def discover(driver_id):
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.discover(timeout=get_timeout()))
+    with driver_client(driver_id) as client:
+        return json_response(client.discover(timeout=get_timeout()))
 
 
 @page.route('/api/<driver_id>/set_init_params', methods=['POST'])
+@responsive
 @lockout
+@invalidates
 def set_init_params(driver_id):
     config = get_from_request('config')
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.set_init_params(config, timeout=get_timeout()))
+    with driver_client(driver_id) as client:
+        return json_response(client.init_params(config, timeout=get_timeout()))
 
 
 @page.route('/api/<driver_id>/resource', methods=['GET'])
+@responsive
 def get_resource(driver_id):
     resource = get_from_request('resource', 'DRIVER_PARAMETER_ALL')
     timeout = get_timeout()
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.get_resource(resource, timeout=timeout))
+    return conditional_json_response(cached_read(driver_id, 'get_resource', (resource,), get_max_age(), timeout))
 
 
 @page.route('/api/<driver_id>/resource', methods=['POST'])
+@responsive
 @lockout
+@invalidates
 def set_resource(driver_id):
     resource = get_from_request('resource')
     timeout = get_timeout()
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.set_resource(resource, timeout=timeout))
+    skip_unchanged = bool(get_from_request('skip_unchanged', False))
+    with driver_client(driver_id) as client:
+        return json_response(client.set_resource(resource, timeout=timeout, skip_unchanged=skip_unchanged))
 
 
 @page.route('/api/<driver_id>/execute', methods=['POST'])
+@responsive
 @lockout
+@invalidates
 def execute(driver_id):
     command = get_from_request('command')
     kwargs = get_from_request('kwargs', {})
     # timeout =re get_timeout()
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.execute(command, **kwargs))
+    with driver_client(driver_id) as client:
+        return json_response(client.execute(command, **kwargs))
 
 
 @page.route('/api/<driver_id>/shutdown', methods=['POST'])
+@responsive
 @lockout
+@invalidates
 def shutdown(driver_id):
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.shutdown())
+    with driver_client(driver_id) as client:
+        return json_response(client.shutdown())
 
 
 @page.route('/api/<driver_id>/set_log_level', methods=['POST'])
+@responsive
 @lockout
 def set_log_level(driver_id):
     level = get_from_request('level')
     timeout = get_timeout()
-    with get_client(page.consul, driver_id) as client:
-        return jsonify(client.set_log_level(timeout=timeout, level=level))
+    with driver_client(driver_id) as client:
+        return json_response(client.set_log_level(timeout=timeout, level=level))
 
 
 @page.route('/api/<driver_id>/lock', methods=['GET'])
 def get_lock(driver_id):
-    return jsonify({'locked-by': page.lock_manager[driver_id]})
+    return json_response({'locked-by': page.lock_manager[driver_id]})
 
 
 @page.route('/api/<driver_id>/lock', methods=['POST'])
 def set_lock(driver_id):
     key = get_from_request('key')
     page.lock_manager[driver_id] = key
-    return jsonify({'locked-by': page.lock_manager[driver_id]})
+    page.shared.invalidate('locks')
+    return json_response({'locked-by': page.lock_manager[driver_id]})
 
 
 @page.route('/api/<driver_id>/unlock', methods=['POST'])
 @page.route('/api/<driver_id>/lock', methods=['DELETE'])
 def unlock(driver_id):
     del page.lock_manager[driver_id]
-    return jsonify({'locked-by': page.lock_manager[driver_id]})
+    page.shared.invalidate('locks')
+    return json_response({'locked-by': page.lock_manager[driver_id]})
+
+
+MAX_BATCH_OPERATIONS = 50
+BATCH_READS = ('ping', 'overall_state', 'state', 'get_resource')
+# operations refused while another key holds the lock, as the single endpoints are
+BATCH_WRITES = ('lock', 'unlock', 'set_resource', 'execute', 'discover', 'set_init_params', 'set_log_level')
+
+
+def run_batch_operation(client, operation, timeout):
+    """
+    Perform one non-lock batch operation, taking its arguments as the corresponding endpoint does
+    """
+    name = operation['op']
+    if name == 'ping':
+        return client.ping(timeout=timeout)
+    if name == 'overall_state':
+        return client.get_state(timeout=timeout)
+    if name == 'state':
+        return client.get_resource_state(timeout=timeout)
+    if name == 'get_resource':
+        return client.get_resource(operation.get('resource', 'DRIVER_PARAMETER_ALL'), timeout=timeout)
+    if name == 'set_resource':
+        return client.set_resource(operation.get('resource'), timeout=timeout,
+                                   skip_unchanged=bool(operation.get('skip_unchanged', False)))
+    if name == 'execute':
+        return client.execute(operation.get('command'), **operation.get('kwargs', {}))
+    if name == 'discover':
+        return client.discover(timeout=timeout)
+    if name == 'set_init_params':
+        return client.init_params(operation.get('config'), timeout=timeout)
+    if name == 'set_log_level':
+        return client.set_log_level(timeout=timeout, level=operation.get('level'))
+
+
+def validate_batch(operations):
+    """
+    :raises ParameterException: unless operations is a list of known operations
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ParameterException({'operations': 'expected a list of operations'})
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise ParameterException({'operations': 'at most %d operations per batch' % MAX_BATCH_OPERATIONS})
+    for i, operation in enumerate(operations):
+        name = operation.get('op') if isinstance(operation, dict) else None
+        if name not in BATCH_READS and name not in BATCH_WRITES:
+            raise ParameterException({'operations': 'operation %d: unknown op %r' % (i, name)})
+
+
+@page.route('/api/<driver_id>/batch', methods=['POST'])
+@responsive
+def batch(driver_id):
+    """
+    Run an ordered list of operations on one driver over a single connection, e.g.
+
+        {"key": "me", "operations": [{"op": "lock"},
+                                     {"op": "set_resource", "resource": {"PARAM": 1}},
+                                     {"op": "execute", "command": "DRIVER_EVENT_ACQUIRE_SAMPLE"},
+                                     {"op": "get_resource"},
+                                     {"op": "unlock"}]}
+
+    The driver is looked up and the lock read once, and the driver's metadata fetched at most once.
+    Execution stops at the first failing operation; if the batch took the lock itself, it is released
+    again. Returns a result per operation run, each with its status code, result or error and elapsed
+    seconds.
+    """
+    operations = get_from_request('operations')
+    validate_batch(operations)
+    key = get_from_request('key')
+    timeout = get_timeout()
+    locker = page.lock_manager[driver_id]
+    results = []
+    took_lock = completed = False
+    page.driver_cache.invalidate(driver_id)
+    page.shared.invalidate('status')
+    try:
+        with driver_client(driver_id) as client:
+            for operation in operations:
+                name = operation['op']
+                start = time.time()
+                try:
+                    if name in BATCH_WRITES and locker not in (None, key):
+                        raise Locked({'locked-by': locker})
+                    if name == 'lock':
+                        if locker is None:
+                            page.lock_manager[driver_id] = key
+                            page.shared.invalidate('locks')
+                            took_lock = True
+                        locker = key
+                        result = {'locked-by': locker}
+                    elif name == 'unlock':
+                        del page.lock_manager[driver_id]
+                        page.shared.invalidate('locks')
+                        locker = None
+                        took_lock = False
+                        result = {'locked-by': None}
+                    else:
+                        result = run_batch_operation(client, operation, timeout)
+                except (Locked, TimeoutException, ParameterException) as e:
+                    results.append({'op': name, 'status': e.status_code, 'error': e.message,
+                                    'elapsed': time.time() - start})
+                    break
+                except Exception as e:
+                    log.exception('Batch operation %s on %s failed', name, driver_id)
+                    results.append({'op': name, 'status': getattr(e, 'status_code', 500),
+                                    'error': '%s: %s' % (type(e).__name__, e), 'elapsed': time.time() - start})
+                    break
+                results.append({'op': name, 'status': 200, 'result': result, 'elapsed': time.time() - start})
+        completed = len(results) == len(operations) and results[-1]['status'] == 200
+    finally:
+        if took_lock and not completed:
+            release_batch_lock(driver_id, key)
+        page.driver_cache.invalidate(driver_id)
+        page.shared.invalidate('status')
+    return json_response({'results': results, 'completed': completed})
+
+
+def release_batch_lock(driver_id, key):
+    """
+    Release a lock taken by a batch which did not complete, unless it has changed hands since
+    """
+    try:
+        if page.lock_manager[driver_id] == key:
+            del page.lock_manager[driver_id]
+            page.shared.invalidate('locks')
+    except Exception:
+        log.exception('Unable to release the lock on %s taken by an incomplete batch', driver_id)
 
 
 @page.route('/api/<driver_id>/sniff')
 def sniff(driver_id):
     key = get_from_request('key')
-    command = json.dumps([driver_id, key])
-    data = get_sniff_data(command)
+    options = {}
+    for name in ['types', 'after', 'payload', 'start', 'end']:
+        value = get_from_request(name)
+        if value is not None:
+            options[name] = value
+
+    if options:
+        command = json.dumps([driver_id, key, options])
+    else:
+        command = json.dumps([driver_id, key])
+    data = get_sniff_data(command, get_sniffer_socket(driver_id))
     return data
 
 
+@page.route('/api/sniffer/stats')
+def sniffer_stats():
+    # merge the statistics from every sniffer shard
+    stats = {'sessions': [], 'recording': [], 'buffered_bytes': 0, 'shards': 0}
+    for sockfile in get_sniffer_sockets():
+        shard_stats = json.loads(get_sniff_data(json.dumps('stats'), sockfile))
+        stats['sessions'].extend(shard_stats.pop('sessions', []))
+        stats['recording'].extend(shard_stats.pop('recording', []))
+        stats['buffered_bytes'] += shard_stats.pop('buffered_bytes', 0)
+        stats['shards'] += 1
+        stats.update(shard_stats)
+    return json_response(stats)
+
+
 @page.route('/api/locks')
 def locks():
-    return jsonify({'locks': dict(page.lock_manager.iteritems())})
+    index, current = current_locks()
+    return conditional_json_response({'locks': current}, etag='locks-%s' % index)
+
+
+@page.route('/metrics')
+def get_metrics():
+    return Response(metrics.collect(get_metrics_dir()), mimetype='text/plain; version=0.0.4')
+
+
+@page.route('/admin/runtime')
+def runtime():
+    """
+    Saturation of this worker: greenlets (as last counted by the hub monitor), ZMQ sockets, file descriptors
+    and gevent hub blocking
+    """
+    fds, fd_limit = open_fds()
+    return json_response({
+        'pid': os.getpid(),
+        'greenlets': page.hub_monitor.greenlet_counts(),
+        'zmq_sockets': {'open': len(getattr(get_context(), '_sockets', ())), 'pooled': len(socket_pool),
+                        'in_flight': sum(metrics.ZMQ_IN_FLIGHT.samples.values())},
+        'fds': {'open': fds, 'limit': fd_limit},
+        'requests_in_flight': sum(metrics.REQUESTS_IN_FLIGHT.samples.values()),
+        'hub': page.hub_monitor.status(),
+    })
 
 
 @page.route('/app')
 def app():
-    source_dir = 'agent-web/app'
-    return send_file(os.path.join(source_dir, 'index.html'))
+    return page.assets.response('index.html')
 
 
 @page.route('/css/<cssfile>')
 def css(cssfile):
-    source_dir = 'agent-web/app/css'
-    return send_file(safe_join(source_dir, cssfile))
+    return page.assets.response('css/' + cssfile)
 
 
 @page.route('/js/<jsfile>')
 def js(jsfile):
-    source_dir = 'agent-web/app/js'
-    return send_file(safe_join(source_dir, jsfile))
+    return page.assets.response('js/' + jsfile)
 
 
 @page.route('/partials/<pfile>')
 def partials(pfile):
-    source_dir = 'agent-web/app/partials'
-    return send_file(safe_join(source_dir, pfile))
+    return page.assets.response('partials/' + pfile)
 
 
-def get_sniff_data(command):
+def get_sniff_data(command, sockfile):
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sock.settimeout(5.0)
-    sock.connect(sniff_sockfile)
+    sock.connect(sockfile)
     sock.send(command)
     data = ''
     while True:
@@ -1,4 +1,8 @@
 #!/usr/bin/env python
 
 from ooi_instrument_agent import app
+from ooi_instrument_agent.views import page
+
+# pick up edits to the UI without restarting
+page.assets.reload = True
 app.run(host='0.0.0.0', port=12570, debug=True)
\ No newline at end of file
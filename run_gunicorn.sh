@@ -1,3 +1,11 @@
 #!/bin/bash
 
-gunicorn --log-config logging.conf -w 2 -k gevent -b 0.0.0.0:12572 ooi_instrument_agent:app
\ No newline at end of file
+# Each gevent worker writes its metrics here so /instrument/metrics can aggregate across workers
+export AGENT_METRICS_DIR=${AGENT_METRICS_DIR:-/tmp/ooi_agent_metrics}
+rm -rf "$AGENT_METRICS_DIR" && mkdir -p "$AGENT_METRICS_DIR"
+
+# One elected worker polls Consul and the drivers and publishes snapshots here for all workers
+export AGENT_SHARED_DIR=${AGENT_SHARED_DIR:-/dev/shm/ooi_agent_shared}
+rm -rf "$AGENT_SHARED_DIR" && mkdir -p "$AGENT_SHARED_DIR"
+
+gunicorn -c gunicorn_config.py ooi_instrument_agent:app